@@ -0,0 +1,607 @@
+"""A local stand-in for the 4DN data portal and the S3 bucket files are uploaded to.
+
+MockPortal serves just enough of the portal api for get_field_info and import_data to run
+against it end to end without a network connection - /me, /profiles/, /search/, item
+GET/POST/PATCH (with check_only and delete_fields) and the /upload/ credentials of file
+items, which point at a MockS3 server.  latency (seconds) is added to every portal request
+so timings are comparable to a remote portal when benchmarking.
+
+    with MockPortal(latency=0.05) as portal:
+        key = portal.key()  # or portal.write_keyfile(path)
+
+It can also be run on its own, eg. `python -m tests.mock_portal --latency 0.05`, which
+writes a keypairs file for the tools to use and serves until interrupted.
+"""
+import argparse
+import base64
+import copy
+import datetime
+import hashlib
+import json
+import threading
+import time
+import uuid as uuid_lib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+
+def _string(description=''):
+    return {'type': 'string', 'description': description}
+
+
+def _link(linkto, description=''):
+    return {'type': 'string', 'linkTo': linkto, 'description': description}
+
+
+def _array(items, description=''):
+    return {'type': 'array', 'items': items, 'description': description}
+
+
+ATTRIBUTION = {
+    'aliases': _array({'type': 'string'}, 'Lab specific identifiers to reference an object.'),
+    'lab': _link('Lab', 'Lab associated with the submission.'),
+    'award': _link('Award', 'Grant associated with the submission.'),
+    'description': _string('A plain text description of the item.'),
+}
+
+PROFILES = {
+    'User': {'required': ['email'], 'properties': {
+        'email': _string('The email address of the user.'),
+        'first_name': _string(),
+        'last_name': _string(),
+        'submits_for': _array(_link('Lab'), 'Labs the user is authorized to submit data for.'),
+    }},
+    'Award': {'required': ['name'], 'properties': {
+        'name': _string('The official grant number.'),
+        'title': _string('The grant name from the NIH database.'),
+    }},
+    'Lab': {'required': ['name'], 'properties': {
+        'name': _string('A short unique name for the lab.'),
+        'title': _string('A unique name for affiliation identification.'),
+        'awards': _array(_link('Award'), 'Grants associated with the lab.'),
+    }},
+    'Vendor': {'required': ['title'], 'properties': dict(ATTRIBUTION, **{
+        'title': _string('The complete name of the originating lab or vendor.'),
+        'url': _string('An external resource with additional information about the source.'),
+    })},
+    'Biosource': {'required': ['biosource_type'], 'properties': dict(ATTRIBUTION, **{
+        'biosource_type': dict(_string('The categorization of the biosource.'),
+                               enum=['primary cell', 'stem cell', 'immortalized cell line', 'tissue']),
+        'biosource_vendor': _link('Vendor', 'The Lab or Vendor that provided the biosource.'),
+        'cell_line': _string('Ontology term for the cell line used.'),
+    })},
+    'Document': {'properties': dict(ATTRIBUTION, **{
+        'attachment': {'type': 'object', 'attachment': True, 'description': 'File Name of the attachment.',
+                       'properties': {'download': _string(), 'href': _string(), 'type': _string(),
+                                      'md5sum': _string(), 'size': {'type': 'integer'}}},
+        'urls': _array({'type': 'string'}, 'External url(s) associated with the document.'),
+    })},
+    'FileFormat': {'required': ['file_format'], 'properties': {
+        'file_format': _string('Format or extension of the file.'),
+        'standard_file_extension': _string('The standard extension of the format.'),
+        'valid_item_types': _array({'type': 'string'}, 'Types of items that can use this format.'),
+    }},
+    'FileFastq': {'required': ['file_format'], 'properties': dict(ATTRIBUTION, **{
+        'file_format': _link('FileFormat', 'Format of the file.'),
+        'filename': _string('The local file name used at time of submission.'),
+        'md5sum': _string('The md5sum of the file being transferred.'),
+        'status': dict(_string(), enum=['uploading', 'uploaded', 'upload failed']),
+        'filesize': {'type': 'integer', 'description': 'Size of file on disk.'},
+        'paired_end': dict(_string('Which pair the file belongs to (if paired end library).'), enum=['1', '2']),
+        'related_files': _array({'type': 'object', 'properties': {
+            'relationship_type': dict(_string('A controlled term specifying the relationship between files.'),
+                                      enum=['paired with', 'derived from', 'supercedes']),
+            'file': _link('File', 'The related file.'),
+        }}, 'Files related to this one.'),
+    })},
+}
+for _name, _profile in PROFILES.items():
+    _profile.update({'title': _name, 'type': 'object', '$schema': 'http://json-schema.org/draft-04/schema#'})
+    _profile['properties']['uuid'] = {'type': 'string', 'format': 'uuid', 'exclude_from': ['submit4dn'],
+                                      'description': 'Unique identifier'}
+    _profile['properties']['@id'] = {'type': 'string', 'calculatedProperty': True}
+
+# abstract types each item type also counts as
+PARENT_TYPES = {'FileFastq': ['File']}
+COLLECTIONS = {'User': 'users', 'Award': 'awards', 'Lab': 'labs', 'Vendor': 'vendors',
+               'Biosource': 'biosources', 'Document': 'documents', 'FileFormat': 'file-formats',
+               'FileFastq': 'files-fastq'}
+ACCESSION_PREFIXES = {'Biosource': 'SR', 'FileFastq': 'FI'}
+# properties other than aliases that items can be referred to by
+NAME_KEYS = {'Award': 'name', 'Lab': 'name', 'FileFormat': 'file_format'}
+
+
+def item_types(item_type):
+    return [item_type] + PARENT_TYPES.get(item_type, []) + ['Item']
+
+
+def _error(code, title, description, **extra):
+    err = {'@type': ['HTTP' + title.replace(' ', ''), 'Error'], 'status': 'error', 'code': code,
+           'title': title, 'description': description}
+    err.update(extra)
+    return err
+
+
+class PortalError(Exception):
+    def __init__(self, code, body):
+        super(PortalError, self).__init__(code, body)
+        self.code = code
+        self.body = body
+
+
+def not_found(path):
+    return PortalError(404, _error(404, 'Not Found', "The resource could not be found: {}".format(path)))
+
+
+def conflict(key, value):
+    return PortalError(409, _error(409, 'Conflict', 'There was a conflict when trying to complete your request.',
+                                   detail="Keys conflict: [('{}', '{}')]".format(key, value)))
+
+
+def validation_failure(errors):
+    return PortalError(422, {'@type': ['ValidationFailure', 'Error'], 'code': 422, 'status': 'error',
+                             'title': 'Unprocessable Entity', 'description': 'Failed validation',
+                             'errors': [{'location': 'body', 'name': name, 'description': description}
+                                        for name, description in errors]})
+
+
+class _Server(object):
+    """A ThreadingHTTPServer on a free local port serving requests with handle(method, path, headers, body)
+    of the subclass, run in a background thread between start and stop."""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.requests = Counter()
+        self.httpd = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.httpd.server_address[1])
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, headers, content = server.handle(self.command, self.path, self.headers, body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class MockS3(_Server):
+    """Just enough of the S3 api (path style) for boto3 put_object / multipart uploads and deletes.
+    objects is {(bucket, key): content}; on_upload(bucket, key) is called when an object is complete."""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super(MockS3, self).__init__(host, port)
+        self.objects = {}
+        self.uploads = {}
+        self.on_upload = None
+        self._lock = threading.Lock()
+
+    def _store(self, bucket, key, content):
+        self.objects[(bucket, key)] = content
+        if self.on_upload is not None:
+            self.on_upload(bucket, key)
+
+    @staticmethod
+    def _xml(status, tag, **values):
+        content = ''.join('<{0}>{1}</{0}>'.format(k, escape(str(v))) for k, v in values.items())
+        return status, {'Content-Type': 'application/xml'}, \
+            '<?xml version="1.0" encoding="UTF-8"?><{0}>{1}</{0}>'.format(tag, content).encode()
+
+    def _no_such_upload(self, upload_id):
+        return self._xml(404, 'Error', Code='NoSuchUpload', Message='The specified upload does not exist.',
+                         UploadId=upload_id)
+
+    def handle(self, method, path, headers, body):
+        parts = urlsplit(path)
+        query = {k: v[0] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+        bucket, _, key = unquote(parts.path).lstrip('/').partition('/')
+        if headers.get('Content-Encoding') == 'aws-chunked' or 'aws-chunked' in headers.get('Content-Encoding', ''):
+            body = self._dechunk(body)
+        upload_id = query.get('uploadId')
+        with self._lock:
+            self.requests[method] += 1
+            if method == 'PUT' and 'partNumber' in query:
+                if upload_id not in self.uploads:
+                    return self._no_such_upload(upload_id)
+                self.uploads[upload_id]['parts'][int(query['partNumber'])] = body
+                return 200, {'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())}, b''
+            if method == 'PUT':
+                self._store(bucket, key, body)
+                return 200, {'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())}, b''
+            if method == 'POST' and 'uploads' in query:
+                upload_id = uuid_lib.uuid4().hex
+                self.uploads[upload_id] = {'bucket': bucket, 'key': key, 'parts': {}}
+                return self._xml(200, 'InitiateMultipartUploadResult', Bucket=bucket, Key=key, UploadId=upload_id)
+            if method == 'POST' and upload_id:
+                upload = self.uploads.pop(upload_id, None)
+                if upload is None:
+                    return self._no_such_upload(upload_id)
+                content = b''.join(upload['parts'][n] for n in sorted(upload['parts']))
+                self._store(bucket, key, content)
+                return self._xml(200, 'CompleteMultipartUploadResult', Bucket=bucket, Key=key,
+                                 ETag='"{}-{}"'.format(hashlib.md5(content).hexdigest(), len(upload['parts'])))
+            if method == 'GET' and upload_id:
+                upload = self.uploads.get(upload_id)
+                if upload is None:
+                    return self._no_such_upload(upload_id)
+                listed = ''.join('<Part><PartNumber>{}</PartNumber><ETag>"{}"</ETag><Size>{}</Size></Part>'.format(
+                    n, hashlib.md5(p).hexdigest(), len(p)) for n, p in sorted(upload['parts'].items()))
+                return 200, {'Content-Type': 'application/xml'}, (
+                    '<?xml version="1.0" encoding="UTF-8"?><ListPartsResult><Bucket>{}</Bucket><Key>{}</Key>'
+                    '<UploadId>{}</UploadId><IsTruncated>false</IsTruncated>{}</ListPartsResult>'.format(
+                        escape(bucket), escape(key), upload_id, listed)).encode()
+            if method == 'DELETE' and upload_id:
+                self.uploads.pop(upload_id, None)
+                return 204, {}, b''
+            if method == 'DELETE':
+                self.objects.pop((bucket, key), None)
+                return 204, {}, b''
+            if method in ('GET', 'HEAD') and (bucket, key) in self.objects:
+                return 200, {'Content-Type': 'binary/octet-stream'}, self.objects[(bucket, key)]
+        return self._xml(404, 'Error', Code='NoSuchKey', Message='The specified key does not exist.')
+
+    @staticmethod
+    def _dechunk(body):
+        """Strips the aws-chunked framing (size;chunk-signature=...\\r\\ndata\\r\\n ... trailers) from body."""
+        content = b''
+        while body:
+            header, _, body = body.partition(b'\r\n')
+            size = int(header.split(b';')[0], 16)
+            if size == 0:
+                break
+            content, body = content + body[:size], body[size + 2:]
+        return content
+
+
+class MockPortal(_Server):
+    """Serves a small in memory portal, see the module docstring.  items is {uuid: item} with the
+    items stored as their frame=object view.  Starts a MockS3 for the uploads unless one is given."""
+    BUCKET = 'mock-files'
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0, s3=None):
+        super(MockPortal, self).__init__(host, port)
+        self.latency = latency
+        self.s3 = s3 or MockS3(host)
+        self.s3.on_upload = self._file_uploaded
+        self.items = {}
+        self._index = {}
+        self._lock = threading.RLock()
+        self._accessions = 0
+        self._upload_keys = {}
+        self.award = self.add('Award', {'name': 'mock-award', 'title': 'Mock award'})
+        self.lab = self.add('Lab', {'name': 'mock-lab', 'title': 'Mock lab', 'awards': [self.award['@id']]})
+        self.user = self.add('User', {'email': 'submitter@example.com', 'first_name': 'Mock',
+                                      'last_name': 'Submitter', 'submits_for': [self.lab['@id']]})
+        self.add('FileFormat', {'file_format': 'fastq', 'standard_file_extension': 'fastq.gz',
+                                'valid_item_types': ['FileFastq']})
+
+    def start(self):
+        if self.s3.httpd is None:
+            self.s3.start()
+        return super(MockPortal, self).start()
+
+    def stop(self):
+        super(MockPortal, self).stop()
+        self.s3.stop()
+
+    def key(self):
+        return {'key': 'mockkey', 'secret': 'mocksecret', 'server': self.url}
+
+    def write_keyfile(self, path, keyname='default'):
+        with open(str(path), 'w') as keyfile:
+            json.dump({keyname: self.key()}, keyfile)
+        return path
+
+    # item store
+
+    def add(self, item_type, properties, item_uuid=None):
+        """Stores a new item of item_type and returns it."""
+        with self._lock:
+            item = dict(properties)
+            item['uuid'] = item_uuid or properties.get('uuid') or str(uuid_lib.uuid4())
+            ident = item['uuid']
+            if item_type in ACCESSION_PREFIXES:
+                self._accessions += 1
+                item['accession'] = '4DN{}{:07d}'.format(ACCESSION_PREFIXES[item_type], self._accessions)
+                ident = item['accession']
+            elif item_type in NAME_KEYS:
+                ident = item[NAME_KEYS[item_type]]
+            item['@id'] = '/{}/{}/'.format(COLLECTIONS[item_type], ident)
+            item['@type'] = item_types(item_type)
+            item.setdefault('status', 'uploading' if 'File' in item['@type'] else 'in review by lab')
+            item['date_created'] = datetime.datetime.utcnow().isoformat() + '+00:00'
+            self.items[item['uuid']] = item
+            self._index_item(item)
+            return item
+
+    def _index_item(self, item):
+        md5_key = 'md5:' + item['md5sum'] if item.get('md5sum') else None
+        for ident in [item['uuid'], item['@id'], item.get('accession'), md5_key] + item.get('aliases', []):
+            if ident:
+                self._index[ident] = item['uuid']
+        name_key = NAME_KEYS.get(item['@type'][0])
+        if name_key:
+            self._index[item[name_key]] = item['uuid']
+
+    def find(self, ident):
+        """The item ident (uuid, accession, alias, @id or /Type/ident) refers to, or None."""
+        ident = unquote(ident)
+        if ident in self._index:
+            return self.items[self._index[ident]]
+        parts = [p for p in ident.split('/') if p]
+        if not parts:
+            return None
+        if len(parts) == 2 and parts[0] not in COLLECTIONS and parts[0] not in COLLECTIONS.values():
+            # an alias with a slash in it
+            ident = '/'.join(parts)
+        else:
+            ident = parts[-1]
+        uuid = self._index.get(ident)
+        return self.items[uuid] if uuid else None
+
+    def embedded(self, item):
+        """The default (embedded) view of item - its links are expanded to the linked items."""
+        item = copy.deepcopy(item)
+        for field in ('awards', 'submits_for'):
+            if field in item:
+                item[field] = [copy.deepcopy(self.find(link)) for link in item[field]]
+        for field in ('lab', 'award', 'file_format'):
+            if item.get(field) and self.find(item[field]):
+                linked = self.find(item[field])
+                item[field] = {'@id': linked['@id'], 'uuid': linked['uuid'], 'display_title': linked['@id']}
+        return item
+
+    # request handling
+
+    def handle(self, method, path, headers, body):
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urlsplit(path)
+        query = parse_qs(parts.query, keep_blank_values=True)
+        path = '/' + '/'.join(p for p in parts.path.split('/') if p)
+        try:
+            data = json.loads(body) if body else {}
+            with self._lock:
+                self.requests['search' if path == '/search' else method] += 1
+                status, result = self.route(method, path, query, data)
+        except PortalError as e:
+            status, result = e.code, e.body
+        return status, {'Content-Type': 'application/json'}, json.dumps(result).encode()
+
+    def route(self, method, path, query, data):
+        check_only = query.get('check_only', [''])[0].lower() == 'true'
+        if method == 'GET':
+            if path == '/me':
+                return 200, self.embedded(self.user)
+            if path == '/profiles':
+                return 200, PROFILES
+            if path.startswith('/profiles/'):
+                name = path.split('/')[-1].replace('.json', '')
+                if name not in PROFILES:
+                    raise not_found(path)
+                return 200, PROFILES[name]
+            if path == '/search':
+                return self.search(query)
+            if path.endswith('/upload'):
+                item = self._file(path[:-len('/upload')])
+                return 200, {'@graph': [{'extra_files_creds': [
+                    {'file_format': ef.get('file_format'), 'filename': ef.get('filename'),
+                     'upload_credentials': self.upload_credentials(item, ef)}
+                    for ef in item.get('extra_files', [])]}]}
+            item = self.find(path)
+            if item is None:
+                raise not_found(path)
+            if query.get('frame', [''])[0] == 'object':
+                return 200, copy.deepcopy(item)
+            return 200, self.embedded(item)
+        if method == 'POST' and path.endswith('/upload'):
+            item = self._file(path[:-len('/upload')])
+            return 200, {'status': 'success', '@graph': [{'upload_credentials': self.upload_credentials(item)}]}
+        if method == 'POST':
+            item_type = path.strip('/')
+            item_type = {c: t for t, c in COLLECTIONS.items()}.get(item_type, item_type)
+            if item_type not in PROFILES:
+                raise not_found(path)
+            return self.post(item_type, data, check_only)
+        if method == 'PATCH':
+            item = self.find(path)
+            if item is None:
+                raise not_found(path)
+            delete = [f for f in query.get('delete_fields', [''])[0].split(',') if f]
+            return self.patch(item, data, delete, check_only)
+        raise PortalError(405, _error(405, 'Method Not Allowed', 'Method not allowed: ' + method))
+
+    def _file(self, ident):
+        item = self.find(ident)
+        if item is None or 'File' not in item['@type']:
+            raise not_found(ident)
+        return item
+
+    def search(self, query):
+        types = query.pop('type', ['Item'])
+        start = int(query.pop('from', ['0'])[0])
+        limit = query.pop('limit', ['all'])[0]
+        for param in ('frame', 'field', 'sort', 'datastore'):
+            query.pop(param, None)
+        results = []
+        for item in self.items.values():
+            if not any(t in item['@type'] for t in types):
+                continue
+            matched = True
+            for field, values in query.items():
+                value = item.get(field)
+                value = value if isinstance(value, list) else [value]
+                if not any(v in value for v in values):
+                    matched = False
+                    break
+            if matched:
+                results.append(copy.deepcopy(item))
+        results.sort(key=lambda i: i['date_created'], reverse=True)
+        total = len(results)
+        results = results[start:] if limit == 'all' else results[start:start + int(limit)]
+        if not results:
+            return 404, {'@graph': [], 'total': total, 'notification': 'No results found'}
+        return 200, {'@graph': results, 'total': total, 'notification': 'Success'}
+
+    def validate(self, item_type, item, check_required=True):
+        """Checks item against the item_type profile and returns it with its links replaced
+        by the @id of the items they point to."""
+        profile = PROFILES[item_type]
+        errors = []
+        item = dict(item)
+        for name, value in item.items():
+            prop = profile['properties'].get(name)
+            if prop is None or prop.get('calculatedProperty'):
+                errors.append((name, 'Additional properties are not allowed'))
+                continue
+            item[name] = self._resolve(name, prop, value, errors)
+            if prop.get('enum') and value not in prop['enum']:
+                errors.append((name, "'{}' is not one of {}".format(value, prop['enum'])))
+        if check_required:
+            for name in profile.get('required', []):
+                if name not in item:
+                    errors.append((name, "'{}' is a required property".format(name)))
+        if errors:
+            raise validation_failure(errors)
+        # like the portal, the md5 sum of a file is a unique key along with the aliases
+        keys = item.get('aliases', []) + (['md5:' + item['md5sum']] if item.get('md5sum') else [])
+        for alias in keys:
+            if alias in self._index and self._index[alias] != item.get('uuid'):
+                raise conflict('alias', alias)
+        return item
+
+    def _resolve(self, name, prop, value, errors):
+        if prop.get('linkTo'):
+            linked = self.find(value)
+            if linked is None:
+                errors.append((name, 'Unable to resolve link: {}'.format(value)))
+                return value
+            return linked['@id']
+        if prop.get('type') == 'array' and isinstance(value, list):
+            return [self._resolve(name, prop['items'], v, errors) for v in value]
+        if prop.get('type') == 'object' and isinstance(value, dict) and 'properties' in prop:
+            return {k: (self._resolve(k, prop['properties'][k], v, errors) if k in prop['properties'] else v)
+                    for k, v in value.items()}
+        return value
+
+    def _success(self, item):
+        return 200, {'status': 'success', '@type': ['result'], '@graph': [item]}
+
+    def post(self, item_type, data, check_only=False):
+        if data.get('uuid') and data['uuid'] in self.items:
+            raise conflict('uuid', data['uuid'])
+        valid = self.validate(item_type, data)
+        if check_only:
+            return self._success({})
+        item = copy.deepcopy(self.add(item_type, self._store_attachment(valid)))
+        if 'File' in item['@type']:
+            item['upload_credentials'] = self.upload_credentials(item)
+        return 201, {'status': 'success', '@type': ['result'], '@graph': [item]}
+
+    def patch(self, item, data, delete_fields=(), check_only=False):
+        item_type = item['@type'][0]
+        data = dict(data, uuid=item['uuid'])
+        valid = self.validate(item_type, data, check_required=False)
+        if check_only:
+            return self._success({})
+        for field in delete_fields:
+            item.pop(field, None)
+        item.update(self._store_attachment(valid))
+        if 'filename' in data and 'File' in item['@type']:
+            item['status'] = 'uploading'
+        self._index_item(item)
+        return self._success(copy.deepcopy(item))
+
+    def _store_attachment(self, item):
+        """Attachments are posted as data urls, stored as the content they decode to."""
+        attachment = item.get('attachment')
+        if isinstance(attachment, dict) and str(attachment.get('href', '')).startswith('data:'):
+            content = base64.b64decode(attachment['href'].split(',', 1)[1])
+            item = dict(item, attachment={'download': attachment.get('download'), 'type': attachment.get('type'),
+                                          'md5sum': hashlib.md5(content).hexdigest(), 'size': len(content),
+                                          'href': '@@download/attachment/' + str(attachment.get('download'))})
+        return item
+
+    def upload_credentials(self, item, extra_file=None):
+        filename = (extra_file or item).get('filename') or ''
+        key = '{}/{}{}'.format(item['uuid'], item.get('accession', item['uuid']),
+                               filename[filename.find('.'):] if '.' in filename else '')
+        self._upload_keys.setdefault(item['uuid'], key)
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=12)
+        return {'AccessKeyId': 'mock-access-key', 'SecretAccessKey': 'mock-secret-key',
+                'SessionToken': 'mock-session-token', 'Expiration': expires.strftime('%Y-%m-%d %H:%M:%S%z'),
+                'key': key, 'upload_url': 's3://{}/{}'.format(self.BUCKET, key)}
+
+    def _file_uploaded(self, bucket, key):
+        # like the portal, a file is marked as uploaded once its content is in the bucket
+        with self._lock:
+            item = self.items.get(key.split('/')[0])
+            if item is not None and self._upload_keys.get(item['uuid']) == key:
+                item['status'] = 'uploaded'
+
+    def uploaded(self, item):
+        """The content uploaded to S3 for the file item (or its uuid), or None."""
+        item = self.find(item) if isinstance(item, str) else item
+        return self.s3.objects.get((self.BUCKET, self._upload_keys.get(item['uuid'])))
+
+
+def main():  # pragma: no cover
+    parser = argparse.ArgumentParser(description="Serves a local stand-in for the 4DN portal and S3")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to each portal request")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--s3-port', type=int, default=8001)
+    parser.add_argument('--keyfile', default='mock_keypairs.json', help="Where to write the keypairs file")
+    args = parser.parse_args()
+    portal = MockPortal(args.latency, port=args.port, s3=MockS3(port=args.s3_port))
+    with portal:
+        portal.write_keyfile(args.keyfile)
+        print("portal at {} (key 'default' in {}), S3 at {}".format(portal.url, args.keyfile, portal.s3.url))
+        print("eg. import_data workbook.xlsx --keyfile {} --s3-endpoint-url {}".format(args.keyfile, portal.s3.url))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""Benchmarks of workbook parsing and submission throughput, run with pytest-benchmark:
+
+    py.test tests/test_benchmarks.py -m benchmark --benchmark-only --benchmark-autosave
+    py.test tests/test_benchmarks.py -m benchmark --benchmark-only --benchmark-compare --benchmark-compare-fail=mean:20%
+
+The size of the synthetic workbook and the latency of the mock portal can be changed with the
+SUBMIT4DN_BENCH_SHEETS, _ROWS, _COLUMNS and _LATENCY environment variables.
+"""
+import os
+from collections import OrderedDict
+import openpyxl
+import pytest
+import wranglertools.get_field_info as gfi
+import wranglertools.import_data as imp
+from tests.mock_portal import MockPortal
+
+pytest.importorskip('pytest_benchmark')
+pytestmark = pytest.mark.benchmark
+
+SHEETS = int(os.environ.get('SUBMIT4DN_BENCH_SHEETS', 3))
+ROWS = int(os.environ.get('SUBMIT4DN_BENCH_ROWS', 200))
+COLUMNS = int(os.environ.get('SUBMIT4DN_BENCH_COLUMNS', 20))
+LATENCY = float(os.environ.get('SUBMIT4DN_BENCH_LATENCY', 0.0))
+ROUNDS = 3
+# types of the synthetic columns after aliases and description, in turn
+COLUMN_TYPES = ['string', 'integer', 'number', 'array of strings', 'Item:Vendor', 'boolean']
+VENDORS = 10
+
+
+def synthetic_fields(columns):
+    fields = [gfi.FieldInfo('aliases', 'array of strings', 1, 'Lab specific identifiers'),
+              gfi.FieldInfo('*description', 'string', 2, 'A plain text description')]
+    for i in range(columns - len(fields)):
+        fields.append(gfi.FieldInfo('field_{:03d}'.format(i), COLUMN_TYPES[i % len(COLUMN_TYPES)], i + 3))
+    return fields
+
+
+def synthetic_value(ftype, sheet, row, col):
+    if ftype == 'integer':
+        return row * col
+    if ftype == 'number':
+        return row / (col + 1)
+    if ftype == 'array of strings':
+        return 'a{0}, b{0}, c{0}'.format(row)
+    if ftype == 'boolean':
+        return ['TRUE', 'FALSE'][row % 2]
+    if ftype.startswith('Item:'):
+        return 'bench:vendor-{}'.format(row % VENDORS)
+    return 'value {} of {} row {}'.format(col, sheet, row)
+
+
+def fill_sheet(ws, rows):
+    """Appends rows (dictionaries of field name -> value) below the header rows of a create_excel sheet."""
+    fields = [str(cell.value).lstrip('*') for cell in ws[1]][1:]
+    for row in rows:
+        ws.append([None] + [row.get(field) for field in fields])
+
+
+def make_workbook(path, sheets=SHEETS, rows=ROWS, columns=COLUMNS):
+    """Writes a workbook of sheets x rows x columns in the get_field_info.create_excel layout.
+    Besides the sheets named after the first item types there is a Vendor sheet with the items
+    the Item:Vendor columns link to.
+    """
+    names = [name for name in gfi.sheet_order if name != 'Vendor'][:sheets]
+    all_fields = {name: synthetic_fields(columns) for name in names}
+    all_fields['Vendor'] = synthetic_fields(2)
+    gfi.create_excel(all_fields, path)
+    wb = openpyxl.load_workbook(path)
+    fill_sheet(wb['Vendor'], [{'aliases': 'bench:vendor-{}'.format(i), 'description': 'vendor'}
+                              for i in range(VENDORS)])
+    for name in names:
+        fill_sheet(wb[name], [
+            dict({'aliases': 'bench:{}-{}'.format(name.lower(), row)},
+                 **{f.name.lstrip('*'): synthetic_value(f.ftype, name, row, col)
+                    for col, f in enumerate(all_fields[name][1:])})
+            for row in range(rows)])
+    wb.save(path)
+    return names
+
+
+def make_fastq_workbook(path, rows=ROWS):
+    """A FileFastq sheet of rows paired end files, each odd row paired with the one before."""
+    fields = [gfi.FieldInfo('aliases', 'array of strings', 1), gfi.FieldInfo('*file_format', 'Item:FileFormat', 2),
+              gfi.FieldInfo('paired_end', 'string', 3), gfi.FieldInfo('filename', 'string', 4),
+              gfi.FieldInfo('related_files.relationship_type', 'array of embedded objects, string', 5),
+              gfi.FieldInfo('related_files.file', 'array of embedded objects, Item:File', 6)]
+    gfi.create_excel({'FileFastq': fields}, path)
+    wb = openpyxl.load_workbook(path)
+    rows = [{'aliases': 'bench:fq-{}'.format(row), 'file_format': 'fastq', 'paired_end': str(row % 2 + 1),
+             'filename': 'reads_{}_R{}.fastq.gz'.format(row // 2, row % 2 + 1)} for row in range(rows)]
+    for pair, row in enumerate(rows[1::2]):
+        row.update({'related_files.relationship_type': 'paired with', 'related_files.file': rows[2 * pair]['aliases']})
+    fill_sheet(wb['FileFastq'], rows)
+    wb.save(path)
+
+
+def sheet_rows(workbook, sheet):
+    """(fields2types, the rows as the ordered dictionaries submit_row starts from)."""
+    rows = imp.reader(workbook, sheetname=sheet)
+    keys, types = next(rows)[1:], next(rows)[1:]
+    return dict(zip(keys, types)), [OrderedDict(zip(keys, imp.clean_row_values(values[1:])))
+                                    for values in rows if not values[0].startswith('#')]
+
+
+def rows_per_sec(benchmark, rows):
+    benchmark.extra_info['rows'] = rows
+    # there are no stats when benchmarking is disabled and the test just runs once
+    if benchmark.stats:
+        benchmark.extra_info['rows_per_sec'] = rows / benchmark.stats.stats.mean
+
+
+@pytest.fixture(scope='module')
+def synthetic_workbook(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('bench') / 'synthetic.xlsx')
+    names = make_workbook(path)
+    book, _ = imp.digest_xlsx(path)
+    return path, book, names
+
+
+@pytest.fixture(scope='module')
+def bench_portal(tmp_path_factory):
+    """A mock portal with a workbook of ROWS vendors and a pooled connection to it."""
+    with MockPortal(latency=LATENCY) as portal:
+        connection = gfi.FDN_Connection(gfi.FDN_Key({'default': portal.key()}, 'default'), pool_size=8)
+        connection.link_cache = imp.LinkCache()
+        path = str(tmp_path_factory.mktemp('bench') / 'vendors.xlsx')
+        gfi.create_excel(gfi.get_uploadable_fields(connection, ['Vendor']), path)
+        wb = openpyxl.load_workbook(path)
+        fill_sheet(wb['Vendor'], [{'aliases': 'bench:vendor-{}'.format(row), 'title': 'Vendor {}'.format(row),
+                                   'description': 'A synthetic vendor', 'url': 'https://example.com/{}'.format(row)}
+                                  for row in range(ROWS)])
+        wb.save(path)
+        book, sheets = imp.digest_xlsx(path)
+        workbook = imp.WorkbookIndex(book, sheets)
+        yield portal, connection, workbook, imp.get_all_aliases(workbook, sheets)
+        connection.session.uninstall()
+
+
+def submit_vendors(connection, workbook, aliases, update=False, patchall=False, workers=8):
+    imp.workbook_reader(workbook, 'Vendor', update, connection, patchall, aliases, {}, {}, {}, False, [],
+                        workers=workers, dryrun_workers=workers)
+
+
+def test_bench_digest_xlsx(benchmark, synthetic_workbook):
+    path, _, names = synthetic_workbook
+    book, sheets = benchmark.pedantic(imp.digest_xlsx, args=(path,), rounds=ROUNDS)
+    assert set(sheets) == set(names + ['Vendor'])
+    rows_per_sec(benchmark, SHEETS * ROWS)
+
+
+def test_bench_reader(benchmark, synthetic_workbook):
+    # row_generator and cell_value over every cell of the synthetic sheets
+    _, book, names = synthetic_workbook
+
+    def read_all():
+        return sum(1 for name in names for _ in imp.reader(book, sheetname=name))
+
+    assert benchmark.pedantic(read_all, rounds=ROUNDS) == SHEETS * (ROWS + 4)
+    rows_per_sec(benchmark, SHEETS * ROWS)
+
+
+def test_bench_workbook_index(benchmark, synthetic_workbook):
+    _, book, names = synthetic_workbook
+    index = benchmark.pedantic(imp.WorkbookIndex, args=(book, names), rounds=ROUNDS)
+    assert len(imp.get_all_aliases(index, names)) == SHEETS * ROWS
+    rows_per_sec(benchmark, SHEETS * ROWS)
+
+
+def test_bench_build_patch_json(benchmark, synthetic_workbook):
+    _, book, names = synthetic_workbook
+    fields2types, rows = sheet_rows(book, names[0])
+    patches = benchmark.pedantic(lambda: [imp.build_patch_json(row, fields2types) for row in rows], rounds=ROUNDS)
+    assert len(patches) == ROWS
+    assert patches[1]['aliases'] == ['bench:{}-1'.format(names[0].lower())]
+    rows_per_sec(benchmark, ROWS)
+
+
+def test_bench_pre_validate_json(benchmark, synthetic_workbook, connection_mock):
+    _, book, names = synthetic_workbook
+    aliases = imp.get_all_aliases(book, names + ['Vendor'])
+    fields2types, rows = sheet_rows(book, names[0])
+    reports = benchmark.pedantic(
+        lambda: [imp.pre_validate_json(row, fields2types, aliases, connection_mock) for row in rows], rounds=ROUNDS)
+    assert not any(reports)
+    rows_per_sec(benchmark, ROWS)
+
+
+def test_bench_check_file_pairing(benchmark, tmp_path):
+    path = str(tmp_path / 'fastq.xlsx')
+    make_fastq_workbook(path)
+    book, _ = imp.digest_xlsx(path)
+    errors = benchmark.pedantic(lambda: imp.check_file_pairing(imp.reader(book, sheetname='FileFastq')),
+                                rounds=ROUNDS)
+    assert not errors
+    rows_per_sec(benchmark, ROWS)
+
+
+def test_bench_workbook_reader_dryrun(benchmark, bench_portal):
+    portal, connection, workbook, aliases = bench_portal
+    benchmark.pedantic(submit_vendors, args=(connection, workbook, aliases), rounds=ROUNDS)
+    assert not portal.find('bench:vendor-0')
+    rows_per_sec(benchmark, ROWS)
+
+
+def test_bench_workbook_reader_patch(benchmark, bench_portal):
+    portal, connection, workbook, aliases = bench_portal
+    if not portal.find('bench:vendor-0'):
+        submit_vendors(connection, workbook, aliases, update=True)
+    benchmark.pedantic(submit_vendors, args=(connection, workbook, aliases, False, True), rounds=ROUNDS)
+    assert portal.find('bench:vendor-{}'.format(ROWS - 1))['title'] == 'Vendor {}'.format(ROWS - 1)
+    rows_per_sec(benchmark, ROWS)
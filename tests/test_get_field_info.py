@@ -4,6 +4,9 @@ from operator import itemgetter
 import openpyxl
 from pathlib import Path
 import os
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 # test data is in conftest.py
 
@@ -76,6 +79,86 @@ def test_connection_success(mocker, mkey, returned_user_me_submit_for_one_lab,
     assert connection.award == awd2chk
 
 
+def test_connection_with_portal_session(mocker, mkey, returned_user_me_submit_for_one_lab,
+                                        returned_lab_w_one_award):
+    mocker.patch('dcicutils.ff_utils.get_metadata', side_effect=[
+        returned_user_me_submit_for_one_lab.json(), returned_lab_w_one_award.json()
+    ])
+    original_get = gfi.ff_utils.REQUESTS_VERBS['GET']
+    connection = gfi.FDN_Connection(mkey, pool_size=4)
+    try:
+        assert gfi.ff_utils.REQUESTS_VERBS['GET'] == connection.session.session.get
+        assert gfi.ff_utils.REQUESTS_VERBS['PATCH'] == connection.session.session.patch
+        adapter = connection.session.session.get_adapter('https://data.4dnucleome.org')
+        assert adapter._pool_maxsize == 4
+        assert adapter.max_retries.connect == adapter.max_retries.read == 3
+        assert not adapter.max_retries.status_forcelist
+        assert 'POST' not in adapter.max_retries.allowed_methods
+    finally:
+        connection.session.close()
+    assert gfi.ff_utils.REQUESTS_VERBS['GET'] is original_get
+
+
+def test_portal_session_leaves_error_statuses_to_ff_utils():
+    # a busy server gets one request per try of ff_utils, not another round of retries for each
+    requests_seen = []
+
+    class Busy(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Busy)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = gfi.PortalSession(pool_size=1)
+    try:
+        response = session.session.get('http://127.0.0.1:{}/me'.format(server.server_port))
+        assert response.status_code == 503
+        assert requests_seen == ['/me']
+    finally:
+        session.close()
+        server.shutdown()
+
+
+def test_portal_session_routes_ff_utils_requests(mocker):
+    session = gfi.PortalSession(pool_size=2)
+    send = mocker.patch.object(session.session, 'request', return_value=MockedSchemaResponse({'a': 1}))
+    session.install()
+    try:
+        gfi.ff_utils.authorized_request('https://data.4dnucleome.org/me', auth=('id', 'secret'))
+    finally:
+        session.uninstall()
+    assert send.call_args[0][:2] == ('GET', 'https://data.4dnucleome.org/me')
+
+
+def test_request_hooks_removed_in_any_order(mocker):
+    calls = []
+    mocker.patch.dict(gfi.ff_utils.REQUESTS_VERBS, {'GET': lambda url, **kw: calls.append(('sent', url))})
+    hooks = gfi.RequestHooks()
+
+    def hook(name):
+        def wrap(verb, request_fxn):
+            return lambda url, **kw: calls.append((name, url)) or request_fxn(url, **kw)
+        return wrap
+    hooks.install('timing', hook('timing'))
+    hooks.install('session', lambda verb, request_fxn: lambda url, **kw: calls.append(('session', url)), inner=True)
+    gfi.ff_utils.REQUESTS_VERBS['GET']('/me')
+    assert calls == [('timing', '/me'), ('session', '/me')]
+    # taking the first one off leaves the other in place
+    hooks.uninstall('timing')
+    del calls[:]
+    gfi.ff_utils.REQUESTS_VERBS['GET']('/me')
+    assert calls == [('session', '/me')]
+    hooks.uninstall('session')
+    del calls[:]
+    gfi.ff_utils.REQUESTS_VERBS['GET']('/me')
+    assert calls == [('sent', '/me')]
+
+
 def test_connection_prompt_for_lab_award_no_prompt_for_one_each(
         mocker, mkey, returned_user_me_submit_for_one_lab,
         returned_lab_w_one_award):
@@ -344,6 +427,96 @@ def test_get_uploadable_fields_mock(connection_mock, mocker, returned_vendor_sch
         assert field.enum is not None
 
 
+class MockedSchemaResponse(object):
+    def __init__(self, json, status=200, headers=None):
+        self._json = json
+        self.status_code = status
+        self.headers = headers or {}
+
+    def json(self):
+        return self._json
+
+
+def test_schema_cache_stores_and_reuses_response(connection_mock, mocker, tmp_path, returned_vendor_schema):
+    cache = gfi.SchemaCache(connection_mock.key['server'], cache_dir=tmp_path)
+    connection_mock.schema_cache = cache
+    req = mocker.patch('dcicutils.ff_utils.authorized_request', return_value=MockedSchemaResponse(
+        returned_vendor_schema.json(), headers={'ETag': '"v1"'}))
+    first = gfi.get_schema_metadata(connection_mock, '/profiles/Vendor.json', add_on='frame=object')
+    second = gfi.get_schema_metadata(connection_mock, '/profiles/Vendor.json', add_on='frame=object')
+    assert first == second == returned_vendor_schema.json()
+    assert req.call_count == 1
+    assert req.call_args[0][0] == 'https://data.4dnucleome.org/profiles/Vendor.json?frame=object'
+    assert (tmp_path / 'data.4dnucleome.org').is_dir()
+
+
+def test_schema_cache_revalidates_with_etag(connection_mock, mocker, tmp_path, returned_vendor_schema):
+    connection_mock.schema_cache = gfi.SchemaCache(connection_mock.key['server'], cache_dir=tmp_path, ttl=0)
+    req = mocker.patch('dcicutils.ff_utils.authorized_request', side_effect=[
+        MockedSchemaResponse(returned_vendor_schema.json(), headers={'ETag': '"v1"'}),
+        MockedSchemaResponse(None, status=304)])
+    gfi.get_schema_metadata(connection_mock, '/profiles/Vendor.json')
+    resp = gfi.get_schema_metadata(connection_mock, '/profiles/Vendor.json')
+    assert resp == returned_vendor_schema.json()
+    assert req.call_args[1]['headers']['If-None-Match'] == '"v1"'
+
+
+def test_schema_cache_offline_and_unreachable(connection_mock, mocker, tmp_path, returned_vendor_schema, capsys):
+    server = connection_mock.key['server']
+    responses = [MockedSchemaResponse(returned_vendor_schema.json())]
+
+    def get(url, **kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    mocker.patch.dict('dcicutils.ff_utils.REQUESTS_VERBS', {'GET': get})
+    mocker.patch('dcicutils.ff_utils.time.sleep')
+    connection_mock.schema_cache = gfi.SchemaCache(server, cache_dir=tmp_path)
+    gfi.get_schema_metadata(connection_mock, '/profiles/Vendor.json')
+    # an unreachable server falls back to the cached copy whatever its age
+    responses[:] = [requests.exceptions.ReadTimeout('Read timed out')] * 5
+    connection_mock.schema_cache = gfi.SchemaCache(server, cache_dir=tmp_path, ttl=0)
+    assert gfi.get_schema_metadata(connection_mock, '/profiles/Vendor.json') == returned_vendor_schema.json()
+    assert 'using cached /profiles/Vendor.json' in capsys.readouterr()[0]
+    assert not responses
+    # but an error response, e.g. for an expired key, is not hidden by the cached copy - even after
+    # a first attempt that could not connect
+    responses[:] = [requests.exceptions.ConnectionError('refused'),
+                    MockedSchemaResponse({'status': 'error', 'code': 401}, status=401)]
+    with pytest.raises(Exception) as excinfo:
+        gfi.get_schema_metadata(connection_mock, '/profiles/Vendor.json')
+    assert '401' in str(excinfo.value)
+    assert not gfi.request_hooks._hooks
+    # offline never asks the server
+    connection_mock.schema_cache = gfi.SchemaCache(server, cache_dir=tmp_path, ttl=0, offline=True)
+    assert gfi.get_schema_metadata(connection_mock, '/profiles/Vendor.json') == returned_vendor_schema.json()
+
+
+def test_schema_cache_per_key(connection_mock, mocker, tmp_path):
+    args = mocker.Mock(no_schema_cache=False, schema_cache_ttl=3600, offline_schemas=False)
+    mocker.patch('pathlib.Path.home', return_value=tmp_path)
+    gfi.set_schema_cache(connection_mock, args)
+    assert connection_mock.schema_cache.directory == tmp_path / '.cache' / 'submit4dn' / 'data.4dnucleome.org' / 'testkey'
+    # the search results of one key are not those of another
+    search = mocker.patch('dcicutils.ff_utils.search_metadata', return_value=[{'file_format': 'fastq'}])
+    query = '/search/?type=FileFormat&field=file_format&valid_item_types=FileFastq'
+    gfi.search_schema_metadata(connection_mock, query)
+    connection_mock.key['key'] = 'otherkey'
+    gfi.set_schema_cache(connection_mock, args)
+    gfi.search_schema_metadata(connection_mock, query)
+    assert search.call_count == 2
+
+
+def test_schema_cache_search(connection_mock, mocker, tmp_path):
+    connection_mock.schema_cache = gfi.SchemaCache(connection_mock.key['server'], cache_dir=tmp_path)
+    search = mocker.patch('dcicutils.ff_utils.search_metadata', return_value=[{'file_format': 'fastq'}])
+    query = '/search/?type=FileFormat&field=file_format&valid_item_types=FileFastq'
+    assert gfi.search_schema_metadata(connection_mock, query) == [{'file_format': 'fastq'}]
+    assert gfi.search_schema_metadata(connection_mock, query) == [{'file_format': 'fastq'}]
+    assert search.call_count == 1
+
+
 def xls_to_list(xls_file, sheet):
     """To compare xls files to reference ones, return a sorted list of content."""
     wb = openpyxl.load_workbook(xls_file)
@@ -2,6 +2,15 @@ from dcicutils.misc_utils import get_error_message
 import wranglertools.import_data as imp
 import pytest
 import pathlib as pp
+import hashlib
+import datetime
+import json
+import time
+import threading
+import contextlib
+import io
+import openpyxl
+from urllib.parse import unquote
 # test data is in conftest.py
 
 
@@ -42,6 +51,160 @@ def test_md5():
     assert md5_keypairs == "19d43267b642fe1868e3c136a2ee06f2"
 
 
+def test_checksum_store(tmp_path):
+    to_hash = tmp_path / 'afile.txt'
+    to_hash.write_text('some content')
+    store = imp.ChecksumStore(tmp_path / 'cache' / 'checksums.sqlite')
+    store.put(imp.ChecksumStore.file_key(to_hash), 'mymd5')
+    assert imp.ChecksumStore(store.path).get(imp.ChecksumStore.file_key(str(to_hash))) == 'mymd5'
+    to_hash.write_text('some other content')
+    assert store.get(imp.ChecksumStore.file_key(to_hash)) is None
+
+
+def test_checksums_prefetch(tmp_path, mocker):
+    to_hash = tmp_path / 'afile.txt'
+    to_hash.write_text('some content')
+    expected = imp.md5(str(to_hash))
+    checksums = imp.Checksums(imp.ChecksumStore(tmp_path / 'checksums.sqlite'), workers=1)
+    checksums.prefetch([str(to_hash), str(to_hash)])
+    assert len(checksums._pending) == 1
+    assert checksums.md5(str(to_hash)) == expected
+    checksums.close()
+    # known sums are not calculated again
+    mocker.patch('wranglertools.import_data.md5', side_effect=AssertionError)
+    assert checksums.cached(str(to_hash)) == expected
+    assert checksums.md5(str(to_hash)) == expected
+    checksums.prefetch([str(to_hash)])
+    assert not checksums._pending
+
+
+def test_file_paths_to_hash():
+    keys = ['aliases', 'filename', 'extra_files.filename-1']
+    rows = [(3, ['a:1', './tests/data_files/example.fastq.gz', './tests/data_files/keypairs.json']),
+            (4, ['a:2', 'ftp://some.server/afile.fastq.gz', '']),
+            (5, ['a:3', './tests/data_files/missing.fastq.gz'])]
+    assert imp.file_paths_to_hash(rows, keys) == ['./tests/data_files/example.fastq.gz',
+                                                  './tests/data_files/keypairs.json']
+    assert imp.file_paths_to_hash(rows, keys, extra_files_only=True) == ['./tests/data_files/keypairs.json']
+
+
+def test_remote_paths_to_fetch():
+    book = openpyxl.Workbook()
+    book.active.title = 'Document'
+    for row in [['#Field Name:', 'aliases', 'attachment'], ['#Field Type:', 'string', 'object'],
+                [None, 'a:doc1', 'https://example.com/protocol.pdf'], [None, 'a:doc2', './tests/data_files/test.pdf'],
+                ['#', 'a:doc3', 'ftp://example.com/skipped.pdf'], [None, 'a:doc4', 'https://example.com/protocol.pdf']]:
+        book['Document'].append(row)
+    fastq = book.create_sheet('FileFastq')
+    for row in [['#Field Name:', 'aliases', 'filename', 'md5sum'], ['#Field Type:', 'string', 'string', 'string'],
+                [None, 'a:fq1', 'ftp://example.com/r1.fastq.gz', 'abc'], [None, 'a:fq2', 'ftp://example.com/r2.fastq.gz'],
+                [None, 'a:fq3', './tests/data_files/example.fastq.gz', 'abc']]:
+        fastq.append(row)
+    sheets = ['Document', 'FileFastq', 'Biosample']
+    assert imp.remote_paths_to_fetch(book, sheets, ['attachment']) == [
+        'https://example.com/protocol.pdf', 'ftp://example.com/r1.fastq.gz']
+    assert imp.remote_paths_to_fetch(book, sheets, ['attachment'], filenames=False) == [
+        'https://example.com/protocol.pdf']
+
+
+@pytest.mark.file_operation
+def test_downloads_prefetch(mocker, tmp_path):
+    def fake_download(url, path):
+        assert url.startswith('https://')
+        pp.Path(path).write_bytes(pp.Path('./tests/data_files/test.pdf').read_bytes())
+        return path
+    mocker.patch('wranglertools.import_data.download', side_effect=fake_download)
+    downloads = imp.Downloads(workers=2, directory=str(tmp_path))
+    mocker.patch('wranglertools.import_data.downloads', downloads)
+    downloads.prefetch(['https://example.com/protocol.pdf', 'https://example.com/other/test.pdf'])
+    attach = imp.attachment('https://example.com/protocol.pdf')
+    assert attach['download'] == 'protocol.pdf'
+    assert attach['href'].startswith('data:application/pdf;base64')
+    assert downloads.local('https://example.com/missing.pdf') is None
+    assert downloads.forget('https://example.com/other/test.pdf')
+    assert not downloads.forget('https://example.com/other/test.pdf')
+    downloads.close()
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.file_operation
+def test_downloads_prefetched_streamed_attachment(mocker, tmp_path, connection_mock):
+    def fake_download(url, path):
+        pp.Path(path).write_bytes(pp.Path('./tests/data_files/test.pdf').read_bytes())
+        return path
+    mocker.patch('wranglertools.import_data.download', side_effect=fake_download)
+    mocker.patch('wranglertools.import_data.STREAM_ATTACHMENT_SIZE', 0)
+    mocker.patch('wranglertools.import_data.get_existing', return_value={})
+    downloads = imp.Downloads(workers=1, directory=str(tmp_path), ahead=1)
+    mocker.patch('wranglertools.import_data.downloads', downloads)
+    urls = ['https://example.com/protocol.pdf', 'https://example.com/other.pdf']
+    downloads.prefetch(urls)
+    # a large attachment is read from the downloaded copy as the item is sent, and not kept by the cache
+    cache = imp.AttachmentCache()
+    attach = cache.get(urls[0])
+    assert attach['href'].source == urls[0]
+    assert pp.Path(attach['href'].path).is_file()
+    assert not cache._attachments
+    # the copy goes once its row is done, even if the row is not submitted, making room for the next one
+    imp.submit_row(5, ['a:doc', urls[0]], ['aliases', 'attachment'], {'aliases': 'array of strings',
+                   'attachment': 'attachment'}, 'Document', False, True, connection_mock, {}, {}, {}, True,
+                   ['attachment'])
+    assert not pp.Path(attach['href'].path).exists()
+    assert downloads.local(urls[1])
+    downloads.close()
+
+
+@pytest.mark.file_operation
+def test_downloads_prefetch_window(mocker, tmp_path):
+    started = []
+
+    def fake_download(url, path):
+        started.append(url)
+        pp.Path(path).write_bytes(b'x' * 100)
+        return path
+    mocker.patch('wranglertools.import_data.download', side_effect=fake_download)
+    downloads = imp.Downloads(workers=2, directory=str(tmp_path), ahead=2)
+    urls = ['ftp://example.com/r{}.fastq.gz'.format(i) for i in range(6)]
+    downloads.prefetch(urls)
+    assert downloads.local(urls[0]) and downloads.local(urls[1])
+    assert started == urls[:2]
+    # the next one is only started once a row is done with its file
+    assert downloads.forget(urls[0])
+    assert downloads.local(urls[2])
+    assert started == urls[:3]
+    # one asked for before its download started is left to the row
+    assert downloads.local(urls[4]) is None
+    assert downloads.forget(urls[1]) and downloads.forget(urls[2])
+    assert downloads.local(urls[3]) and downloads.local(urls[5])
+    assert started == urls[:4] + urls[5:]
+    downloads.close()
+    # and no more are started while the ones kept add up to max_bytes
+    downloads.configure(workers=1, directory=str(tmp_path), ahead=8, max_bytes=150)
+    del started[:]
+    downloads.prefetch(urls)
+    assert downloads.local(urls[1])
+    for _ in range(100):
+        if downloads.staged_bytes() == 200:
+            break
+        time.sleep(0.01)
+    assert downloads.staged_bytes() == 200
+    assert started == urls[:2]
+    downloads.close()
+    assert not list(tmp_path.iterdir())
+
+
+def test_download_streams_to_file(mocker, tmp_path):
+    response = mocker.Mock(status_code=200)
+    response.iter_content.return_value = iter([b'first ', b'second'])
+    get = mocker.patch('wranglertools.import_data.requests.get', return_value=response)
+    path = imp.download('https://example.com/notes.txt', str(tmp_path / 'notes.txt'))
+    assert pp.Path(path).read_bytes() == b'first second'
+    assert get.call_args[1]['stream'] is True
+    response.status_code = 404
+    with pytest.raises(imp.WebFetchException):
+        imp.download('https://example.com/missing.txt', str(tmp_path / 'missing.txt'))
+
+
 @pytest.mark.file_operation
 def test_attachment_image():
     attach = imp.attachment("./tests/data_files/test.jpg")
@@ -67,6 +230,24 @@ def test_attachment_expanduser_path():
     assert attach['href'].startswith('data:application/pdf;base64')
 
 
+@pytest.mark.file_operation
+def test_attachment_streamed_body(mocker):
+    mocker.patch('wranglertools.import_data.STREAM_ATTACHMENT_SIZE', 0)
+    attach = imp.attachment("./tests/data_files/test.pdf")
+    assert isinstance(attach['href'], imp.DataURL)
+    post_json = {'aliases': ['a:doc'], 'attachment': attach, 'description': 'a protocol'}
+    with open("./tests/data_files/test.pdf", 'rb') as f:
+        encoded = 'data:application/pdf;base64,' + imp.b64encode(f.read()).decode('ascii')
+    expected = json.dumps(dict(post_json, attachment=dict(attach, href=encoded))).encode('utf-8')
+    body = imp.StreamedBody(post_json)
+    assert len(body) == len(expected)
+    assert b''.join(iter(lambda: body.read(1000), b'')) == expected
+    # rewound to be sent again
+    body.seek(0)
+    assert body.read() == expected
+    assert imp.has_data_urls(post_json)
+
+
 @pytest.mark.file_operation
 def test_attachment_image_wrong_extension():
     with pytest.raises(ValueError) as excinfo:
@@ -233,6 +414,35 @@ def test_get_existing_uuid(connection_mock, mocker, returned_vendor_existing_ite
         assert response == returned_vendor_existing_item.json()
 
 
+def test_get_existing_from_existing_items(connection_mock, mocker, returned_vendor_existing_item):
+    post_jsons = {'aliases': ['sample_vendor:alias', 'sample_vendor:new_alias'], 'uuid': 'some_uuid'}
+    existing = returned_vendor_existing_item.json()
+    existing_items = {'sample_vendor:alias': existing, 'some_uuid': existing}
+    mock_get = mocker.patch('dcicutils.ff_utils.get_metadata', side_effect=Exception("Reason: {'code': 404}"))
+    response = imp.get_existing(post_jsons, connection_mock, existing_items)
+    assert response == existing
+    # only the alias the searches did not find is fetched
+    assert [c[0][0] for c in mock_get.call_args_list] == ['sample_vendor:new_alias']
+
+
+def test_get_existing_items_batches_searches(connection_mock, mocker):
+    found = {'uuid': 'e3a9b3ac-1ab4-4f9a-8fa8-6a2b1a1f6c50', 'accession': '4DNFIYI7YMVU',
+             '@id': '/files-fastq/4DNFIYI7YMVU/', 'aliases': ['lab:f1', 'lab:f1_alt']}
+    mock_search = mocker.patch('dcicutils.ff_utils.search_metadata', side_effect=[[], [found], []])
+    ids = ['lab:f1', 'lab:f2', 'lab:f3', '4DNFIYI7YMVU', '/labs/test-lab/']
+    existing_items = imp.get_existing_items(ids, connection_mock, chunk_size=2)
+    queries = [c[0][0] for c in mock_search.call_args_list]
+    assert queries == ['search/?type=Item&frame=object&accession=4DNFIYI7YMVU',
+                       'search/?type=Item&frame=object&aliases=lab%3Af1&aliases=lab%3Af2',
+                       'search/?type=Item&frame=object&aliases=lab%3Af3']
+    assert existing_items['lab:f1'] == found
+    assert existing_items['4DNFIYI7YMVU'] == found
+    # identifiers the searches miss, and @ids that can't be searched for, are left for get_existing to fetch
+    assert 'lab:f2' not in existing_items
+    assert 'lab:f3' not in existing_items
+    assert '/labs/test-lab/' not in existing_items
+
+
 def test_combine_set_expsets():
     post_json = {"aliases": "sample_expset", "description": "sample description"}
     existing_data = {}
@@ -372,6 +582,71 @@ def test_error_conflict_report(connection_mock):
     assert rep.strip() == message.strip()
 
 
+def test_error_conflict_report_all_conflicts(mocker, connection_mock):
+    err_dict = {"title": "Conflict", "status": "error", "code": 409,
+                "detail": "Keys conflict: [('alias', 'test:vendor'), ('vendor:name', 'a-vendor')]"}
+    search = mocker.patch('dcicutils.ff_utils.search_metadata', side_effect=[
+        [{'@id': '/vendors/a-vendor/', 'aliases': ['test:other', 'test:vendor']}], []])
+    rep = imp.error_report(err_dict, "Vendor", [], connection_mock)
+    assert rep.split('\n') == [
+        "ERROR vendor                  Field 'alias': 'test:vendor' already exists, please use /vendors/a-vendor/",
+        "ERROR vendor                  Field 'name': 'a-vendor' already exists, please contact DCIC"]
+    assert search.call_args_list[0][0][0] == 'search/?type=Vendor&frame=object&aliases=test%3Avendor'
+
+
+def test_workbook_reader_resolves_conflicts_together(capsys, mocker, connection_mock, workbooks):
+    def post_response(post_json, sheet, key=None, add_on=''):
+        alias = post_json['aliases'][0]
+        if alias.endswith('_2'):
+            return {'status': 'error', 'title': 'Conflict', 'code': 409,
+                    'detail': "Keys conflict: [('alias', '{}')]".format(alias)}
+        return {'status': 'success', '@graph': [{'uuid': alias + '_uuid', '@id': '/' + alias}]}
+
+    def search_response(query, key=None):
+        aliases = [unquote(part.split('=')[1]) for part in query.split('&') if part.startswith('aliases=')]
+        return [{'@id': '/files-fastq/{}/'.format(alias), 'aliases': [alias]} for alias in aliases]
+    mocker.patch('wranglertools.import_data.get_existing', return_value={})
+    mocker.patch('dcicutils.ff_utils.post_metadata', side_effect=post_response)
+    search = mocker.patch('dcicutils.ff_utils.search_metadata', side_effect=search_response)
+    imp.workbook_reader(workbooks.get('FileFastq_pairing.xlsx'), 'FileFastq', True, connection_mock, False,
+                        {}, {}, {}, {}, True, [], workers=3)
+    assert search.call_count == 1
+    out = [line for line in capsys.readouterr()[0].split('\n') if line.startswith('ERROR')]
+    conflicts = ['test_lab:f{}_2'.format(n) for n in [1, 2, 3, 4, 6, 7]]
+    assert out == ["ERROR filefastq               Field 'alias': '{0}' already exists, please use /files-fastq/{0}/"
+                   .format(alias) for alias in conflicts]
+
+
+def test_workbook_reader_reports_held_rows_when_a_row_raises(tmp_path, capsys, mocker, connection_mock, workbooks):
+    report_path = tmp_path / 'report.jsonl'
+    mocker.patch('wranglertools.import_data.submission_report', imp.SubmissionReport(str(report_path)))
+
+    def post_response(post_json, sheet, key=None, add_on=''):
+        alias = post_json['aliases'][0]
+        if alias == 'test_lab:f1_2':
+            return {'status': 'error', 'title': 'Conflict', 'code': 409,
+                    'detail': "Keys conflict: [('alias', '{}')]".format(alias)}
+        if alias == 'test_lab:f3_1':
+            raise RuntimeError("Upload failed")
+        return {'status': 'success', '@graph': [{'uuid': alias + '_uuid', '@id': '/' + alias}]}
+    mocker.patch('wranglertools.import_data.get_existing', return_value={})
+    mocker.patch('dcicutils.ff_utils.post_metadata', side_effect=post_response)
+    mocker.patch('dcicutils.ff_utils.search_metadata', return_value=[])
+    with pytest.raises(RuntimeError):
+        imp.workbook_reader(workbooks.get('FileFastq_pairing.xlsx'), 'FileFastq', True, connection_mock, False,
+                            {}, {}, {}, {}, True, [])
+    imp.submission_report.close()
+    # the conflict and the rows held back after it are still printed and reported
+    out = capsys.readouterr()[0]
+    assert "Field 'alias': 'test_lab:f1_2' already exists, please contact DCIC" in out
+    # (the rows paired with an earlier row are posted first, f3_1 raises in the second level)
+    rows = [json.loads(line) for line in report_path.read_text().splitlines()]
+    aliases = ['test_lab:f{}'.format(n) for n in
+               ['1_1', '1_2', '2_1', '2_2', '3_2', '4_2', '5_1', '6_1', '7_1']]
+    assert [row['alias'] for row in rows] == aliases
+    assert [row['action'] for row in rows].count('error') == 1
+
+
 def test_error_access_denied_report(connection_mock):
     # There are 3 errors, 2 of them are legit, one needs to be checked afains the all aliases list, and excluded
     err_dict = {'code': 403,
@@ -405,6 +680,27 @@ def test_digest_xlsx(workbooks):
             assert book[sheet].max_column == workbook[sheet].max_column
 
 
+@pytest.mark.file_operation
+def test_digest_xlsx_read_only_rows_match(workbooks):
+    WORKBOOK_DIR = './tests/data_files/workbooks/'
+    for fn, workbook in workbooks.items():
+        book, sheets = imp.digest_xlsx(WORKBOOK_DIR + fn, read_only=True)
+        assert sheets == workbook.sheetnames
+        for sheet in sheets:
+            assert list(imp.reader(book, sheetname=sheet)) == list(imp.reader(workbook, sheetname=sheet))
+        book.close()
+
+
+def test_plain_value():
+    assert imp.plain_value(None) == ''
+    assert imp.plain_value(0) == ''
+    assert imp.plain_value(3.0) == 3
+    assert imp.plain_value(2.5) == 2.5
+    assert imp.plain_value(True) is True
+    assert imp.plain_value(' a string ') == 'a string'
+    assert imp.plain_value(datetime.datetime(2018, 1, 31)) == '2018-01-31'
+
+
 def test_workbooks_reader_no_update_no_patchall_new_doc_with_attachment(capsys, mocker, connection_mock, workbooks):
     # test new item submission without patchall update tags and check the return message
     test_insert = 'Document_insert.xlsx'
@@ -652,6 +948,96 @@ def test_workbook_reader_update_new_experiment_set_post(capsys, mocker, connecti
     assert args[0][0] == final_post
 
 
+def test_map_rows_keeps_row_order_with_workers():
+
+    def slow_square(n):
+        # later rows finish first
+        time.sleep((10 - n) * 0.001)
+        return n * n
+    assert list(imp.map_rows(slow_square, range(10), workers=4)) == [n * n for n in range(10)]
+    assert list(imp.map_rows(slow_square, range(10))) == [n * n for n in range(10)]
+
+
+@pytest.mark.file_operation
+def test_workbook_reader_workers_same_as_serial(capsys, mocker, connection_mock, workbooks):
+    test_insert = 'FileFastq_pairing.xlsx'
+    message = "FILEFASTQ(13)              : 13 posted / 0 not posted       0 patched / 0 not patched, 0 errors"
+
+    def post_response(post_json, sheet, key=None, add_on=''):
+        alias = post_json['aliases'][0]
+        return {'status': 'success', '@graph': [{'uuid': alias + '_uuid', '@id': '/' + alias}]}
+    mocker.patch('wranglertools.import_data.get_existing', return_value={})
+    mocker.patch('dcicutils.ff_utils.post_metadata', side_effect=post_response)
+    loadxl_by_workers = {}
+    for workers in [1, 4]:
+        dict_load = {}
+        imp.workbook_reader(workbooks.get(test_insert), 'FileFastq', True, connection_mock, False,
+                            {}, dict_load, {}, {}, True, [], workers=workers)
+        out = capsys.readouterr()[0]
+        assert message == out.strip()
+        loadxl_by_workers[workers] = dict_load
+    assert loadxl_by_workers[1] == loadxl_by_workers[4]
+    # only the second file of the pairs that link to each other is left for loadxl_cycle
+    assert len(loadxl_by_workers[4]['FileFastq']) == 4
+    assert loadxl_by_workers[4]['FileFastq'][0]['uuid'] == 'test_lab:f1_2_uuid'
+
+
+def test_order_rows(workbooks):
+    rows = imp.reader(workbooks.get('FileFastq_pairing.xlsx'), sheetname='FileFastq')
+    keys = next(rows)[1:]
+    fields2types = dict(zip(keys, next(rows)[1:]))
+    rows = [(row_num, values[1:]) for row_num, values in enumerate(rows, start=3) if not values[0].startswith('#')]
+    aliases = {a: 'FileFastq' for _, values in rows for a in values[0].split(', ')}
+    levels, inline = imp.order_rows(rows, keys, fields2types, 'FileFastq', aliases)
+    assert [[r for r, _ in level] for level in levels] == [[6, 8, 10, 12, 13, 14, 16], [5, 7, 9, 11, 15, 17]]
+    # f1_1 and f1_2 link to each other - the link back from f1_2 is left for loadxl_cycle
+    assert inline[5] == {'related_files': {6}}
+    assert inline[6] == {}
+    assert inline[15] == {'related_files': {14}}
+
+
+def test_order_rows_link_to_later_sheet(workbooks):
+    keys = ['aliases', 'related_files.relationship_type', 'related_files.file']
+    fields2types = dict(zip(keys, ['array of strings', 'array of embedded objects, string',
+                                   'array of embedded objects, Item:File']))
+    rows = [(3, ['a:raw', 'derived from', 'a:processed']), (4, ['a:other', 'derived from', 'existing-uuid'])]
+    aliases = {'a:raw': 'FileFastq', 'a:other': 'FileFastq', 'a:processed': 'FileProcessed'}
+    levels, inline = imp.order_rows(rows, keys, fields2types, 'FileFastq', aliases)
+    assert levels == [rows]
+    assert inline == {3: {}, 4: {'related_files': set()}}
+
+
+def test_workbook_reader_dryrun_workers(capsys, mocker, connection_mock, workbooks):
+    in_flight = []
+    max_in_flight = []
+    lock = threading.Lock()
+
+    def check_response(post_json, sheet, key=None, add_on=''):
+        assert add_on == 'check_only=True'
+        with lock:
+            in_flight.append(1)
+            max_in_flight.append(len(in_flight))
+        # later rows finish first
+        time.sleep(0.02 if post_json['aliases'][0].endswith('_1') else 0.001)
+        with lock:
+            in_flight.pop()
+        if post_json['aliases'][0].endswith('_2'):
+            return {'status': 'error', 'title': 'Forbidden', 'description': 'not allowed'}
+        return {'status': 'success'}
+    mocker.patch('wranglertools.import_data.get_existing', return_value={})
+    mocker.patch('dcicutils.ff_utils.post_metadata', side_effect=check_response)
+    outputs = []
+    for dryrun_workers in [None, 3]:
+        imp.workbook_reader(workbooks.get('FileFastq_pairing.xlsx'), 'FileFastq', False, connection_mock, False,
+                            {}, {}, {}, {}, True, [], dryrun_workers=dryrun_workers)
+        outputs.append(capsys.readouterr()[0])
+        if dryrun_workers is None:
+            assert max(max_in_flight) == 1
+    assert outputs[0] == outputs[1]
+    assert 'ERROR filefastq' in outputs[1]
+    assert max(max_in_flight) == 3
+
+
 def test_user_workflow_reader_wfr_post(capsys, mocker, connection_mock, workbooks):
     test_insert = 'Pseudo_wfr_insert.xlsx'
     sheet_name = 'user_workflow_1'
@@ -732,6 +1118,129 @@ def test_order_sorter(capsys):
         assert message1 in outlist[1]
 
 
+def dependency_workbook():
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    sheets = {
+        'Vendor': [['#Field Name:', 'aliases'], ['#Field Type:', 'array of strings'], [None, 'test:vendor']],
+        'Enzyme': [['#Field Name:', 'aliases', 'enzyme_source'], ['#Field Type:', 'array of strings', 'Item:Vendor'],
+                   [None, 'test:enzyme', 'test:vendor']],
+        'Gene': [['#Field Name:', 'aliases'], ['#Field Type:', 'array of strings'], [None, 'test:gene']],
+        'Biosource': [['#Field Name:', 'aliases', 'references'], ['#Field Type:', 'array of strings', 'array of Item:Item'],
+                      [None, 'test:bs', 'test:gene,test:exp'], ['#', 'test:bs2', 'test:enzyme']],
+        'ExperimentHiC': [['#Field Name:', 'aliases', '*replicate_set'],
+                          ['#Field Type:', 'array of strings', 'Item:ExperimentSetReplicate'], [None, 'test:exp', 'test:rep']],
+        'ExperimentSetReplicate': [['#Field Name:', 'aliases'], ['#Field Type:', 'array of strings'], [None, 'test:rep']],
+    }
+    for name, rows in sheets.items():
+        ws = wb.create_sheet(name)
+        for row in rows:
+            ws.append(row)
+    sheets = imp.order_sorter(list(sheets))
+    workbook = imp.WorkbookIndex(wb, sheets)
+    return workbook, sheets, imp.get_all_aliases(workbook, sheets)
+
+
+def test_sheet_dependencies():
+    workbook, sheets, aliases = dependency_workbook()
+    assert imp.sheet_dependencies(workbook, sheets, aliases) == {
+        'Vendor': set(),
+        # by the Item:Vendor type of a column
+        'Enzyme': {'Vendor'},
+        'Gene': set(),
+        # by the aliases used - the link to a later sheet and the commented out row don't count
+        'Biosource': {'Gene'},
+        # links to the replicate set go the other way, it is made from the experiments
+        'ExperimentHiC': set(),
+        'ExperimentSetReplicate': {'ExperimentHiC'},
+    }
+
+
+def test_link_targets_match_sub_types():
+    subtypes = imp.get_subtypes({
+        'Experiment': {'rdfs:subClassOf': '/profiles/Item.json'},
+        'ExperimentHiC': {'rdfs:subClassOf': '/profiles/Experiment.json'},
+        'ExperimentMic': {'rdfs:subClassOf': '/profiles/Experiment.json'},
+        'ExperimentSet': {'rdfs:subClassOf': '/profiles/Item.json'},
+        'ExperimentSetReplicate': {'rdfs:subClassOf': '/profiles/ExperimentSet.json'},
+        'Vendor': {'rdfs:subClassOf': '/profiles/Item.json'}})
+    assert subtypes == {'Experiment': {'ExperimentHiC', 'ExperimentMic'}, 'ExperimentSet': {'ExperimentSetReplicate'}}
+    sheets = ['Vendor', 'ExperimentHiC', 'ExperimentMic', 'ExperimentMic_Path', 'ExperimentSetReplicate']
+    # the experiment set sheets are not sub types of Experiment however their names start
+    assert imp._link_targets('Item:Experiment', sheets, subtypes) == ['ExperimentHiC', 'ExperimentMic',
+                                                                      'ExperimentMic_Path']
+    assert imp._link_targets('array of Item:ExperimentSet', sheets, subtypes) == ['ExperimentSetReplicate']
+    assert imp._link_targets('Item:Vendor', sheets, subtypes) == ['Vendor']
+    assert imp._link_targets('Item:Item', sheets, subtypes) == []
+
+
+def test_run_sheets_waits_for_dependencies(capsys):
+    started = []
+    running = set()
+    overlapped = []
+    lock = threading.Lock()
+
+    def load_sheet(sheet):
+        with lock:
+            started.append(sheet)
+            if running:
+                overlapped.append(sheet)
+            running.add(sheet)
+        print(sheet, 'start')
+        time.sleep(0.05)
+        print(sheet, 'end')
+        with lock:
+            running.remove(sheet)
+
+    dependencies = {'Vendor': set(), 'Enzyme': {'Vendor'}, 'Gene': set(), 'Biosource': {'Gene', 'Enzyme'}}
+    imp.run_sheets(['Vendor', 'Enzyme', 'Gene', 'Biosource'], dependencies, load_sheet, workers=4)
+    assert started[:2] == ['Vendor', 'Gene']
+    assert started.index('Enzyme') > started.index('Vendor')
+    assert started[-1] == 'Biosource'
+    assert overlapped
+    # the output of each sheet is printed together
+    lines = capsys.readouterr().out.splitlines()
+    for sheet in dependencies:
+        assert lines.index(sheet + ' end') == lines.index(sheet + ' start') + 1
+
+
+def test_run_sheets_output_of_row_threads(capsys):
+    def load_sheet(sheet):
+        def row(n):
+            print(sheet, 'row', n)
+            imp.print_progress('{} upload {}'.format(sheet, n))
+            time.sleep(0.01)
+            return n
+        print(sheet, 'start')
+        assert list(imp.map_rows(row, range(4), workers=3)) == list(range(4))
+        print(sheet, 'end')
+
+    imp.run_sheets(['Vendor', 'Enzyme'], {}, load_sheet, workers=2)
+    lines = capsys.readouterr().out.splitlines()
+    for sheet in ['Vendor', 'Enzyme']:
+        # what the row threads print stays with the sheet
+        start = lines.index(sheet + ' start')
+        expected = [sheet + ' start', sheet + ' end'] + ['{} row {}'.format(sheet, n) for n in range(4)]
+        assert sorted(lines[start:start + 6]) == sorted(expected)
+        # and progress lines are printed as they happen, before the output of their sheet
+        progress = ['[{0}] {0} upload {1}'.format(sheet, n) for n in range(4)]
+        assert all(lines.index(line) < start for line in progress)
+
+
+def test_run_sheets_stops_after_error():
+    loaded = []
+
+    def load_sheet(sheet):
+        if sheet == 'Enzyme':
+            raise ValueError('bad sheet')
+        loaded.append(sheet)
+
+    with pytest.raises(ValueError):
+        imp.run_sheets(['Vendor', 'Enzyme', 'Biosource'], {'Biosource': {'Enzyme'}, 'Enzyme': {'Vendor'}},
+                       load_sheet, workers=2)
+    assert loaded == ['Vendor']
+
+
 @pytest.mark.file_operation
 def test_loadxl_cycle(capsys, mocker, connection_mock):
     patch_list = {'Experiment': [{"uuid": "some_uuid"}]}
@@ -743,6 +1252,126 @@ def test_loadxl_cycle(capsys, mocker, connection_mock):
     assert message == out.strip()
 
 
+def test_loadxl_cycle_deletes_fields_in_the_same_patch(capsys, mocker, connection_mock):
+    patch_list = {'Experiment': [{"uuid": "some_uuid", "description": "*delete*", "experiment_sets": ['*delete*'],
+                                  "references": ["/publications/1/"]}]}
+    patch = mocker.patch('dcicutils.ff_utils.patch_metadata', return_value={'status': 'success'})
+    imp.loadxl_cycle(patch_list, connection_mock, [])
+    patch.assert_called_once_with({"uuid": "some_uuid", "references": ["/publications/1/"]}, "some_uuid",
+                                  key=connection_mock.key, add_on='delete_fields=description,experiment_sets')
+    assert capsys.readouterr()[0].strip() == "EXPERIMENT(phase2): 1 items patched."
+
+
+def test_loadxl_cycle_workers(capsys, mocker, connection_mock):
+    patch_list = {'Biosample': [{"uuid": "bs_%s" % i} for i in range(4)],
+                  'Experiment': [{"uuid": "exp_%s" % i} for i in range(4)],
+                  'ExperimentSet': []}
+    running = []
+    most = []
+    lock = threading.Lock()
+
+    def patch_response(post_json, uuid, key=None, add_on=''):
+        with lock:
+            running.append(uuid)
+            most.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(uuid)
+        if uuid == 'bs_0':
+            return {'status': 'error', 'title': 'Forbidden', 'description': 'not allowed'}
+        return {'status': 'success'}
+    mocker.patch('dcicutils.ff_utils.patch_metadata', side_effect=patch_response)
+    imp.loadxl_cycle(patch_list, connection_mock, [], workers=4)
+    assert max(most) > 1
+    out = capsys.readouterr()[0].strip().split('\n')
+    assert out[0] == 'ERROR biosample               : not allowed'
+    assert out[1:] == ["BIOSAMPLE(phase2): 4 items patched.", "EXPERIMENT(phase2): 4 items patched.",
+                       "EXPERIMENTSET(phase2): 0 items patched."]
+
+
+def test_workbook_reader_patchall_leaves_links_to_new_rows(mocker, connection_mock, workbooks):
+    # only the first file of each pair exists - with --patchall alone the others are not posted
+    def existing(post_json, connection, existing_items=None):
+        alias = post_json['aliases'][0]
+        return {} if alias.endswith('_2') else {'uuid': alias + '_uuid', '@id': '/' + alias}
+    mocker.patch('wranglertools.import_data.get_existing', side_effect=existing)
+    patch = mocker.patch('dcicutils.ff_utils.patch_metadata', side_effect=lambda post_json, uuid, **kw: {
+        'status': 'success', '@graph': [{'uuid': uuid, '@id': '/' + uuid}]})
+    dict_load = {}
+    imp.workbook_reader(workbooks.get('FileFastq_pairing.xlsx'), 'FileFastq', False, connection_mock, True,
+                        {}, dict_load, {}, {}, True, [], workers=3)
+    assert patch.call_count == 7
+    assert not any('related_files' in c[0][0] for c in patch.call_args_list)
+    assert 'test_lab:f1_1_uuid' in [item['uuid'] for item in dict_load['FileFastq']]
+
+
+def test_submission_report_rows_and_loadxl(tmp_path, mocker, connection_mock, workbooks):
+    report_path = tmp_path / 'report.jsonl'
+    mocker.patch('wranglertools.import_data.submission_report', imp.SubmissionReport(str(report_path)))
+
+    def post_response(post_json, sheet, key=None, add_on=''):
+        alias = post_json['aliases'][0]
+        if alias.endswith('_2'):
+            return {'status': 'error', 'title': 'Forbidden', 'description': 'not allowed'}
+        return {'status': 'success', '@graph': [{'uuid': alias + '_uuid', '@id': '/' + alias}]}
+    mocker.patch('wranglertools.import_data.get_existing', return_value={})
+    mocker.patch('dcicutils.ff_utils.post_metadata', side_effect=post_response)
+    mocker.patch('dcicutils.ff_utils.patch_metadata', return_value={'status': 'success'})
+    dict_load = {}
+    imp.workbook_reader(workbooks.get('FileFastq_pairing.xlsx'), 'FileFastq', True, connection_mock, False,
+                        {}, dict_load, {}, {}, True, [], workers=3)
+    imp.loadxl_cycle(dict_load, connection_mock, {})
+    imp.submission_report.close()
+    records = [json.loads(line) for line in report_path.read_text().splitlines()]
+    rows = [r for r in records if r['stage'] == 'rows']
+    assert [r['row'] for r in rows] == sorted(r['row'] for r in rows)
+    assert len(rows) == 13
+    assert rows[0]['alias'] == 'test_lab:f1_1'
+    assert rows[0]['action'] == 'post'
+    assert rows[0]['uuid'] == 'test_lab:f1_1_uuid'
+    assert rows[0]['error'] is None
+    assert {'get_existing', 'submit', 'total'} <= set(rows[0]['timings'])
+    errors = [r for r in rows if r['action'] == 'error']
+    assert errors and all('not allowed' in r['error'] and r['uuid'] is None for r in errors)
+    loadxl = [r for r in records if r['stage'] == 'loadxl']
+    assert len(loadxl) == sum(len(v) for v in dict_load.values())
+    # the link of f1_1 to the f1_2 that failed to post is left for loadxl_cycle
+    assert 'test_lab:f1_1_uuid' in [r['uuid'] for r in loadxl]
+    assert all(r['action'] == 'patch' and r['sheet'] == 'FileFastq' for r in loadxl)
+
+
+def test_run_profile(mocker):
+    calls = []
+    mocker.patch.dict(imp.ff_utils.REQUESTS_VERBS, {'GET': lambda url, **kw: calls.append(url) or 'got',
+                                                    'POST': lambda url, **kw: calls.append(url) or 'posted'})
+    profile = imp.RunProfile()
+    with profile.phase('not recorded'):
+        pass
+    profile.enable()
+    try:
+        assert imp.ff_utils.REQUESTS_VERBS['GET']('https://portal/me', auth=None) == 'got'
+        imp.ff_utils.REQUESTS_VERBS['GET']('https://portal/search/?type=Lab', auth=None)
+        imp.ff_utils.REQUESTS_VERBS['POST']('https://portal/Lab', auth=None)
+        with profile.phase('digest_xlsx'):
+            pass
+        with profile.phase('digest_xlsx'):
+            pass
+    finally:
+        profile.disable()
+    imp.ff_utils.REQUESTS_VERBS['GET']('https://portal/me', auth=None)
+    assert len(calls) == 4
+    assert list(profile.phases) == ['digest_xlsx']
+    assert profile.phases['digest_xlsx']['count'] == 2
+    assert {kind: stat['count'] for kind, stat in profile.requests.items()} == {'GET': 1, 'search': 1, 'POST': 1}
+    assert sum(profile.requests['GET']['histogram']) == 1
+    profile.add_request('PATCH', 100)
+    assert profile.requests['PATCH']['histogram'][-1] == 1
+    report = profile.report()
+    assert report[2].startswith('digest_xlsx')
+    assert any(line.startswith('search') for line in report)
+    assert profile.as_dict()['requests']['POST']['count'] == 1
+
+
 def test_verify_and_return_item_good_item(mocker, connection_mock, returned_award_objframe):
     mocker.patch('dcicutils.ff_utils.get_metadata', return_value=returned_award_objframe.json())
     res = imp._verify_and_return_item('/awards/1U01ES017166-01/', connection_mock)
@@ -965,6 +1594,94 @@ def test_get_all_aliases(workbooks):
     assert my_aliases == all_aliases
 
 
+@pytest.mark.file_operation
+def test_workbook_index_matches_workbook(workbooks):
+    for fn, workbook in workbooks.items():
+        index = imp.WorkbookIndex(workbook)
+        assert index.sheetnames == workbook.sheetnames
+        for sheet in workbook.sheetnames:
+            assert list(imp.reader(index, sheetname=sheet)) == list(imp.reader(workbook, sheetname=sheet))
+        assert imp.get_all_aliases(index, workbook.sheetnames) == imp.get_all_aliases(workbook, workbook.sheetnames)
+
+
+@pytest.mark.file_operation
+def test_workbook_index_streamed(workbooks):
+    for fn, workbook in workbooks.items():
+        book, sheets = imp.digest_xlsx('./tests/data_files/workbooks/' + fn, read_only=True)
+        index = imp.WorkbookIndex(book, keep_rows=False)
+        # the sheets are only parsed once, the rows are read back from the spools
+        book.close()
+        for sheet in sheets:
+            assert len(index[sheet].rows) <= 2
+            assert list(imp.reader(index, sheetname=sheet)) == list(imp.reader(workbook, sheetname=sheet))
+            assert list(index[sheet].data_rows()) == list(imp.WorkbookIndex(workbook)[sheet].data_rows())
+        assert imp.get_all_aliases(index, sheets) == imp.get_all_aliases(workbook, sheets)
+        index.close()
+
+
+def test_row_spool_readers_keep_their_place(mocker):
+    mocker.patch.object(imp.RowSpool, 'BATCH', 2)
+    spool = imp.RowSpool()
+    rows = [('', 'row {}'.format(n), n) for n in range(5)]
+    for row in rows:
+        spool.add(row)
+    first, second = iter(spool), iter(spool)
+    assert [next(first), next(first), next(first)] == rows[:3]
+    assert list(second) == rows
+    assert list(first) == rows[3:]
+    spool.close()
+
+
+@pytest.mark.file_operation
+def test_workbook_reader_looks_ahead_in_chunks(mocker, connection_mock, workbooks):
+    def post_response(post_json, sheet, key=None, add_on=''):
+        return {'status': 'success', '@graph': [{'uuid': post_json['aliases'][0] + '_uuid', '@id': '/a/'}]}
+    mocker.patch('wranglertools.import_data.LOOKAHEAD_ROWS', 4)
+    mocker.patch('wranglertools.import_data.get_existing', return_value={})
+    lookup = mocker.patch('wranglertools.import_data.get_existing_items', return_value={})
+    post = mocker.patch('dcicutils.ff_utils.post_metadata', side_effect=post_response)
+    order_rows = mocker.spy(imp, 'order_rows')
+    book, sheets = imp.digest_xlsx('./tests/data_files/workbooks/FileFastq_pairing.xlsx', read_only=True)
+    index = imp.WorkbookIndex(book, keep_rows=False)
+    dict_loadxl = {}
+    imp.workbook_reader(index, 'FileFastq', True, connection_mock, False, {}, dict_loadxl, {}, {}, True, [],
+                        batch_lookup=True)
+    # the 13 rows are looked up 4 at a time
+    assert lookup.call_count == 4
+    assert post.call_count == 13
+    # the rows of a streamed sheet are not held to be ordered, the links between them are patched in later
+    assert not order_rows.called
+    assert not any('related_files' in c[0][0] for c in post.call_args_list)
+    assert len(dict_loadxl['FileFastq']) == 10
+    book.close()
+
+
+@pytest.mark.file_operation
+def test_workbook_index_positions(workbooks):
+    index = imp.WorkbookIndex(workbooks.get('FileFastq_pairing.xlsx'))
+    sheet = index['FileFastq']
+    assert sheet.keys[:3] == ['aliases', '*file_format', 'paired_end']
+    assert sheet.types[0] == 'array of string'
+    assert sheet.comment_rows == {2, 3, 4}
+    assert index.alias_positions['test_lab:alt_f1_2'] == [('FileFastq', 6)]
+    row_num, values = next(sheet.data_rows())
+    assert row_num == 5
+    assert values[0] == 'test_lab:f1_1, test_lab:alt_f1_1'
+    assert imp.reader(index, sheetname='Biosample') is None
+
+
+def test_workbook_reader_from_index(capsys, mocker, connection_mock, workbooks):
+    test_insert = 'File_fastq_insert.xlsx'
+    message = "FILEFASTQ(1)               :  1 posted / 0 not posted       0 patched / 0 not patched, 0 errors"
+    e = {'status': 'success', '@graph': [{'uuid': 'some_uuid', '@id': 'some_uuid'}]}
+    mocker.patch('wranglertools.import_data.get_existing', return_value={})
+    mocker.patch('dcicutils.ff_utils.post_metadata', return_value=e)
+    index = imp.WorkbookIndex(workbooks.get(test_insert))
+    imp.workbook_reader(index, 'FileFastq', True, connection_mock, False, {}, {}, {}, {}, True, [])
+    out = capsys.readouterr()[0]
+    assert message == out.strip()
+
+
 @pytest.fixture
 def fields2type():
     return {
@@ -1096,6 +1813,116 @@ def test_validate_item_one_in_one_not_in_db(mocker, connection_mock):
     assert 'test:alias2' not in msg
 
 
+def test_validate_item_with_link_cache(mocker, connection_mock):
+    connection_mock.link_cache = imp.LinkCache()
+    mocker.patch('dcicutils.ff_utils.get_metadata', side_effect=[
+        {'@type': ['HTTPNotFound', 'Error']}, {'@type': ['Biosource', 'Item']},
+        {'@type': ['HTTPServerError', 'Error']}, {'@type': ['Biosource', 'Item']}
+    ])
+    items = ['test:alias1', 'test:alias2']
+    for _ in range(3):
+        msg = imp.validate_item(items, 'Biosource', {}, connection_mock)
+        assert msg.startswith("ERROR: '/Biosource/test:alias1' is NOT FOUND")
+        assert 'test:alias2' not in msg
+    # only the first row looked them up
+    assert imp.ff_utils.get_metadata.call_count == 2
+    assert (connection_mock.link_cache.hits, connection_mock.link_cache.misses) == (4, 2)
+    # server errors are looked up again next time
+    imp.validate_item(['test:alias3'], 'Biosource', {}, connection_mock)
+    imp.validate_item(['test:alias3'], 'Biosource', {}, connection_mock)
+    assert imp.ff_utils.get_metadata.call_count == 4
+
+
+def test_link_cache_evicts_least_recently_used():
+    link_cache = imp.LinkCache(maxsize=2)
+    link_cache.add('/labs/lab1/', ['Lab', 'Item'])
+    link_cache.add('/labs/lab2/', ['Lab', 'Item'])
+    assert link_cache.get_types('/labs/lab1/', None) == ['Lab', 'Item']
+    link_cache.add('/labs/lab3/', ['Lab', 'Item'])
+    assert len(link_cache) == 2
+    assert '/labs/lab2/' not in link_cache._types
+    assert '/labs/lab1/' in link_cache._types
+
+
+@pytest.mark.file_operation
+def test_attachment_cache_encodes_once(mocker, connection_mock, tmp_path):
+    encode = mocker.patch('wranglertools.import_data.attachment', wraps=imp.attachment)
+    connection_mock.attachment_cache = imp.AttachmentCache()
+    posts = [{'aliases': ['a:doc%s' % i], 'attachment': './tests/data_files/test.pdf'} for i in range(3)]
+    mocker.patch('wranglertools.import_data.get_existing', return_value={})
+    for post_json in posts:
+        imp.populate_post_json(post_json, connection_mock, 'Document', ['attachment'])
+    assert encode.call_count == 1
+    assert connection_mock.attachment_cache.hits == 2
+    assert posts[0]['attachment'] == posts[2]['attachment']
+    assert posts[0]['attachment'] is not posts[2]['attachment']
+    # a file changed since it was encoded is read again
+    changed = tmp_path / 'notes.txt'
+    changed.write_text('first')
+    first = connection_mock.attachment_cache.get(str(changed))
+    changed.write_text('second version')
+    assert connection_mock.attachment_cache.get(str(changed)) != first
+
+
+@pytest.mark.file_operation
+def test_attachment_cache_byte_budget():
+    attachments = ['./tests/data_files/test.pdf', './tests/data_files/test.jpg']
+    sizes = [imp.AttachmentCache.size(imp.attachment(path)) for path in attachments]
+    attachment_cache = imp.AttachmentCache(max_bytes=max(sizes))
+    for path in attachments:
+        attachment_cache.get(path)
+    # only the most recent one fits
+    assert attachment_cache.bytes == sizes[1]
+    assert [key[0] for key in attachment_cache._attachments] == [str(pp.Path(attachments[1]).resolve())]
+    attachment_cache.get(attachments[0])
+    assert attachment_cache.misses == 3
+
+
+def test_attachment_cache_locks_are_bounded(tmp_path):
+    attachment_cache = imp.AttachmentCache(stripes=4)
+    for i in range(20):
+        note = tmp_path / 'note{}.txt'.format(i)
+        note.write_text('note {}'.format(i))
+        assert attachment_cache.get(str(note)) == imp.attachment(str(note))
+    assert len(attachment_cache._locks) == 4
+
+
+def test_sheet_links():
+    keys = ['aliases', 'biosource', 'treatments', '#comment', 'description']
+    fields2types = {'aliases': 'array of strings', 'biosource': 'array of Item:Biosource',
+                    'treatments': 'array of Item:Treatment', '#comment': 'string', 'description': 'string'}
+    rows = [(3, ['a:bs1', 'a:src1, 4DNSROOOAAQ1', '', 'a:src2', 'some text']),
+            (4, ['a:bs2', 'a:src1,a:workbook_src', '/treatments/some-uuid/', '', ''])]
+    links = imp.sheet_links(rows, keys, fields2types, {'a:workbook_src': 'Biosource'})
+    assert links == {'/Biosource/a:src1': ('a:src1', 'Biosource'),
+                     '/Biosource/4DNSROOOAAQ1': ('4DNSROOOAAQ1', 'Biosource'),
+                     '/treatments/some-uuid/': ('/treatments/some-uuid/', 'Treatment')}
+
+
+def test_prefetch_link_types(mocker, connection_mock):
+    connection_mock.link_cache = imp.LinkCache()
+    links = {'/Biosource/a:src1': ('a:src1', 'Biosource'),
+             '/Biosource/4DNSROOOAAQ1': ('4DNSROOOAAQ1', 'Biosource'),
+             '/Biosource/a:missing': ('a:missing', 'Biosource'),
+             '/Lab/a:lab': ('a:lab', 'Lab'),
+             '/treatments/some-uuid/': ('/treatments/some-uuid/', 'Treatment')}
+    src = {'@type': ['Biosource', 'Item'], 'uuid': 'u1', 'accession': '4DNSROOOAAQ1', 'aliases': ['a:src1']}
+    mocker.patch('dcicutils.ff_utils.search_metadata', side_effect=[
+        [src], [src], [{'@type': ['Lab', 'Item'], 'uuid': 'u2', 'aliases': ['a:lab']}]])
+    imp.prefetch_link_types(links, connection_mock)
+    queries = [c[0][0] for c in imp.ff_utils.search_metadata.call_args_list]
+    assert queries == ['search/?type=Biosource&frame=object&aliases=a%3Amissing&aliases=a%3Asrc1',
+                       'search/?type=Biosource&frame=object&accession=4DNSROOOAAQ1',
+                       'search/?type=Lab&frame=object&aliases=a%3Alab']
+    assert sorted(connection_mock.link_cache._types) == ['/Biosource/4DNSROOOAAQ1', '/Biosource/a:src1', '/Lab/a:lab']
+    # the rows then only need GETs for what the searches did not find
+    mocker.patch('dcicutils.ff_utils.get_metadata', return_value={'@type': ['HTTPNotFound', 'Error']})
+    msg = imp.validate_item(['a:src1', '4DNSROOOAAQ1', 'a:missing', 'a:lab'], 'Biosource', {}, connection_mock)
+    assert imp.ff_utils.get_metadata.call_count == 2
+    assert msg == ("ERROR: '/Biosource/a:missing' is NOT FOUND - THE REQUIRED TYPE IS Biosource\n"
+                   "ERROR: '/Biosource/a:lab' is NOT FOUND - THE REQUIRED TYPE IS Biosource")
+
+
 def test_validate_string_are_strings_not_alias(alias_dict):
     s = ['test_string', 'test_string2']
     msg = imp.validate_string(s, alias_dict)
@@ -1613,6 +2440,64 @@ def pf_w_extfiles_resp():
     }
 
 
+def test_update_item_md5_on_upload(mocker, connection_mock):
+    resp = {'status': 'success', '@graph': [{'uuid': 'some_uuid', 'accession': 'some_accession',
+                                             'upload_credentials': 'creds'}]}
+    mocker.patch('wranglertools.import_data.checksums', imp.Checksums(on_upload=True))
+    mocker.patch('wranglertools.import_data.ff_utils.post_metadata', return_value=resp)
+    mocker.patch('wranglertools.import_data.ff_utils.patch_metadata', return_value=resp)
+    mocker.patch('wranglertools.import_data.upload_file_item',
+                 side_effect=lambda e, path, connection, hasher: hasher.update(b'uploaded bytes'))
+    imp.update_item('POST', True, {'aliases': ['a:1']}, 'afile', None, connection_mock, 'FileFastq')
+    assert 'md5sum' not in imp.ff_utils.post_metadata.call_args[0][0]
+    args = imp.ff_utils.patch_metadata.call_args[0]
+    assert args == ({'md5sum': hashlib.md5(b'uploaded bytes').hexdigest()}, 'some_uuid')
+
+
+def test_update_item_md5_on_upload_of_a_duplicate(mocker, connection_mock):
+    resp = {'status': 'success', '@graph': [{'uuid': 'some_uuid', 'accession': 'some_accession',
+                                             'upload_credentials': {'upload_url': 's3://bucket/key'}}]}
+    md5sum = hashlib.md5(b'uploaded bytes').hexdigest()
+    conflict = {'status': 'error', 'title': 'Conflict', 'code': 409,
+                'detail': "Keys conflict: [('alias', 'md5:{}')]".format(md5sum)}
+    mocker.patch('wranglertools.import_data.checksums', imp.Checksums(on_upload=True))
+    mocker.patch('wranglertools.import_data.ff_utils.post_metadata', return_value=resp)
+    patch = mocker.patch('wranglertools.import_data.ff_utils.patch_metadata',
+                         side_effect=[Exception('Bad status code for PATCH request: 409. Reason: {}'.format(conflict)),
+                                      resp])
+    mocker.patch('wranglertools.import_data.upload_file_item',
+                 side_effect=lambda e, path, connection, hasher: hasher.update(b'uploaded bytes'))
+    remove = mocker.patch.object(imp.s3_uploader, 'remove')
+    # the md5 of another file is an error of the row, not of the run
+    e = imp.update_item('POST', True, {'aliases': ['a:1']}, 'afile', None, connection_mock, 'FileFastq')
+    assert e == conflict
+    # and the upload it belongs to is removed and the file marked as failed
+    assert remove.call_args[0][0] == {'upload_url': 's3://bucket/key'}
+    assert patch.call_args_list[1][0][:2] == ({'status': 'upload failed'}, 'some_uuid')
+
+
+def test_s3_uploader_hashes_while_uploading(tmp_path, multipart_client, s3_creds):
+    to_upload = tmp_path / 'big.fastq.gz'
+    to_upload.write_bytes(b'0123456789' * 4 + b'end')
+    journal = imp.UploadJournal(str(tmp_path / 'journal.sqlite'))
+    uploader = imp.S3Uploader(part_size=10, concurrency=2, journal=journal)
+    # part 2 is already uploaded but still counts for the md5
+    journal.start('test-files-bucket', 'some-uuid/4DNFIXXXXXXX.fastq.gz', to_upload, 43,
+                  to_upload.stat().st_mtime, 'upload0', 10)
+    journal.add_part('upload0', 2, 'etag2')
+    hasher = hashlib.md5()
+    uploader.upload(s3_creds, str(to_upload), hasher=hasher)
+    assert hasher.hexdigest() == imp.md5(str(to_upload))
+    assert sorted(c[1]['PartNumber'] for c in multipart_client.upload_part.call_args_list) == [1, 3, 4, 5]
+    # small files are streamed through the hasher by boto3
+    small = tmp_path / 'small.txt'
+    small.write_bytes(b'small')
+    multipart_client.upload_fileobj.side_effect = lambda f, *args, **kwargs: f.read(2) + f.read()
+    hasher = hashlib.md5()
+    uploader.upload(s3_creds, str(small), hasher=hasher)
+    assert hasher.hexdigest() == hashlib.md5(b'small').hexdigest()
+
+
 def test_update_item_extrafiles(mocker, connection_mock, pf_w_extfiles_resp):
     extrafiles = {'pairs_px2': '/test/file/test_pairs.gz.px2', 'pairsam_px2': '/test/file/testfile.pairs.sam.gz'}
     upld_creds = [{'file_format': 'pairs_px2', 'upload_credentials': 'px2creds'},
@@ -1628,6 +2513,222 @@ def test_update_item_extrafiles(mocker, connection_mock, pf_w_extfiles_resp):
     assert resp['status'] == 'success'
 
 
+@pytest.fixture
+def s3_creds():
+    return {'AccessKeyId': 'key', 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+            'upload_url': 's3://test-files-bucket/some-uuid/4DNFIXXXXXXX.fastq.gz'}
+
+
+@pytest.mark.file_operation
+def test_s3_uploader_upload(mocker, capsys, s3_creds):
+    client = mocker.patch('wranglertools.import_data.boto3.client')
+    uploader = imp.S3Uploader(part_size=8 * imp.MB, concurrency=3, max_files=2)
+    uploader.upload(s3_creds, './tests/data_files/example.fastq.gz')
+    assert client.call_args[1]['aws_session_token'] == 'token'
+    args, kwargs = client.return_value.upload_file.call_args
+    assert args[1:] == ('test-files-bucket', 'some-uuid/4DNFIXXXXXXX.fastq.gz')
+    assert args[0].endswith('example.fastq.gz')
+    assert kwargs['Config'].multipart_chunksize == 8 * imp.MB
+    assert kwargs['Config'].max_concurrency == 3
+    out = capsys.readouterr()[0]
+    assert 'Uploaded in' in out
+
+
+def test_s3_uploader_upload_stream_md5_mismatch(mocker, s3_creds):
+    uploader = imp.S3Uploader()
+    client = mocker.patch.object(uploader, 'client').return_value
+    client.upload_fileobj.side_effect = lambda f, *args, **kwargs: f.read()
+    client.delete_object.side_effect = imp.ClientError({'Error': {'Code': 'AccessDenied'}}, 'DeleteObject')
+    mocker.patch('wranglertools.import_data.remote_source',
+                 side_effect=lambda url: contextlib.nullcontext((io.BytesIO(b'reads'), 5)))
+    assert uploader.upload_stream(s3_creds, url='ftp://example.com/r.fastq.gz') == hashlib.md5(b'reads').hexdigest()
+    # the md5 error is raised even when the upload can't be removed
+    with pytest.raises(RuntimeError) as excinfo:
+        uploader.upload_stream(s3_creds, url='ftp://example.com/r.fastq.gz', md5sum='0' * 32)
+    assert 'md5 sum' in str(excinfo.value)
+    assert 'could not be removed' in str(excinfo.value)
+    client.delete_object.assert_called_once_with(Bucket='test-files-bucket', Key='some-uuid/4DNFIXXXXXXX.fastq.gz')
+
+
+def test_s3_uploader_bad_creds():
+    with pytest.raises(Exception) as e:
+        imp.S3Uploader().upload({'upload_url': 's3://bucket/key'}, 'afile')
+    assert "Didn't get back s3 access keys" in str(e.value)
+
+
+def test_s3_uploader_upload_many():
+    uploaded = []
+    threads = set()
+
+    def fake_upload(creds, path):
+        threads.add(threading.current_thread().name)
+        time.sleep(0.01)
+        uploaded.append((creds, path))
+    uploads = [('creds%d' % i, 'file%d' % i) for i in range(5)]
+    imp.S3Uploader(max_files=3).upload_many(uploads, fake_upload)
+    assert sorted(uploaded) == uploads
+    assert 1 < len(threads) <= 3
+
+
+@pytest.fixture
+def multipart_client(mocker):
+    client = mocker.patch('wranglertools.import_data.boto3.client').return_value
+    client.create_multipart_upload.return_value = {'UploadId': 'upload1'}
+    client.upload_part.side_effect = lambda **kw: {'ETag': 'etag%d' % kw['PartNumber']}
+    return client
+
+
+def test_s3_uploader_resumes_from_journal(tmp_path, multipart_client, s3_creds):
+    to_upload = tmp_path / 'big.fastq.gz'
+    to_upload.write_bytes(b'x' * 45)
+    journal = imp.UploadJournal(str(tmp_path / 'journal.sqlite'))
+    uploader = imp.S3Uploader(part_size=10, concurrency=1, journal=journal)
+    sent = []
+
+    def fail_on_part_3(**kw):
+        if kw['PartNumber'] == 3:
+            raise imp.ClientError({'Error': {'Code': 'RequestTimeout'}}, 'UploadPart')
+        sent.append(kw['PartNumber'])
+        return {'ETag': 'etag%d' % kw['PartNumber']}
+    multipart_client.upload_part.side_effect = fail_on_part_3
+    with pytest.raises(RuntimeError):
+        uploader.upload(s3_creds, str(to_upload))
+    assert journal.parts('upload1') == {1: 'etag1', 2: 'etag2', 4: 'etag4', 5: 'etag5'}
+    # a rerun with a new journal object on the same file only sends the missing part
+    sent = []
+    multipart_client.upload_part.side_effect = lambda **kw: sent.append(kw['PartNumber']) or {'ETag': 'etag'}
+    uploader.configure(part_size=10, concurrency=2, journal=imp.UploadJournal(journal.path))
+    uploader.upload(s3_creds, str(to_upload))
+    assert sent == [3]
+    assert multipart_client.create_multipart_upload.call_count == 1
+    parts = multipart_client.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts']
+    assert [p['PartNumber'] for p in parts] == [1, 2, 3, 4, 5]
+    assert uploader.journal.find('test-files-bucket', 'some-uuid/4DNFIXXXXXXX.fastq.gz') is None
+
+
+def test_s3_uploader_journal_restarts_changed_file(tmp_path, multipart_client, s3_creds):
+    to_upload = tmp_path / 'big.fastq.gz'
+    to_upload.write_bytes(b'x' * 25)
+    journal = imp.UploadJournal(str(tmp_path / 'journal.sqlite'))
+    journal.start('test-files-bucket', 'some-uuid/4DNFIXXXXXXX.fastq.gz', to_upload, 30, 0.0, 'old', 10)
+    journal.add_part('old', 1, 'oldetag')
+    imp.S3Uploader(part_size=10, concurrency=1, journal=journal).upload(s3_creds, str(to_upload))
+    assert multipart_client.abort_multipart_upload.call_args[1]['UploadId'] == 'old'
+    assert multipart_client.upload_part.call_count == 3
+    assert journal.parts('old') == {}
+
+
+def test_s3_uploader_refreshes_expired_creds(tmp_path, mocker, multipart_client, s3_creds):
+    to_upload = tmp_path / 'big.fastq.gz'
+    to_upload.write_bytes(b'x' * 25)
+    expired = imp.ClientError({'Error': {'Code': 'ExpiredToken'}}, 'UploadPart')
+    multipart_client.upload_part.side_effect = [expired, {'ETag': 'a'}, {'ETag': 'b'}, {'ETag': 'c'}]
+    new_creds = dict(s3_creds, SessionToken='new_token')
+    refresh = mocker.Mock(return_value=new_creds)
+    uploader = imp.S3Uploader(part_size=10, concurrency=1,
+                              journal=imp.UploadJournal(str(tmp_path / 'journal.sqlite')))
+    uploader.upload(s3_creds, str(to_upload), refresh)
+    assert refresh.call_count == 1
+    assert imp.boto3.client.call_args[1]['aws_session_token'] == 'new_token'
+    assert multipart_client.complete_multipart_upload.called
+
+
+def test_upload_file_item_refreshes_with_upload_creds(mocker, connection_mock, s3_creds):
+    upload = mocker.patch('wranglertools.import_data.upload_file')
+    mocker.patch('wranglertools.import_data.get_upload_creds', return_value='new_creds')
+    imp.upload_file_item({'@graph': [{'accession': '4DNFIXXXXXXX', 'upload_credentials': s3_creds}]},
+                         'afile', connection_mock)
+    creds, path, refresh = upload.call_args[0]
+    assert (creds, path) == (s3_creds, 'afile')
+    assert refresh() == 'new_creds'
+    assert imp.get_upload_creds.call_args[0][0] == '4DNFIXXXXXXX'
+
+
+def expires_in(seconds):
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+    return expires.strftime('%Y-%m-%d %H:%M:%S%z')
+
+
+def test_creds_expiration():
+    assert imp.creds_expiration({'Expiration': '2018-07-21T04:59:18+00:00'}) == 1532149158
+    assert imp.creds_expiration({'Expiration': '2018-07-21 04:59:18+0000'}) == 1532149158
+    assert imp.creds_expiration({'Expiration': 'soon'}) is None
+    assert imp.creds_expiration('creds') is None
+
+
+def test_upload_credentials_fetched_only_when_needed(mocker, connection_mock, s3_creds):
+    upload_credentials = imp.UploadCredentials(margin=600)
+    old = dict(s3_creds, Expiration=expires_in(3600))
+    new = dict(s3_creds, SessionToken='new_token', Expiration=expires_in(3600))
+    mocker.patch('wranglertools.import_data.get_upload_creds', return_value=new)
+    upload_credentials.remember('4DNFIXXXXXXX', old)
+    assert upload_credentials.get('4DNFIXXXXXXX', connection_mock) is old
+    # an upload refused with the old credentials gets new ones
+    refresh = upload_credentials.refresher('4DNFIXXXXXXX', connection_mock, old)
+    assert refresh() is new
+    assert upload_credentials.get('4DNFIXXXXXXX', connection_mock) is new
+    # credentials about to expire are replaced
+    upload_credentials.remember('4DNFIXXXXXXX', dict(s3_creds, Expiration=expires_in(3600)))
+    mocker.patch('wranglertools.import_data.time.time', return_value=time.time() + 3590)
+    assert upload_credentials.get('4DNFIXXXXXXX', connection_mock) is new
+    assert upload_credentials.fetched == imp.get_upload_creds.call_count == 2
+
+
+def test_upload_credentials_short_lived(mocker, connection_mock, s3_creds):
+    upload_credentials = imp.UploadCredentials(margin=600, min_interval=60)
+    mocker.patch('wranglertools.import_data.get_upload_creds', return_value=s3_creds)
+    # the margin is clamped to a quarter of the lifetime of the credentials
+    short = dict(s3_creds, Expiration=expires_in(120))
+    upload_credentials.remember('4DNFIXXXXXXX', short)
+    assert upload_credentials.get('4DNFIXXXXXXX', connection_mock) is short
+    # and credentials that are already expired are not fetched again within min_interval
+    upload_credentials.remember('4DNFIXXXXXXX', dict(s3_creds, Expiration=expires_in(-5)))
+    with upload_credentials.keep_fresh('4DNFIXXXXXXX', connection_mock):
+        upload_credentials.get('4DNFIXXXXXXX', connection_mock)
+        time.sleep(0.3)
+    assert not imp.get_upload_creds.called
+
+
+def test_upload_credentials_keep_fresh(mocker, connection_mock, s3_creds):
+    upload_credentials = imp.UploadCredentials(margin=5, min_interval=0)
+    old = dict(s3_creds, Expiration=expires_in(2))
+    new = dict(s3_creds, SessionToken='new_token', Expiration=expires_in(3600))
+    mocker.patch('wranglertools.import_data.get_upload_creds', return_value=new)
+    upload_credentials.remember('4DNFIXXXXXXX', old)
+    refresh = upload_credentials.refresher('4DNFIXXXXXXX', connection_mock, old)
+    with upload_credentials.keep_fresh('4DNFIXXXXXXX', connection_mock):
+        for _ in range(50):
+            if upload_credentials.fetched:
+                break
+            time.sleep(0.1)
+        # the upload gets the credentials renewed in the background
+        assert refresh() is new
+    assert imp.get_upload_creds.call_count == 1
+
+
+def test_update_item_extrafiles_uses_posted_creds(mocker, connection_mock, pf_w_extfiles_resp):
+    for ecred in pf_w_extfiles_resp['@graph'][0]['extra_files_creds']:
+        ecred['upload_credentials']['Expiration'] = expires_in(3600)
+    extrafiles = {'pairs_px2': '/test/file/test_pairs.gz.px2'}
+    mocker.patch('wranglertools.import_data.ff_utils.post_metadata', return_value=pf_w_extfiles_resp)
+    mocker.patch('wranglertools.import_data.get_upload_creds')
+    upload = mocker.patch('wranglertools.import_data.upload_extra_file')
+    mocker.patch('wranglertools.import_data.ff_utils.get_metadata',
+                 return_value={'uuid': 'd13d06cf-218e-4f61-aaf0-91f226348b2c'})
+    imp.update_item('POST', False, {}, None, extrafiles, connection_mock, 'FileProcessed')
+    assert not imp.get_upload_creds.called
+    ecreds, path, refresh = upload.call_args[0]
+    assert ecreds['upload_url'].endswith('4DNFILBPYFFN.pairs.gz.px2')
+    assert path == '/test/file/test_pairs.gz.px2'
+
+
+def test_s3_uploader_client_refreshes_credentials(s3_creds):
+    expiring = dict(s3_creds, Expiration=expires_in(60))
+    new = dict(s3_creds, SessionToken='new_token', Expiration=expires_in(3600))
+    client = imp.S3Uploader().client(expiring, lambda: new)
+    assert client._request_signer._credentials.get_frozen_credentials().token == 'new_token'
+
+
 def test_get_profiles(mocker, mock_profiles, connection_mock):
     '''just using a simple mock profiles dictionary'''
     mocker.patch('wranglertools.import_data.ff_utils.get_metadata', return_value=mock_profiles)
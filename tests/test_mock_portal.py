@@ -0,0 +1,180 @@
+import hashlib
+import sys
+import openpyxl
+import pytest
+from dcicutils import ff_utils
+import wranglertools.get_field_info as gfi
+import wranglertools.import_data as imp
+from tests.mock_portal import MockPortal
+
+
+@pytest.fixture
+def portal(monkeypatch):
+    # the tools swap in pooled sessions and configure the module level uploader - undo that afterwards
+    monkeypatch.setattr(ff_utils, 'REQUESTS_VERBS', dict(ff_utils.REQUESTS_VERBS))
+    monkeypatch.setattr(gfi.request_hooks, '_hooks', [])
+    monkeypatch.setattr(gfi.request_hooks, '_original', None)
+    with MockPortal() as portal:
+        yield portal
+    imp.s3_uploader.configure()
+    imp.checksums.configure()
+
+
+@pytest.fixture
+def keyfile(portal, tmp_path):
+    return str(portal.write_keyfile(tmp_path / 'keypairs.json'))
+
+
+def run(mocker, main, *args):
+    mocker.patch.object(sys, 'argv', ['prog'] + [str(a) for a in args])
+    main()
+
+
+def fill_workbook(path, rows_by_sheet):
+    wb = openpyxl.load_workbook(path)
+    for sheet, rows in rows_by_sheet.items():
+        ws = wb[sheet]
+        fields = [str(cell.value).lstrip('*') for cell in ws[1]]
+        for row in rows:
+            ws.append([None] + [row.get(field) for field in fields[1:]])
+    wb.save(path)
+
+
+def import_args(portal, keyfile, infile, *extra):
+    return [infile, '--keyfile', keyfile, '--remote', '--no-schema-cache', '--no-checksum-cache',
+            '--no-upload-journal', '--md5-workers', 0, '--s3-endpoint-url', portal.s3.url] + list(extra)
+
+
+def test_mock_portal_connection(portal):
+    connection = gfi.FDN_Connection(gfi.FDN_Key({'default': portal.key()}, 'default'))
+    assert connection.user == portal.user['@id']
+    assert connection.lab == '/labs/mock-lab/'
+    assert connection.award == '/awards/mock-award/'
+
+
+def test_mock_portal_check_only_and_delete_fields(portal):
+    key = portal.key()
+    post = {'aliases': ['test:vendor'], 'title': 'A vendor', 'url': 'https://example.com'}
+    res = ff_utils.post_metadata(post, 'Vendor', key=key, add_on='check_only=True')
+    assert res['status'] == 'success'
+    assert not ff_utils.search_metadata('search/?type=Vendor', key=key)
+    with pytest.raises(Exception) as excinfo:
+        ff_utils.post_metadata({'aliases': ['test:vendor'], 'titel': 'A vendor'}, 'Vendor', key=key)
+    err = imp.parse_exception(excinfo.value)
+    assert err['code'] == 422
+    assert [e['name'] for e in err['errors']] == ['titel', 'title']
+    uuid = ff_utils.post_metadata(post, 'Vendor', key=key)['@graph'][0]['uuid']
+    ff_utils.patch_metadata({}, uuid, key=key, add_on='delete_fields=url')
+    assert 'url' not in ff_utils.get_metadata('test:vendor', key=key, add_on='frame=object')
+
+
+def test_mock_portal_latency(portal):
+    portal.latency = 0.05
+    assert ff_utils.get_metadata('me', key=portal.key())
+    assert portal.requests['GET'] == 1
+
+
+def test_mock_portal_streamed_attachment(portal, mocker):
+    mocker.patch('wranglertools.import_data.STREAM_ATTACHMENT_SIZE', 0)
+    connection = gfi.FDN_Connection(gfi.FDN_Key({'default': portal.key()}, 'default'))
+    attach = imp.attachment('./tests/data_files/test.pdf')
+    post_json = {'aliases': ['test:doc'], 'attachment': attach}
+    assert imp.submit_metadata('POST', post_json, 'Document', connection, add_on='check_only=True')['status'] == 'success'
+    imp.submit_metadata('POST', post_json, 'Document', connection)
+    with open('./tests/data_files/test.pdf', 'rb') as f:
+        assert portal.find('test:doc')['attachment']['md5sum'] == hashlib.md5(f.read()).hexdigest()
+
+
+def test_mock_portal_pipe_remote_file(portal):
+    # the mock S3 also stands in for the server the fastq is mirrored on
+    content = b'@read1\nACGT\n+\n!!!!\n' * 1000
+    md5sum = hashlib.md5(content).hexdigest()
+    portal.s3.objects[('mirror', 'reads.fastq.gz')] = content
+    url = portal.s3.url + '/mirror/reads.fastq.gz'
+    imp.s3_uploader.configure(endpoint_url=portal.s3.url, pipe_remote=True)
+    connection = gfi.FDN_Connection(gfi.FDN_Key({'default': portal.key()}, 'default'))
+    connection.upload_credentials = imp.UploadCredentials()
+
+    def post(alias, **fields):
+        post_json = dict({'aliases': [alias], 'file_format': 'fastq', 'filename': 'reads.fastq.gz'}, **fields)
+        return imp.update_item('POST', True, post_json, url, None, connection, 'FileFastq')
+
+    post('test:fq1', md5sum=md5sum)
+    assert portal.uploaded('test:fq1') == content
+    assert portal.find('test:fq1')['status'] == 'uploaded'
+    # without an md5sum it is added once the upload is done
+    portal.s3.objects[('mirror', 'reads.fastq.gz')] = content * 2
+    post('test:fq2')
+    assert portal.find('test:fq2')['md5sum'] == hashlib.md5(content * 2).hexdigest()
+    # unless it is that of another file - the row fails, the upload is removed and the file can be tried again
+    e = post('test:dup')
+    assert e['status'] == 'error' and e['detail'] == "Keys conflict: [('alias', 'md5:{}')]".format(
+        hashlib.md5(content * 2).hexdigest())
+    assert portal.uploaded('test:dup') is None
+    assert portal.find('test:dup')['status'] == 'upload failed'
+    with pytest.raises(RuntimeError) as excinfo:
+        post('test:fq3', md5sum='0' * 32)
+    assert 'md5 sum' in str(excinfo.value)
+    assert portal.uploaded('test:fq3') is None
+
+
+def test_get_field_info_and_import_data_end_to_end(portal, keyfile, tmp_path, mocker, capsys):
+    workbook = str(tmp_path / 'fields.xlsx')
+    run(mocker, gfi.main, '--keyfile', keyfile, '--no-schema-cache', '--type', 'Vendor', '--type', 'Biosource',
+        '--type', 'FileFastq', '--outfile', workbook)
+    wb = openpyxl.load_workbook(workbook)
+    assert wb.sheetnames == ['Vendor', 'Biosource', 'FileFastq']
+    assert "Choices:['fastq']" in [cell.value for cell in wb['FileFastq'][4]]
+    fastq = tmp_path / 'reads.fastq.gz'
+    fastq.write_bytes(b'@read1\nACGT\n+\n!!!!\n' * 1000)
+    fill_workbook(workbook, {
+        'Vendor': [{'aliases': 'test:vendor', 'title': 'A vendor'}],
+        'Biosource': [{'aliases': 'test:bs', 'biosource_type': 'stem cell', 'biosource_vendor': 'test:vendor'}],
+        'FileFastq': [{'aliases': 'test:fq', 'file_format': 'fastq', 'filename': str(fastq)}],
+    })
+    capsys.readouterr()
+
+    # dry run - nothing is posted
+    run(mocker, imp.main, *import_args(portal, keyfile, workbook))
+    out = capsys.readouterr().out
+    assert 'ERROR' not in out
+    assert not ff_utils.search_metadata('search/?type=Vendor', key=portal.key())
+
+    run(mocker, imp.main, *import_args(portal, keyfile, workbook, '--update', '--sheet-workers', 3))
+    out = capsys.readouterr().out
+    assert 'ERROR' not in out
+    biosource = portal.find('test:bs')
+    assert biosource['biosource_vendor'] == portal.find('test:vendor')['@id']
+    assert biosource['lab'] == '/labs/mock-lab/'
+    fq = portal.find('test:fq')
+    assert fq['md5sum'] == hashlib.md5(fastq.read_bytes()).hexdigest()
+    assert portal.uploaded(fq) == fastq.read_bytes()
+    assert fq['status'] == 'uploaded'
+
+    # running the workbook again patches the existing items
+    run(mocker, imp.main, *import_args(portal, keyfile, workbook, '--patchall'))
+    out = capsys.readouterr().out
+    assert 'ERROR' not in out
+    assert out.count('0 posted / 0 not posted       1 patched / 0 not patched, 0 errors') == 3
+    assert 'Uploading file' not in out
+
+
+def test_import_data_cleans_up_when_interrupted(portal, keyfile, tmp_path, mocker):
+    workbook = str(tmp_path / 'fields.xlsx')
+    run(mocker, gfi.main, '--keyfile', keyfile, '--no-schema-cache', '--type', 'Vendor', '--outfile', workbook)
+    fill_workbook(workbook, {'Vendor': [{'aliases': 'test:vendor', 'title': 'A vendor'}]})
+    report = tmp_path / 'report.jsonl'
+    downloads_closed = mocker.spy(imp.downloads, 'close')
+    checksums_closed = mocker.spy(imp.checksums, 'close')
+
+    def interrupt(*args, **kwargs):
+        downloads_closed.reset_mock()
+        checksums_closed.reset_mock()
+        raise KeyboardInterrupt
+    mocker.patch('wranglertools.import_data.loadxl_cycle', side_effect=interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        run(mocker, imp.main, *import_args(portal, keyfile, workbook, '--update', '--report', report))
+    # the rows submitted before are in the report, and the downloads and md5 workers are shut down
+    assert 'test:vendor' in report.read_text()
+    assert imp.submission_report._file is None
+    assert downloads_closed.called and checksums_closed.called
@@ -7,6 +7,14 @@ import attr
 import openpyxl
 import sys
 import json
+import hashlib
+import os
+import re
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 EPILOG = '''
@@ -21,6 +29,8 @@ EPILOG = '''
         --outfile      change the default file name "fields.xlsx" to a specified one
         --debug        to add more debugging output
         --noadmin      if you have admin access to 4DN this option lets you generate the sheet as a non-admin user
+        --offline-schemas  use the locally cached schemas without checking the server for changes
+        --pool-size    number of connections to the portal kept open and reused (default 10, 0 for none)
 
 
     This program graphs uploadable fields (i.e. not calculated properties)
@@ -73,9 +83,36 @@ def create_common_arg_parser():
                         specify each sheet by --type",
                         action="append",
                         default=['all'])
+    parser.add_argument('--offline-schemas',
+                        default=False,
+                        action='store_true',
+                        help="Use the schemas cached in ~/.cache/submit4dn without checking the server for changes. \
+                        Schemas that have not been cached yet are still fetched.")
+    parser.add_argument('--schema-cache-ttl',
+                        default=3600,
+                        type=int,
+                        help="Seconds a cached schema is used before checking the server for changes. \
+                        Default is 3600")
+    parser.add_argument('--no-schema-cache',
+                        default=False,
+                        action='store_true',
+                        help="Do not read or write the local schema cache")
+    parser.add_argument('--pool-size',
+                        default=10,
+                        type=int,
+                        help="Number of keep-alive connections to the portal kept open and reused by all \
+                        requests, 0 to open a new connection for each request.  Default is 10")
     return parser
 
 
+def set_schema_cache(connection, args):
+    """Attach a SchemaCache to the connection as configured by the common arguments."""
+    if args.no_schema_cache:
+        return
+    connection.schema_cache = SchemaCache(connection.key['server'], key_id=connection.key.get('key'),
+                                          ttl=args.schema_cache_ttl, offline=args.offline_schemas)
+
+
 def getArgs():  # pragma: no cover
     parser = argparse.ArgumentParser(
         parents=[create_common_arg_parser()],
@@ -128,11 +165,133 @@ class FDN_Key:
             self.con_key['server'] += "/"
 
 
+class RequestHooks(object):
+    """The single owner of the request functions dcicutils.ff_utils uses (ff_utils.REQUESTS_VERBS).
+    Each hook wraps the request functions below it - wrap(verb, request_fxn) returns the function to
+    use instead.  The functions are rebuilt from the originals through the hooks still installed
+    whenever one is added or removed, so hooks can be removed in any order without dropping or
+    reinstating another one.  inner hooks (like the pooled session that actually sends the
+    requests) go below the ones installed before them.
+    """
+    def __init__(self):
+        self._hooks = []
+        self._original = None
+        self._lock = threading.Lock()
+
+    def install(self, owner, wrap, inner=False):
+        with self._lock:
+            if any(o is owner for o, _ in self._hooks):
+                return
+            if self._original is None:
+                self._original = dict(ff_utils.REQUESTS_VERBS)
+            if inner:
+                self._hooks.insert(0, (owner, wrap))
+            else:
+                self._hooks.append((owner, wrap))
+            self._rebuild()
+
+    def uninstall(self, owner):
+        with self._lock:
+            if not any(o is owner for o, _ in self._hooks):
+                return
+            self._hooks = [(o, wrap) for o, wrap in self._hooks if o is not owner]
+            self._rebuild()
+            if not self._hooks:
+                self._original = None
+
+    def installed(self, owner):
+        return any(o is owner for o, _ in self._hooks)
+
+    def _rebuild(self):
+        request_fxns = dict(self._original)
+        for _, wrap in self._hooks:
+            request_fxns = {verb: wrap(verb, request_fxn) for verb, request_fxn in request_fxns.items()}
+        ff_utils.REQUESTS_VERBS.update(request_fxns)
+
+
+# everything that changes how ff_utils sends its requests goes through this
+request_hooks = RequestHooks()
+
+
+class RequestOutcome(object):
+    """A request hook that keeps the exception (or None once a response came back) of the last request
+    made by the thread that created it - ff_utils only reports failed requests as a message."""
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.error = None
+
+    def _record(self, verb, request_fxn):
+        def request(*args, **kwargs):
+            try:
+                response = request_fxn(*args, **kwargs)
+            except Exception as e:
+                if threading.get_ident() == self.thread:
+                    self.error = e
+                raise
+            if threading.get_ident() == self.thread:
+                self.error = None
+            return response
+        return request
+
+    def __enter__(self):
+        request_hooks.install(self, self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        request_hooks.uninstall(self)
+
+    @property
+    def unreachable(self):
+        """True if the last request got no response at all (connection error or timeout)"""
+        return isinstance(self.error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class PortalSession(object):
+    """A keep-alive requests.Session that all the dcicutils.ff_utils requests go through once
+    installed, so connections (and their TLS handshakes) to the portal are reused.
+    pool_size connections are kept open and idempotent requests are retried with backoff when a
+    connection can't be made or breaks off - responses with an error status are left to the retries
+    of ff_utils, so they are not retried twice over.
+    """
+    def __init__(self, pool_size=10, retries=3, backoff=0.5):
+        self.session = requests.Session()
+        retry = Retry(total=retries, connect=retries, read=retries, status=0, backoff_factor=backoff,
+                      allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _send(self, verb, request_fxn):
+        return getattr(self.session, verb.lower())
+
+    def install(self):
+        """Routes the requests made by ff_utils through the session - below any other request hooks."""
+        request_hooks.install(self, self._send, inner=True)
+
+    def uninstall(self):
+        request_hooks.uninstall(self)
+
+    def close(self):
+        self.uninstall()
+        self.session.close()
+
+
 class FDN_Connection(object):
-    def __init__(self, key4dn):
+    def __init__(self, key4dn, pool_size=0):
         # passed key object stores the key dict in con_key
         self.check = False
         self.key = key4dn.con_key
+        self.schema_cache = None
+        # set by import_data to remember the types of linked items during validation
+        self.link_cache = None
+        # and the attachments and file upload credentials used by the rows
+        self.attachment_cache = None
+        self.upload_credentials = None
+        # with a pool_size all the requests to the portal reuse pooled connections
+        self.session = None
+        if pool_size:
+            self.session = PortalSession(pool_size)
+            self.session.install()
         # check connection and find user uuid
         # TODO: we should not need try/except, since if me page fails, there is
         # no need to proggress, but the test are failing without this Part
@@ -350,20 +509,128 @@ def build_field_list(properties, required_fields=None, no_description=False,
     return fields
 
 
+class SchemaCache(object):
+    """Keeps the schema (profiles) responses of a server on disk so repeated runs don't download them again.
+    Responses younger than ttl seconds are used as they are, older ones are revalidated with the stored
+    ETag/Last-Modified and only downloaded again if they changed.  If the server can't be reached the
+    cached copy is used whatever its age and in offline mode the server is not asked at all.  HTTP errors
+    (e.g. an expired key) are raised as usual.  Search results depend on what the user may see, so each
+    key_id gets its own cache on a server.
+    """
+    def __init__(self, server, key_id=None, cache_dir=None, ttl=3600, offline=False):
+        if cache_dir is None:
+            cache_dir = pp.Path.home() / '.cache' / 'submit4dn'
+        server_name = re.sub(r'^https?://', '', server).strip('/')
+        self.directory = pp.Path(cache_dir) / re.sub(r'[^\w.-]+', '_', server_name)
+        if key_id:
+            self.directory = self.directory / re.sub(r'[^\w.-]+', '_', key_id)
+        self.ttl = ttl
+        self.offline = offline
+
+    def _path(self, url):
+        return self.directory / (hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _read(self, url):
+        try:
+            with open(self._path(url)) as cached:
+                return json.load(cached)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, url, entry):
+        entry['url'] = url
+        entry['fetched'] = time.time()
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp = self._path(url).with_suffix('.tmp')
+            with open(tmp, 'w') as out:
+                json.dump(entry, out)
+            os.replace(tmp, self._path(url))
+        except OSError as e:  # pragma: no cover
+            print("WARNING: could not write schema cache - {}".format(e))
+
+    def _fresh(self, entry):
+        return entry is not None and (self.offline or time.time() - entry['fetched'] < self.ttl)
+
+    def get_metadata(self, uri, key, add_on=''):
+        """Cached equivalent of ff_utils.get_metadata"""
+        auth = ff_utils.get_authentication_with_server(key)
+        url = '/'.join([auth['server'], uri.lstrip('/')]) + ff_utils.process_add_on(add_on)
+        entry = self._read(url)
+        if self._fresh(entry):
+            return entry['body']
+        headers = {'content-type': 'application/json', 'accept': 'application/json'}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            with RequestOutcome() as outcome:
+                response = ff_utils.authorized_request(url, auth=auth, verb='GET', headers=headers)
+        except Exception:
+            if entry is None or not outcome.unreachable:
+                raise
+            print("WARNING: could not reach the server - using cached {}".format(uri))
+            return entry['body']
+        if response.status_code == 304 and entry is not None:
+            self._write(url, entry)
+            return entry['body']
+        body = ff_utils.get_response_json(response)
+        self._write(url, {'body': body, 'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified')})
+        return body
+
+    def search_metadata(self, search, key):
+        """Cached equivalent of ff_utils.search_metadata - searches have no validators so
+        results are only refreshed once they are older than ttl."""
+        auth = ff_utils.get_authentication_with_server(key)
+        url = '/'.join([auth['server'], search.lstrip('/')])
+        entry = self._read(url)
+        if self._fresh(entry):
+            return entry['body']
+        try:
+            with RequestOutcome() as outcome:
+                body = ff_utils.search_metadata(search, key=key)
+        except Exception:
+            if entry is None or not outcome.unreachable:
+                raise
+            print("WARNING: could not reach the server - using cached {}".format(search))
+            return entry['body']
+        self._write(url, {'body': body})
+        return body
+
+
+def get_schema_metadata(connection, uri, add_on=''):
+    """get_metadata for schema requests that goes through the connection schema_cache if it has one."""
+    cache = getattr(connection, 'schema_cache', None)
+    if cache is None:
+        return ff_utils.get_metadata(uri, key=connection.key, add_on=add_on)
+    return cache.get_metadata(uri, connection.key, add_on)
+
+
+def search_schema_metadata(connection, search):
+    """search_metadata for schema related searches that goes through the connection schema_cache if it has one."""
+    cache = getattr(connection, 'schema_cache', None)
+    if cache is None:
+        return ff_utils.search_metadata(search, key=connection.key)
+    return cache.search_metadata(search, connection.key)
+
+
 class FDN_Schema(object):
     def __init__(self, connection, schema_name):
         uri = '/profiles/' + schema_name + '.json'
-        response = ff_utils.get_metadata(uri, key=connection.key, add_on="frame=object")
+        response = get_schema_metadata(connection, uri, add_on="frame=object")
         self.required = None
         if 'required' in response:
             self.required = response['required']
         if schema_name in file_types and response['properties'].get('file_format'):
             q = '/search/?type=FileFormat&field=file_format&valid_item_types={}'.format(schema_name)
-            formats = [i['file_format'] for i in ff_utils.search_metadata(q, key=connection.key)]
+            formats = [i['file_format'] for i in search_schema_metadata(connection, q)]
             response['properties']['file_format']['enum'] = formats
         elif schema_name in exp_types and response['properties'].get('experiment_type'):
             q = '/search/?type=ExperimentType&field=title&valid_item_types={}'.format(schema_name)
-            exptypes = [i['title'] for i in ff_utils.search_metadata(q, key=connection.key)]
+            exptypes = [i['title'] for i in search_schema_metadata(connection, q)]
             response['properties']['experiment_type']['enum'] = exptypes
         self.properties = response['properties']
 
@@ -470,7 +737,8 @@ def main():  # pragma: no cover
     key = FDN_Key(args.keyfile, args.key)
     if key.error:
         sys.exit(1)
-    connection = FDN_Connection(key)
+    connection = FDN_Connection(key, pool_size=args.pool_size)
+    set_schema_cache(connection, args)
     if args.noadmin:
         connection.admin = False
     sheets = get_sheet_names(args.type)
@@ -6,28 +6,54 @@ import pathlib as pp
 import hashlib
 from wranglertools.get_field_info import (
     sheet_order, FDN_Key, FDN_Connection,
-    create_common_arg_parser, _remove_all_from_types)
+    create_common_arg_parser, _remove_all_from_types,
+    set_schema_cache, get_schema_metadata, request_hooks)
 from dcicutils import ff_utils
 import openpyxl
 import warnings  # to suppress openpxl warning about headers
 from openpyxl.utils.exceptions import InvalidFileException
+from openpyxl.worksheet._read_only import ReadOnlyWorksheet
 import datetime
 import sys
 import mimetypes
 import requests
 from base64 import b64encode
 import magic  # install me with 'pip install python-magic'
+import boto3
+from boto3.s3.transfer import TransferConfig, S3UploadFailedError
+import botocore.session
+from botocore.config import Config as BotoConfig
+from botocore.credentials import CredentialProvider, CredentialResolver, RefreshableCredentials
+from botocore.exceptions import BotoCoreError, ClientError
 # https://github.com/ahupp/python-magic
 # this is the site for python-magic in case we need it
 import ast
-import os
 import time
-import subprocess
 import shutil
+import tempfile
 import re
-from collections import OrderedDict, Counter
+import threading
+import sqlite3
+import math
+import itertools
+import functools
+import attr
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from urllib import request as urllib2
-from contextlib import closing
+from urllib.parse import quote
+from contextlib import closing, nullcontext, contextmanager
+import json
+import io
+import pickle
+import contextvars
+import uuid
+import cProfile
+
+
+MB = 1024 * 1024
+# attachments larger than this are streamed into the request body from the file
+STREAM_ATTACHMENT_SIZE = 16 * MB
 
 
 EPILOG = '''
@@ -101,6 +127,127 @@ def getArgs():  # pragma: no cover
                         default=False,
                         action='store_true',
                         help="Will skip pre-validation of workbook")
+    parser.add_argument('--workers',
+                        default=1,
+                        type=int,
+                        help="Number of rows of a sheet to submit at the same time.  Default is 1")
+    parser.add_argument('--loadxl-workers',
+                        default=1,
+                        type=int,
+                        help="Number of items to patch at the same time when the links left out of the posts are \
+                        patched in once all the sheets are loaded.  Default is 1")
+    parser.add_argument('--sheet-workers',
+                        default=1,
+                        type=int,
+                        help="Number of sheets to load at the same time - a sheet is only started once the \
+                        sheets it links to are done.  Default is 1, one sheet after the other")
+    parser.add_argument('--report',
+                        default=None,
+                        help="Write a JSON line for each row submitted to this file, with the action taken, \
+                        the uuid of the item, any errors and the time spent in each phase of the submission")
+    parser.add_argument('--profile',
+                        default=False,
+                        action='store_true',
+                        help="Print how long the main phases of the run took and the number and latency of \
+                        the requests made to the portal at the end")
+    parser.add_argument('--profile-out',
+                        default=None,
+                        help="Also write the --profile breakdown to this JSON file")
+    parser.add_argument('--cprofile',
+                        default=None,
+                        help="Run under cProfile and dump the stats to this file (for pstats or snakeviz)")
+    parser.add_argument('--dryrun-workers',
+                        default=None,
+                        type=int,
+                        help="Number of rows of a sheet checked at the same time in a dry run (without --update \
+                        or --patchall).  The report is still printed in row order.  Default is --workers")
+    parser.add_argument('--batch-lookup',
+                        default=False,
+                        action='store_true',
+                        help="Look up the existing items of each sheet with a few searches rather than \
+                        one request per identifier.  Identifiers the searches don't find are still \
+                        looked up one by one")
+    parser.add_argument('--stream-workbook',
+                        default=False,
+                        action='store_true',
+                        help="Read the workbook in read-only streaming mode - uses much less memory for \
+                        very large workbooks.  The rows are looked ahead (md5 sums, links, --batch-lookup) a \
+                        thousand at a time and links between the rows of a sheet are patched in at the end \
+                        (loadxl) instead of being posted with the rows")
+    parser.add_argument('--upload-part-size',
+                        default=64,
+                        type=int,
+                        help="Size in MB of the parts large files are uploaded to S3 in.  Default is 64")
+    parser.add_argument('--upload-concurrency',
+                        default=10,
+                        type=int,
+                        help="Number of parts of a file uploaded to S3 at the same time.  Default is 10")
+    parser.add_argument('--upload-files',
+                        default=4,
+                        type=int,
+                        help="Number of files uploaded to S3 at the same time.  Default is 4")
+    parser.add_argument('--s3-endpoint-url',
+                        default=None,
+                        help="Upload files to this S3 compatible server instead of AWS S3, \
+                        eg. a local stand-in used for testing")
+    parser.add_argument('--pipe-remote-files',
+                        default=False,
+                        action='store_true',
+                        help="Stream files given as ftp or http(s) urls straight from there into S3 instead of \
+                        downloading them first.  A given md5sum is checked on the way, otherwise it is added once the \
+                        upload is done (and the row fails if it is that of another file)")
+    parser.add_argument('--upload-journal',
+                        default=UploadJournal.DEFAULT_PATH,
+                        help="File used to keep track of partly uploaded files so that a rerun only sends \
+                        the missing parts.  Default is {} in the current directory".format(UploadJournal.DEFAULT_PATH))
+    parser.add_argument('--no-upload-journal',
+                        default=False,
+                        action='store_true',
+                        help="Do not keep track of partly uploaded files - failed uploads start again from the beginning")
+    parser.add_argument('--attachment-cache-size',
+                        default=256,
+                        type=int,
+                        help="MB of encoded attachments kept while the workbook is read, so an attachment \
+                        used by many rows is only read and encoded once.  0 turns this off.  Default is 256")
+    parser.add_argument('--link-cache-size',
+                        default=100000,
+                        type=int,
+                        help="Number of linked items whose type is remembered while validating the workbook, \
+                        so each one is only looked up once.  0 looks them up for every row.  Default is 100000")
+    parser.add_argument('--download-workers',
+                        default=4,
+                        type=int,
+                        help="Number of ftp and http attachments and ftp files downloaded at the same time in the \
+                        background before they are needed, 0 to download each one when its row is submitted.  \
+                        Default is 4")
+    parser.add_argument('--download-ahead',
+                        default=8,
+                        type=int,
+                        help="Number of files downloaded ahead of the rows and kept until their row is done with \
+                        them.  Default is 8")
+    parser.add_argument('--download-max-size',
+                        default=10240,
+                        type=int,
+                        help="No more files are downloaded ahead while the ones kept add up to this many MB.  \
+                        Default is 10240")
+    parser.add_argument('--download-dir',
+                        default=None,
+                        help="Directory the files are downloaded to, removed again at the end.  \
+                        Default is the system temporary directory")
+    parser.add_argument('--md5-workers',
+                        default=2,
+                        type=int,
+                        help="Number of processes calculating the md5 sums of the files of a sheet in the background \
+                        while the rows are submitted, 0 to calculate each one when it is needed.  Default is 2")
+    parser.add_argument('--md5-on-upload',
+                        default=False,
+                        action='store_true',
+                        help="Calculate the md5 sum of a file to upload while it is uploaded instead of beforehand, \
+                        so it is only read once.  The md5sum is added to the file item after the upload")
+    parser.add_argument('--no-checksum-cache',
+                        default=False,
+                        action='store_true',
+                        help="Do not reuse or store the md5 sums of files in {}".format(ChecksumStore.DEFAULT_PATH))
     args = parser.parse_args()
     _remove_all_from_types(args)
     return args
@@ -148,6 +295,138 @@ def md5(path_string):
     return md5sum.hexdigest()
 
 
+class ChecksumStore(object):
+    """Persistent SQLite cache of file md5 sums keyed by the absolute path of the file.
+    A stored sum is only used while the size, mtime and inode of the file are the same as
+    when it was calculated, so edited or replaced files are hashed again.
+    """
+    DEFAULT_PATH = pp.Path.home() / '.cache' / 'submit4dn' / 'checksums.sqlite'
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = pp.Path(path)
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS checksums (
+                                path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, md5 TEXT)''')
+            self._db.commit()
+        return self._db
+
+    @staticmethod
+    def file_key(path):
+        """Returns (absolute path, size, mtime in ns, inode) of path."""
+        path = pp.Path(path).expanduser().resolve()
+        stat = path.stat()
+        return str(path), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, file_key):
+        with self._lock:
+            row = self._connect().execute('SELECT size, mtime, inode, md5 FROM checksums WHERE path = ?',
+                                          file_key[:1]).fetchone()
+        if row and tuple(row[:3]) == tuple(file_key[1:]):
+            return row[3]
+        return None
+
+    def put(self, file_key, md5sum):
+        with self._lock:
+            db = self._connect()
+            db.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)', tuple(file_key) + (md5sum,))
+            db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class Checksums(object):
+    """md5 sums of the files to submit.  Sums are looked up in store (a ChecksumStore) first;
+    prefetch hashes files in a pool of workers processes in the background so that md5 only
+    waits for files that are not done yet.  With on_upload the md5 of a file to upload is
+    calculated while it is read for the upload instead (see update_item).
+    """
+    def __init__(self, store=None, workers=0, on_upload=False):
+        self._pool = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.configure(store, workers, on_upload)
+
+    def configure(self, store=None, workers=0, on_upload=False):
+        self.close()
+        self.store = store
+        self.workers = workers
+        self.on_upload = on_upload
+
+    def cached(self, path):
+        """Returns the known md5 of path or None."""
+        if self.store is None:
+            return None
+        return self.store.get(ChecksumStore.file_key(path))
+
+    def remember(self, path, md5sum):
+        if self.store is not None:
+            self.store.put(ChecksumStore.file_key(path), md5sum)
+
+    def prefetch(self, paths):
+        """Starts hashing the files in paths that do not have a known md5 yet."""
+        if not self.workers:
+            return
+        for path in paths:
+            key = ChecksumStore.file_key(path)
+            with self._lock:
+                if key in self._pending or (self.store is not None and self.store.get(key)):
+                    continue
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pending[key] = self._pool.submit(md5, key[0])
+
+    def md5(self, path):
+        if self.store is None and not self._pending:
+            return md5(path)
+        key = ChecksumStore.file_key(path)
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        md5sum = self.store.get(key) if self.store is not None else None
+        if md5sum is None:
+            md5sum = pending.result() if pending is not None else md5(path)
+            if self.store is not None:
+                self.store.put(key, md5sum)
+        return md5sum
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                for pending in self._pending.values():
+                    pending.cancel()
+                self._pool.shutdown()
+            self._pool = None
+            self._pending = {}
+
+
+# shared by all the rows of a run - main configures it from the options
+checksums = Checksums()
+
+
+def file_paths_to_hash(rows, keys, extra_files_only=False):
+    """Returns the local files named in the filename and extra_files filename columns of rows."""
+    columns = [i for i, k in enumerate(keys) if (k == 'filename' and not extra_files_only) or
+               (k.startswith('extra_files') and 'filename' in k)]
+    paths = []
+    for _, values in rows:
+        for i in columns:
+            value = values[i] if i < len(values) else None
+            if not value or not isinstance(value, str) or value.startswith(('ftp://', 'http://', 'https://')):
+                continue
+            if pp.Path(value).expanduser().is_file():
+                paths.append(value)
+    return paths
+
+
 class WebFetchException(Exception):
     """
     custom exception to raise if ftp or http fetch fails
@@ -155,6 +434,210 @@ class WebFetchException(Exception):
     pass
 
 
+def download(url, path):
+    """Streams url (ftp or http) to the file path a chunk at a time."""
+    part = '{}.part'.format(path)
+    if url.startswith('ftp://'):
+        with closing(urllib2.urlopen(url)) as r, open(part, 'wb') as f:
+            shutil.copyfileobj(r, f, MB)
+    else:
+        with closing(requests.get(url, stream=True)) as r:
+            if r.status_code != 200:
+                raise WebFetchException("{} returned {}".format(url, r.status_code))
+            with open(part, 'wb') as f:
+                for chunk in r.iter_content(MB):
+                    f.write(chunk)
+    pp.Path(part).replace(path)
+    return path
+
+
+@contextmanager
+def remote_source(url):
+    """Opens the ftp or http(s) url as a file object to read from - yields (file object, size or None)."""
+    if url.startswith('ftp://'):
+        with closing(urllib2.urlopen(url)) as r:
+            size = r.headers.get('Content-length')
+            yield r, int(size) if size else None
+        return
+    with closing(requests.get(url, stream=True)) as r:
+        if r.status_code != 200:
+            raise WebFetchException("{} returned {}".format(url, r.status_code))
+        # the content as it is stored, fastq.gz files are not to be unzipped
+        r.raw.decode_content = False
+        size = r.headers.get('Content-Length')
+        yield r.raw, int(size) if size else None
+
+
+class Downloads(object):
+    """Remote attachments and ftp files fetched ahead of the rows that need them.  prefetch
+    queues the urls and downloads them workers at a time in the background into a temporary
+    directory (under directory) and local waits for one and returns the local copy.
+    Only ahead files, and no more once max_bytes are on disk, are downloaded and kept at a time -
+    the next ones are started as the rows forget the copies they are done with.  A url that is
+    asked for before its download was started, while there is no room for it, is left to the row
+    to fetch itself.  The copies still there are removed by close at the end of the run.
+    """
+    def __init__(self, workers=0, directory=None, ahead=8, max_bytes=10240 * MB):
+        self._pool = None
+        self._pending = {}
+        self._queue = deque()
+        self._held = {}
+        self._started = 0
+        self._running = 0
+        self._tmpdir = None
+        self._lock = threading.RLock()
+        self.configure(workers, directory, ahead, max_bytes)
+
+    def configure(self, workers=0, directory=None, ahead=8, max_bytes=10240 * MB):
+        self.close()
+        self.workers = workers
+        self.directory = directory
+        self.ahead = ahead
+        self.max_bytes = max_bytes
+
+    def prefetch(self, urls):
+        if not self.workers:
+            return
+        with self._lock:
+            for url in urls:
+                if url not in self._pending and url not in self._queue:
+                    self._queue.append(url)
+            self._start_next()
+
+    def _start_next(self):
+        """Starts the queued downloads there is room for - called with the lock held.  Downloads are
+        only started as workers become free so the ones in progress are no more than workers files."""
+        while self._queue and self._running < self.workers and self._room():
+            self._start(self._queue.popleft())
+
+    def _room(self):
+        return len(self._held) < self.ahead and self.staged_bytes() < self.max_bytes
+
+    def _start(self, url):
+        if self._pool is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='submit4dn-downloads-', dir=self.directory)
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        # keep the name of the file, it is used for the attachment name and type
+        folder = pp.Path(self._tmpdir, str(self._started))
+        folder.mkdir()
+        self._started += 1
+        self._running += 1
+        self._held[url] = 0
+        self._pending[url] = self._pool.submit(download, url, str(folder / url.split('/')[-1]))
+        self._pending[url].add_done_callback(lambda pending, url=url: self._downloaded(url, pending))
+
+    def _downloaded(self, url, pending):
+        size = None
+        if not pending.cancelled() and pending.exception() is None:
+            try:
+                size = pp.Path(pending.result()).stat().st_size
+            except OSError:
+                pass
+        with self._lock:
+            if self._pending.get(url) is not pending:
+                return
+            self._running -= 1
+            if url not in self._held:
+                self._start_next()
+                return
+            if size is None:
+                # nothing on disk - make room for the next one
+                del self._held[url]
+            else:
+                self._held[url] = size
+            self._start_next()
+
+    def staged_bytes(self):
+        """The size of the downloaded copies that have not been forgotten yet."""
+        with self._lock:
+            return sum(self._held.values())
+
+    def local(self, url):
+        """The downloaded copy of url, or None if it was not prefetched or could not be downloaded."""
+        with self._lock:
+            if url in self._queue:
+                # needed before its turn - started now if there is room, otherwise the row gets it itself
+                self._queue.remove(url)
+                if self._room():
+                    self._start(url)
+            pending = self._pending.get(url)
+            if pending is None:
+                return None
+        try:
+            path = pending.result()
+        except Exception as e:
+            print("WARNING: Download of {} failed - {}".format(url, e))
+            return None
+        return path if pp.Path(path).is_file() else None
+
+    def forget(self, url):
+        """Removes the downloaded copy of url, making room for the next download - True if there was one."""
+        with self._lock:
+            if url in self._queue:
+                self._queue.remove(url)
+                return False
+        path = self.local(url)
+        with self._lock:
+            if self._held.pop(url, None) is not None:
+                self._start_next()
+        if path is None:
+            return False
+        pp.Path(path).unlink()
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                for pending in self._pending.values():
+                    pending.cancel()
+            pool, tmpdir = self._pool, self._tmpdir
+            self._pool = None
+            self._tmpdir = None
+            self._pending = {}
+            self._queue = deque()
+            self._held = {}
+            self._running = 0
+        if pool is not None:
+            pool.shutdown()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# shared by all the rows of a run - main configures it from the options
+downloads = Downloads()
+
+
+def remote_paths_to_fetch(workbook, sheets, attach_fields, filenames=True):
+    """The ftp and http(s) attachments of the sheets, and with filenames the ftp filenames of the rows
+    with an md5sum, in the order they are needed."""
+    urls = []
+    for sheet in sheets:
+        rows = reader(workbook, sheetname=sheet)
+        if rows is None:
+            continue
+        keys = next(rows, [])[1:]
+        next(rows, None)
+        columns = [i for i, k in enumerate(keys) if k in attach_fields or (k == 'filename' and filenames)]
+        md5_column = keys.index('md5sum') if 'md5sum' in keys else None
+        if not columns:
+            continue
+        for values in rows:
+            if not values or str(values[0]).startswith('#'):
+                continue
+            values = values[1:]
+            for i in columns:
+                value = values[i] if i < len(values) else None
+                if not isinstance(value, str):
+                    continue
+                if keys[i] == 'filename':
+                    if not value.startswith('ftp://') or md5_column is None or not values[md5_column]:
+                        continue
+                elif not value.startswith(('ftp://', 'http://', 'https://')):
+                    continue
+                if value not in urls:
+                    urls.append(value)
+    return urls
+
+
 def attachment(path):
     """Create an attachment upload object from a filename and embed the attachment as a data url.
        NOTE: a url or ftp can be used but path must end in filename with extension that will match
@@ -178,6 +661,7 @@ def attachment(path):
     ftp_attach = False
     if path.startswith('~'):
         path = str(pp.Path(path).expanduser())
+    url, path = path, downloads.local(path) or path
     if not pp.Path(path).is_file():
         # if the path does not exist, check if it works as a URL
         if path.startswith("ftp://"):  # grab the file from ftp
@@ -222,6 +706,11 @@ def attachment(path):
     if detected_mime != guessed_mime and guessed_mime != 'application/zip':
         raise ValueError('Wrong extension for %s: %s' % (detected_mime, filename))
 
+    if not ftp_attach and pp.Path(path).stat().st_size > STREAM_ATTACHMENT_SIZE:
+        # encoded a chunk at a time as the item is sent rather than held in memory - a downloaded
+        # copy is forgotten once the row is done with it (release_attachments)
+        href = DataURL(str(pp.Path(path).resolve()), guessed_mime, source=url if path != url else None)
+        return {'download': filename, 'type': guessed_mime, 'href': href}
     with open(path, 'rb') as stream:
         attach = {
             'download': filename,
@@ -230,14 +719,198 @@ def attachment(path):
         }
     if ftp_attach:
         pp.Path(path).unlink()
+    # the downloaded copy is not needed any more once it is encoded
+    downloads.forget(url)
     return attach
 
 
-def digest_xlsx(filename):
+class DataURL(object):
+    """The base64 data url of the file at path, encoded a chunk at a time while a StreamedBody
+    is sent so a large attachment is never held in memory.  source is the url path was
+    downloaded from, if it is a downloaded copy."""
+    # a multiple of 3 so the chunks are encoded without padding in between
+    CHUNK = 3 * 256 * 1024
+
+    def __init__(self, path, mime, source=None):
+        self.path = path
+        self.mime = mime
+        self.source = source
+        self.size = pp.Path(path).stat().st_size
+        self.prefix = 'data:%s;base64,' % mime
+
+    def __len__(self):
+        return len(self.prefix) + 4 * math.ceil(self.size / 3)
+
+    def __repr__(self):
+        return 'DataURL(%r, %r)' % (self.path, self.mime)
+
+    def chunks(self):
+        yield self.prefix.encode('ascii')
+        with open(self.path, 'rb') as f:
+            left = self.size
+            while left > 0:
+                data = f.read(min(self.CHUNK, left))
+                if not data:
+                    raise IOError("{} changed while it was being sent".format(self.path))
+                left -= len(data)
+                yield b64encode(data)
+
+
+class AttachmentCache(object):
+    """Run scoped cache of the attachment objects made by attachment(), so a file or url that many
+    rows use is only checked, read and encoded once.  Local files are keyed by their resolved path,
+    size and modification time, so a file that changes during the run is read again.  The least
+    recently used attachments are dropped once the encoded data held passes max_bytes.  Rows after
+    the same attachment wait for the first to encode it on one of a fixed set of striped locks.
+    """
+    def __init__(self, max_bytes=256 * MB, stripes=32):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._attachments = OrderedDict()
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path):
+        local = pp.Path(path).expanduser()
+        if local.is_file():
+            stat = local.stat()
+            return str(local.resolve()), stat.st_size, stat.st_mtime
+        return path, None, None
+
+    @staticmethod
+    def size(attach):
+        # streamed attachments only hold their path
+        href = attach.get('href')
+        return len(href) if isinstance(href, str) else 0
+
+    def get(self, path):
+        key = self.key(path)
+        with self._locks[hash(key) % len(self._locks)]:
+            with self._lock:
+                if key in self._attachments:
+                    self._attachments.move_to_end(key)
+                    self.hits += 1
+                    return dict(self._attachments[key])
+                self.misses += 1
+            attach = attachment(path)
+            self.add(key, attach)
+        return dict(attach)
+
+    def add(self, key, attach):
+        size = self.size(attach)
+        # a streamed attachment read from a downloaded copy is only good until that is forgotten
+        if size > self.max_bytes or downloaded_attachments({'attachment': attach}):
+            return
+        with self._lock:
+            self._attachments[key] = attach
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, dropped = self._attachments.popitem(last=False)
+                self.bytes -= self.size(dropped)
+
+
+def has_data_urls(post_json):
+    return any(isinstance(value, dict) and isinstance(value.get('href'), DataURL) for value in post_json.values())
+
+
+def downloaded_attachments(post_json):
+    """The urls of the streamed attachments of post_json that are read from a downloaded copy."""
+    return [value['href'].source for value in post_json.values()
+            if isinstance(value, dict) and isinstance(value.get('href'), DataURL) and value['href'].source]
+
+
+def release_attachments(urls):
+    """Forgets the downloaded copies of urls, making room for the next downloads."""
+    for url in urls:
+        downloads.forget(url)
+
+
+class StreamedBody(object):
+    """The JSON of post_json as a request body that reads the DataURLs in it from their files as
+    it is sent.  It has a length, so it goes with a Content-Length, and can be rewound to be sent again."""
+    def __init__(self, post_json):
+        token = uuid.uuid4().hex
+        urls = []
+
+        def placeholder(value):
+            if not isinstance(value, DataURL):
+                raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+            urls.append(value)
+            return '{}-{}'.format(token, len(urls) - 1)
+
+        pieces = re.split('{}-([0-9]+)'.format(token), json.dumps(post_json, default=placeholder))
+        self.parts = [urls[int(piece)] if i % 2 else piece.encode('utf-8') for i, piece in enumerate(pieces)]
+        self.seek(0)
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def _chunks(self):
+        for part in self.parts:
+            if isinstance(part, DataURL):
+                yield from part.chunks()
+            elif part:
+                yield part
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if offset or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("a streamed body can only be rewound to the start")
+        self._iter = self._chunks()
+        self._chunk = b''
+        self._pos = 0
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._pos >= len(self._chunk):
+                self._chunk, self._pos = next(self._iter, b''), 0
+                if not self._chunk:
+                    break
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._pos + size)
+            pieces.append(self._chunk[self._pos:end])
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return b''.join(pieces)
+
+
+def _rewinding_retries(request_fxn, url, auth, verb, **kwargs):
+    """standard_request_with_retries that sends the streamed body from the start on each try."""
+    body = kwargs['data']
+
+    def request(url, **kwargs):
+        body.seek(0)
+        return request_fxn(url, **kwargs)
+    return ff_utils.standard_request_with_retries(request, url, auth, verb, **kwargs)
+
+
+def submit_metadata(verb, post_json, identifier, connection, add_on=''):
+    """POSTs post_json to the identifier collection or PATCHes the identifier item.  When it has
+    attachments given as DataURLs the body is streamed from the files rather than built in memory."""
+    add_ons = {'add_on': add_on} if add_on else {}
+    if verb not in ('POST', 'PATCH'):
+        raise ValueError('Unrecognized verb - must be POST or PATCH')
+    if not has_data_urls(post_json):
+        if verb == 'PATCH':
+            return ff_utils.patch_metadata(post_json, identifier, key=connection.key, **add_ons)
+        return ff_utils.post_metadata(post_json, identifier, key=connection.key, **add_ons)
+    auth = ff_utils.get_authentication_with_server(connection.key)
+    url = '/'.join([auth['server'], identifier.lstrip('/')]) + ff_utils.process_add_on(add_on)
+    res = ff_utils.authorized_request(url, auth=auth, verb=verb, data=StreamedBody(post_json),
+                                      retry_fxn=_rewinding_retries)
+    return ff_utils.get_response_json(res)
+
+
+def digest_xlsx(filename, read_only=False):
+    """Load the workbook - with read_only the sheets are streamed from the file as they are read
+    instead of being loaded into memory up front."""
     try:
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            book = openpyxl.load_workbook(filename)
+            book = openpyxl.load_workbook(filename, read_only=read_only)
     except InvalidFileException as e:
         if filename.endswith('.xls'):
             print("WARNING - Old xls format not supported - please save your workbook as xlsx")
@@ -249,7 +922,9 @@ def digest_xlsx(filename):
 
 
 def reader(workbook, sheetname=None):
-    """Read named sheet or first and only sheet from xlsx file."""
+    """Read named sheet or first and only sheet from xlsx file (or from a WorkbookIndex)."""
+    if isinstance(workbook, WorkbookIndex):
+        return workbook.reader(sheetname)
     if sheetname is None:
         sheet = workbook.worksheets[0]
     else:
@@ -270,13 +945,162 @@ def row_generator(sheet):
     """Generator that gets rows from excel sheet
     Note that this currently checks to see if a row is empty and if so stops
     This is needed as plain text formatting of cells is recognized as data
+    Read only sheets are streamed as plain values, padded to the width of the first row
+    as the stored sheet dimensions can't be relied on for them.
     """
-    for row in sheet.rows:
-        vals = [cell_value(cell) for cell in row]
+    if isinstance(sheet, ReadOnlyWorksheet):
+        rows = ([plain_value(value) for value in row] for row in sheet.iter_rows(values_only=True))
+    else:
+        rows = ([cell_value(cell) for cell in row] for row in sheet.rows)
+    width = None
+    for vals in rows:
         if not any([v for v in vals]):
             return
-        else:
-            yield vals
+        if width is None:
+            width = len(vals)
+        elif len(vals) < width:
+            vals.extend([''] * (width - len(vals)))
+        yield vals
+
+
+class RowSpool(object):
+    """The converted rows of a streamed sheet, pickled to a temporary file as the sheet is indexed so
+    the sheet is only parsed once.  Each read goes through the file from the start (the readers each
+    keep their own place in it) without holding the rows in memory."""
+    # rows read at a time by a reader
+    BATCH = 100
+
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(prefix='submit4dn-sheet-', dir=directory)
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def add(self, row):
+        with self._lock:
+            self._file.seek(self._end)
+            pickle.dump(row, self._file, pickle.HIGHEST_PROTOCOL)
+            self._end = self._file.tell()
+
+    def __iter__(self):
+        offset = 0
+        while True:
+            with self._lock:
+                self._file.seek(offset)
+                rows = []
+                while len(rows) < self.BATCH and self._file.tell() < self._end:
+                    rows.append(pickle.load(self._file))
+                offset = self._file.tell()
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        self._file.close()
+
+
+@attr.s
+class SheetIndex(object):
+    """The already converted rows of a sheet - rows keep their first (title/comment) column.
+    An index of a streamed sheet only keeps the two header rows and reads the rows from spool."""
+    name = attr.ib()
+    rows = attr.ib(factory=list)
+    comment_rows = attr.ib(factory=set)
+    aliases = attr.ib(factory=list)
+    spool = attr.ib(default=None)
+
+    @property
+    def keys(self):
+        return list(self.rows[0][1:]) if self.rows else []
+
+    @property
+    def types(self):
+        return list(self.rows[1][1:]) if len(self.rows) > 1 else []
+
+    def all_rows(self):
+        if self.spool is None:
+            return iter(self.rows)
+        return iter(self.spool)
+
+    def data_rows(self):
+        """(excel row number, values without the first column) of the rows that are not commented out"""
+        for row_num, row in enumerate(self.all_rows(), start=1):
+            if row_num > 2 and row_num not in self.comment_rows:
+                yield row_num, list(row[1:])
+
+
+class WorkbookIndex(object):
+    """Everything the readers need from a workbook, read with a single pass over each sheet.
+    Holds the header keys and types, the converted cell values, which rows are commented out and
+    the (sheet, row) positions of every alias, so cell conversion is only done once per cell
+    however many times a sheet is read.  reader() accepts an index in place of the workbook.
+    Without keep_rows (for a read only workbook) only the headers, comment rows and aliases are
+    kept in memory - the converted rows go to a RowSpool on disk that each read of a sheet goes
+    through again, so the workbook is still parsed once.  close() removes the spools.
+    """
+    def __init__(self, workbook, sheets=None, keep_rows=True):
+        self.sheets = OrderedDict()
+        self.alias_positions = {}
+        self.keep_rows = keep_rows
+        for sheet in sheets or workbook.sheetnames:
+            if sheet not in workbook.sheetnames:
+                continue
+            self.sheets[sheet] = self._index_sheet(sheet, row_generator(workbook[sheet]), keep_rows)
+
+    def _index_sheet(self, sheet, rows, keep_rows=True):
+        index = SheetIndex(sheet, spool=None if keep_rows else RowSpool())
+        alias_col = None
+        for row_num, row in enumerate(rows, start=1):
+            if keep_rows or row_num <= 2:
+                index.rows.append(tuple(row))
+            if index.spool is not None:
+                index.spool.add(tuple(row))
+            if row_num == 1:
+                if 'aliases' in row:
+                    alias_col = row.index('aliases')
+                continue
+            if isinstance(row[0], str) and row[0].startswith('#'):
+                index.comment_rows.add(row_num)
+                continue
+            if row_num == 2 or alias_col is None:
+                continue
+            my_aliases = list(filter(None, [x.strip() for x in str(row[alias_col]).split(",")]))
+            if my_aliases:
+                index.aliases.append((row_num, my_aliases))
+                for a in my_aliases:
+                    self.alias_positions.setdefault(a, []).append((sheet, row_num))
+        return index
+
+    @property
+    def sheetnames(self):
+        return list(self.sheets.keys())
+
+    def __getitem__(self, sheet):
+        return self.sheets[sheet]
+
+    def __contains__(self, sheet):
+        return sheet in self.sheets
+
+    def close(self):
+        for index in self.sheets.values():
+            if index.spool is not None:
+                index.spool.close()
+
+    def reader(self, sheetname=None):
+        """Same rows as reader() on the workbook would give - as fresh lists as the readers modify them."""
+        if sheetname is None:
+            sheetname = self.sheetnames[0]
+        if sheetname not in self.sheets:
+            print(sheetname)
+            print("ERROR: Can not find the collection sheet in excel file (openpyxl error)")
+            return
+        return (list(row) for row in self.sheets[sheetname].all_rows())
+
+
+def is_streamed(workbook):
+    """True for a read only workbook, or the index of one, whose rows are read from the file as needed."""
+    if isinstance(workbook, WorkbookIndex):
+        return not workbook.keep_rows
+    return bool(getattr(workbook, 'read_only', False))
 
 
 def cell_value(cell):
@@ -317,6 +1141,35 @@ def cell_value(cell):
     )  # pragma: no cover
 
 
+def plain_value(value):
+    """The cell_value conversion for the plain values of a read only (values_only) sheet
+    where the cell data types are not available."""
+    if value is None:
+        return ''
+    elif isinstance(value, bool):
+        return value
+    elif isinstance(value, (int, float)):
+        if isinstance(value, float):
+            if value.is_integer():
+                value = int(value)
+        if not value:
+            return ''
+        return value
+    elif isinstance(value, openpyxl.cell.cell.TIME_TYPES):
+        if isinstance(value, datetime.datetime):
+            if value.time() == datetime.time(0, 0, 0):
+                return value.date().isoformat()
+            else:  # pragma: no cover
+                return value.isoformat()
+        else:
+            return value.isoformat()
+    elif isinstance(value, str):
+        if value in openpyxl.cell.cell.ERROR_CODES:  # pragma: no cover
+            raise ValueError('Cell contains a cell error %s' % value)
+        return value.strip()
+    raise ValueError('%s is not an acceptable cell value' % value)  # pragma: no cover
+
+
 def data_formatter(value, val_type, field=None):
     """Return formatted data."""
     # If val_type is int/num, but the value is not
@@ -422,9 +1275,8 @@ def parse_exception(e):
         raise e
 
 
-def get_existing(post_json, connection):
-    """Get the entry that will be patched from the server."""
-    # get all possible identifier from the json
+def _all_identifiers(post_json):
+    """All the identifiers (uuid, accession, @id and aliases) in a post_json."""
     all_ids = []
     for identifier in ["uuid", "accession", "@id"]:
         if post_json.get(identifier):
@@ -433,22 +1285,36 @@ def get_existing(post_json, connection):
     if post_json.get("aliases"):
         # weird precaution in case there are 2 aliases, 1 exisitng , 1 new
         all_ids.extend(post_json['aliases'])
+    return all_ids
+
+
+def get_existing(post_json, connection, existing_items=None):
+    """Get the entry that will be patched from the server.
+    If existing_items (as returned by get_existing_items) is passed the identifiers
+    are looked up there and only ones missing from it are fetched from the server."""
+    # get all possible identifier from the json
+    all_ids = _all_identifiers(post_json)
     # look if post_json has these 3 identifier
     temp = {}
     uuids = []
+    found = {}
     for an_id in all_ids:
-        try:
-            temp = ff_utils.get_metadata(an_id, key=connection.key, add_on="frame=object")
-        except Exception as e:
-            exc = parse_exception(e)
-            # if the item does not exist get_metadata will raise an exceptions
-            # see if the exception message has 404, then continue, if not throw that exception
-            if exc['code'] == 404:
-                temp = {}
-            else:
-                raise e
+        if existing_items is not None and an_id in existing_items:
+            temp = existing_items[an_id] or {}
+        else:
+            try:
+                temp = ff_utils.get_metadata(an_id, key=connection.key, add_on="frame=object")
+            except Exception as e:
+                exc = parse_exception(e)
+                # if the item does not exist get_metadata will raise an exceptions
+                # see if the exception message has 404, then continue, if not throw that exception
+                if exc['code'] == 404:
+                    temp = {}
+                else:
+                    raise e
         if temp.get("uuid"):
             uuids.append(temp.get("uuid"))
+            found[temp.get("uuid")] = temp
 
     # check if all existing identifiers point to the same object
     unique_uuids = list(set(uuids))
@@ -457,6 +1323,9 @@ def get_existing(post_json, connection):
         return {}
     # if everything is as expected
     elif len(unique_uuids) == 1:
+        # items from the bulk lookup are already the full object frame
+        if existing_items is not None:
+            return found[unique_uuids[0]]
         temp = ff_utils.get_metadata(unique_uuids[0], key=connection.key, add_on="frame=object")
         return temp
     # funky business not allowed, if identifiers point to different objects
@@ -467,6 +1336,56 @@ def get_existing(post_json, connection):
         return
 
 
+def _search_field_for_identifier(an_id):
+    """The search field an identifier can be looked up with - None if it can't be searched for."""
+    if re.match(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', an_id):
+        return 'uuid'
+    if re.match(r'^[A-Z0-9]{3}[A-Z]{2}[A-Z0-9]{7}$', an_id):
+        return 'accession'
+    if ':' in an_id and not an_id.startswith('/'):
+        return 'aliases'
+    return None
+
+
+def _batched_searches(by_field, connection, item_type='Item', chunk_size=50):
+    """Searches for the identifiers in by_field (search field -> identifiers) chunk_size at a time.
+    Yields (chunk of identifiers, items found) - items found is None if the search failed."""
+    for field, ids in by_field.items():
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            query = 'search/?type={}&frame=object&'.format(item_type) + '&'.join(
+                '{}={}'.format(field, quote(an_id, safe='')) for an_id in chunk)
+            try:
+                items = ff_utils.search_metadata(query, key=connection.key)
+            except Exception:
+                items = None
+            yield chunk, items
+
+
+def _item_identifiers(item):
+    return [an_id for an_id in [item.get('uuid'), item.get('accession'), item.get('@id')] + item.get('aliases', [])
+            if an_id]
+
+
+def get_existing_items(identifiers, connection, chunk_size=50):
+    """Looks up a batch of identifiers with a few searches instead of a GET for each of them.
+    Returns a dictionary of identifier -> existing item (frame=object) of the identifiers found.
+    The ones the searches don't find (not searchable, not indexed yet or hidden from search) are
+    left out for get_existing to fetch one by one, so they are not taken for new items.
+    """
+    existing_items = {}
+    by_field = {'uuid': [], 'accession': [], 'aliases': []}
+    for an_id in sorted(set(filter(None, identifiers))):
+        field = _search_field_for_identifier(an_id)
+        if field:
+            by_field[field].append(an_id)
+    for chunk, items in _batched_searches(by_field, connection, chunk_size=chunk_size):
+        for item in items or []:
+            for an_id in _item_identifiers(item):
+                existing_items[an_id] = item
+    return existing_items
+
+
 def get_f_type(field, fields2types):
     return fields2types.get(field, None)
 
@@ -480,9 +1399,75 @@ def add_to_mistype_message(item='', itype='', ftype='', msg=''):
     return msg + toadd + '- THE REQUIRED TYPE IS %s\n' % ftype
 
 
+def fetch_link_types(item, connection):
+    """Returns the @type of the item at path item, or of the error response if it can't be got."""
+    try:
+        res = ff_utils.get_metadata(item, key=connection.key, add_on="frame=object")
+    except Exception as problem:
+        res = parse_exception(problem)
+    return res.get('@type')
+
+
+class LinkCache(object):
+    """Run scoped cache of the @type of the items linked to from the workbook, so each distinct
+    link is only looked up once however many rows use it.  Links that were not found are cached
+    too, other errors are not.  The least recently used links are dropped beyond maxsize.
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._types = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_types(self, item, connection):
+        with self._lock:
+            if item in self._types:
+                self._types.move_to_end(item)
+                self.hits += 1
+                return self._types[item]
+            self.misses += 1
+        itemtypes = fetch_link_types(item, connection)
+        if itemtypes and ('Error' not in itemtypes or 'HTTPNotFound' in itemtypes):
+            self.add(item, itemtypes)
+        return itemtypes
+
+    def add(self, item, itemtypes):
+        with self._lock:
+            self._types[item] = itemtypes
+            self._types.move_to_end(item)
+            while len(self._types) > self.maxsize:
+                self._types.popitem(last=False)
+
+    def __len__(self):
+        return len(self._types)
+
+    def __contains__(self, item):
+        return item in self._types
+
+
+def get_link_types(item, connection):
+    """fetch_link_types that goes through the connection link_cache if it has one."""
+    link_cache = getattr(connection, 'link_cache', None)
+    if link_cache is None:
+        return fetch_link_types(item, connection)
+    return link_cache.get_types(item, connection)
+
+
+def _link_path(item, typeinfield):
+    """The path a link to item in a field of type Item:typeinfield is looked up at."""
+    # check for fully qualified path i.e. /labs/4dn-dcic-lab/
+    pattern = re.compile(r"/[\w-]+/\w")
+    if not item.startswith('/'):
+        item = '/' + item
+    match = pattern.match(item)
+    if match is None:
+        item = '/' + typeinfield + item
+    return item
+
+
 def validate_item(itemlist, typeinfield, alias_dict, connection):
     msg = ''
-    pattern = re.compile(r"/[\w-]+/\w")
     for item in itemlist:
         if item in alias_dict:
             itemtype = alias_dict[item]
@@ -490,18 +1475,8 @@ def validate_item(itemlist, typeinfield, alias_dict, connection):
                 # need special cases for FileSet and ExperimentSet?
                 msg = add_to_mistype_message(item, itemtype, typeinfield, msg)
         else:
-            # check for fully qualified path i.e. /labs/4dn-dcic-lab/
-            match = pattern.match(item)
-            if not item.startswith('/'):
-                item = '/' + item
-            match = pattern.match(item)
-            if match is None:
-                item = '/' + typeinfield + item
-            try:
-                res = ff_utils.get_metadata(item, key=connection.key, add_on="frame=object")
-            except Exception as problem:
-                res = parse_exception(problem)
-            itemtypes = res.get('@type')
+            item = _link_path(item, typeinfield)
+            itemtypes = get_link_types(item, connection)
             if itemtypes:
                 if typeinfield not in itemtypes:
                     msg = add_to_mistype_message(item, itemtypes[0], typeinfield, msg)
@@ -523,15 +1498,18 @@ def _convert_to_array(s, is_array):
     return [s.strip()]
 
 
-def validate_field(field_data, field_type, aliases_by_type, connection):
+def _field_values(field_data, field_type):
+    """Returns (field_type without embedding, is_array, formatted field_data) for validation."""
     to_trim = 'array of embedded objects, '
-    is_array = False
-    msg = None
     field_data = data_formatter(field_data, field_type)
     if field_type.startswith(to_trim):
         field_type = field_type.replace(to_trim, '')
-    if 'array' in field_type:
-        is_array = True
+    return field_type, 'array' in field_type, field_data
+
+
+def validate_field(field_data, field_type, aliases_by_type, connection):
+    msg = None
+    field_type, is_array, field_data = _field_values(field_data, field_type)
     if 'Item:' in field_type:
         _, itemtype = field_type.rsplit(':', 1)
         items = _convert_to_array(field_data, is_array)
@@ -544,8 +1522,8 @@ def validate_field(field_data, field_type, aliases_by_type, connection):
     return msg
 
 
-def pre_validate_json(post_json, fields2types, aliases_by_type, connection):
-    report = []
+def _fields_to_validate(post_json, fields2types):
+    """Yields (field data, field type) of the fields of post_json that pre_validate_json checks."""
     for field, field_data in post_json.items():
         # ignore commented out fields
         if field.startswith('#'):
@@ -557,13 +1535,57 @@ def pre_validate_json(post_json, fields2types, aliases_by_type, connection):
         # source_experiments and produced_from hold strings of aliases by design
         if field in ['aliases', 'produced_from', 'source_experiments']:
             continue
-        field_type = get_f_type(field, fields2types)
+        yield field_data, get_f_type(field, fields2types)
+
+
+def pre_validate_json(post_json, fields2types, aliases_by_type, connection):
+    report = []
+    for field_data, field_type in _fields_to_validate(post_json, fields2types):
         msg = validate_field(field_data, field_type, aliases_by_type, connection)
         if msg:
             report.append(msg)
     return report
 
 
+def sheet_links(rows, keys, fields2types, aliases_by_type):
+    """The links pre_validate_json will look up for the rows of a sheet (not workbook aliases).
+    Returns {link path: (linked identifier, required item type)}."""
+    links = {}
+    for _, values in rows:
+        post_json = OrderedDict(zip(keys, clean_row_values(values)))
+        for field_data, field_type in _fields_to_validate(post_json, fields2types):
+            field_type, is_array, field_data = _field_values(field_data, field_type)
+            if 'Item:' not in field_type:
+                continue
+            _, itemtype = field_type.rsplit(':', 1)
+            for item in _convert_to_array(field_data, is_array):
+                if item not in aliases_by_type:
+                    links[_link_path(item, itemtype)] = (item, itemtype)
+    return links
+
+
+def prefetch_link_types(links, connection, chunk_size=50):
+    """Fills the connection link_cache with the types of the links (see sheet_links) found with
+    a few searches per required item type.  Links that are not found by the searches (e.g. not
+    searchable identifiers, wrong type, not indexed yet) are left to be looked up one by one."""
+    link_cache = getattr(connection, 'link_cache', None)
+    if link_cache is None:
+        return
+    by_type = {}
+    for path, (item, itemtype) in links.items():
+        field = _search_field_for_identifier(item)
+        if field and path not in link_cache:
+            by_type.setdefault(itemtype, {}).setdefault(field, {}).setdefault(item, []).append(path)
+    for itemtype, by_field in sorted(by_type.items()):
+        paths = {item: item_paths for ids in by_field.values() for item, item_paths in ids.items()}
+        searches = {field: sorted(ids) for field, ids in by_field.items()}
+        for _, items in _batched_searches(searches, connection, item_type=itemtype, chunk_size=chunk_size):
+            for found in items or []:
+                for an_id in _item_identifiers(found):
+                    for path in paths.get(an_id, []):
+                        link_cache.add(path, found.get('@type'))
+
+
 def build_patch_json(fields, fields2types):
     """Create the data entry dictionary from the fields."""
     patch_data = {}
@@ -619,21 +1641,27 @@ def check_extra_file_meta(ef_info, seen_formats, existing_formats):
         sfilename = get_just_filename(filepath)
         ef_info['submitted_filename'] = sfilename
         if not ef_info.get('md5sum'):
-            ef_info['md5sum'] = md5(filepath)
+            with timed('md5'):
+                ef_info['md5sum'] = checksums.md5(filepath)
         if not ef_info.get('filesize'):
             ef_info['filesize'] = pp.Path(filepath).stat().st_size
     seen_formats.append(ef_format)
     return ef_info, seen_formats
 
 
-def populate_post_json(post_json, connection, sheet, attach_fields):  # , existing_data):
+def populate_post_json(post_json, connection, sheet, attach_fields, existing_items=None):
     """Get existing, add attachment, check for file and fix attribution."""
     # add attachments
+    attachment_cache = getattr(connection, 'attachment_cache', None)
     for af in attach_fields:
         if post_json.get(af):
-            attach = attachment(post_json[af])
+            if attachment_cache is None:
+                attach = attachment(post_json[af])
+            else:
+                attach = attachment_cache.get(post_json[af])
             post_json[af] = attach
-    existing_data = get_existing(post_json, connection)
+    with timed('get_existing'):
+        existing_data = get_existing(post_json, connection, existing_items)
     # Combine aliases
     if post_json.get('aliases') != ['*delete*']:
         if post_json.get('aliases') and existing_data.get('aliases'):
@@ -722,18 +1750,108 @@ def filter_set_from_exps(post_json):
     return post_json, rep_set_info, exp_set_info
 
 
-def filter_loadxl_fields(post_json, sheet):
-    """All fields from the list_of_loadxl_fields are taken out of post_json and accumulated in dictionary."""
+def filter_loadxl_fields(post_json, sheet, keep=()):
+    """All fields from the list_of_loadxl_fields are taken out of post_json and accumulated in dictionary.
+    The fields in keep are left in post_json - their links can be posted with the item."""
     patch_loadxl_item = {}
     for sheet_loadxl, fields_loadxl in list_of_loadxl_fields:
         if sheet == sheet_loadxl:
             for field_loadxl in fields_loadxl:
+                if field_loadxl in keep:
+                    continue
                 if post_json.get(field_loadxl):
                     patch_loadxl_item[field_loadxl] = post_json[field_loadxl]
                     del post_json[field_loadxl]
     return post_json, patch_loadxl_item
 
 
+def _strings_in(value):
+    """All the strings in value (a field of a built post_json)."""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return [string for v in value for string in _strings_in(v)]
+    return []
+
+
+def order_rows(rows, keys, fields2types, sheet, aliases_by_type):
+    """Orders the rows of a sheet so the loadxl fields (list_of_loadxl_fields) of a row can be posted
+    with it rather than patched in afterwards by loadxl_cycle.
+    A loadxl field can go with its row unless it links to an alias of a sheet loaded after this one
+    - links to rows of this sheet are posted after those rows, anything else (aliases of the sheets
+    loaded before, uuids, accessions) is already on the portal; rows are put in levels so each row
+    comes after the ones it links to.  Where rows link to each other in a cycle the field closing
+    the cycle is left to loadxl_cycle as before (as are fields linking to later sheets).
+    Returns (levels - lists of the rows to run one after the other, {row_num: {field: row_nums it
+    links to in this sheet}} for the fields that go with their row).
+    """
+    fields = [f for sheet_loadxl, fields_loadxl in list_of_loadxl_fields if sheet_loadxl == sheet
+              for f in fields_loadxl]
+    if not fields:
+        return [rows], {}
+    position = sheet_order.index(sheet) if sheet in sheet_order else len(sheet_order)
+    row_of_alias = {}
+    row_json = {}
+    for row_num, values in rows:
+        post_json = build_patch_json(OrderedDict(zip(keys, clean_row_values(values))), fields2types)
+        row_json[row_num] = post_json
+        for alias in post_json.get('aliases', []):
+            row_of_alias[alias] = row_num
+    inline = {}
+    for row_num, post_json in row_json.items():
+        inline[row_num] = {}
+        for field in fields:
+            needs = set()
+            for alias in _strings_in(post_json.get(field)):
+                linked = aliases_by_type.get(alias)
+                if alias in row_of_alias:
+                    needs.add(row_of_alias[alias])
+                elif linked is not None and (linked not in sheet_order or sheet_order.index(linked) >= position):
+                    needs = None
+                    break
+            if needs is not None and row_num not in needs:
+                inline[row_num][field] = needs
+    # break the cycles - a depth first search in row order leaves the field of a row that links
+    # back to a row it was reached from to loadxl_cycle
+    state = {}
+    for first in inline:
+        if first in state:
+            continue
+        state[first] = 'open'
+        stack = [(first, iter(list(inline[first].items())))]
+        while stack:
+            row_num, links = stack[-1]
+            for field, needs in links:
+                if field not in inline[row_num]:
+                    continue
+                if any(state.get(r) == 'open' for r in needs):
+                    del inline[row_num][field]
+                    continue
+                unseen = [r for r in sorted(needs) if r not in state]
+                if unseen:
+                    state[unseen[0]] = 'open'
+                    stack.append((unseen[0], iter(list(inline[unseen[0]].items()))))
+                    # come back to this field once the rest of its rows are done
+                    stack[-2] = (row_num, itertools.chain([(field, needs)], links))
+                    break
+            else:
+                state[row_num] = 'done'
+                stack.pop()
+    # group the rows in levels that only link to rows of earlier levels
+    levels = []
+    placed = set()
+    remaining = [row_num for row_num, _ in rows]
+    while remaining:
+        level = [r for r in remaining if all(needs <= placed for needs in inline[r].values())]
+        levels.append(level)
+        placed.update(level)
+        remaining = [r for r in remaining if r not in placed]
+    by_num = dict(rows)
+    return [[(r, by_num[r]) for r in level] for level in levels], inline
+
+
 def combine_set(post_json, existing_data, sheet, accumulate_dict):
     """Combine experiment related information form dictionaries with existing information."""
     # find all identifiers from exisiting set item to match the one used in experiments sheet
@@ -831,87 +1949,189 @@ def error_report(error_dic, sheet, all_aliases, connection, error_id=''):
         return
 
 
+@attr.s
+class ConflictReport(object):
+    """The unique key conflicts of a failed POST or PATCH as (field, value) pairs.  Each is shown with
+    the @id of the item that already has the value once resolve_conflicts has looked them up,
+    conflicts it could not find (the item is not viewable by the user) are to be taken up with DCIC."""
+    sheet = attr.ib()
+    conflicts = attr.ib(factory=list)
+    at_ids = attr.ib(factory=dict)
+
+    @classmethod
+    def from_error(cls, error_dic, sheet):
+        """The ConflictReport of error_dic - None if it is not a conflict error that can be read."""
+        if error_dic.get('title') != "Conflict":
+            return None
+        try:
+            # list is reported as string, turned into list again
+            conflict_list = ast.literal_eval(error_dic.get('detail').replace("Keys conflict:", "").strip())
+            return cls(sheet, [(str(key).split(":")[-1], value) for key, value in conflict_list])
+        except Exception:
+            return None
+
+    def lines(self):
+        lines = []
+        for field, value in self.conflicts:
+            at_id = self.at_ids.get((field, value))
+            add_text = "please use " + at_id if at_id else "please contact DCIC"
+            lines.append("{sheet:<30}Field '{er}': '{des}' already exists, {at}"
+                         .format(er=field, des=value, sheet="ERROR " + self.sheet.lower(), at=add_text))
+        return lines
+
+    def __str__(self):
+        return '\n'.join(self.lines())
+
+
+# unique keys that are searched for with a different field
+CONFLICT_SEARCH_FIELDS = {'alias': 'aliases'}
+
+
+def resolve_conflicts(reports, connection, chunk_size=50):
+    """Looks up the items that already have the conflicting values of the ConflictReports with a
+    search for each sheet and field, chunk_size values at a time, instead of one for each conflict."""
+    to_find = {}
+    for report in reports:
+        for field, value in report.conflicts:
+            search_field = CONFLICT_SEARCH_FIELDS.get(field, field)
+            values = to_find.setdefault(report.sheet, {}).setdefault(search_field, [])
+            if str(value) not in values:
+                values.append(str(value))
+    found = {}
+    for sheet, by_field in to_find.items():
+        for search_field, values in by_field.items():
+            for _, items in _batched_searches({search_field: values}, connection, sheet, chunk_size):
+                for item in items or []:
+                    item_values = item.get(search_field)
+                    if not isinstance(item_values, list):
+                        item_values = [item_values]
+                    for item_value in item_values:
+                        found[(sheet, search_field, str(item_value))] = item.get('@id')
+    for report in reports:
+        for field, value in report.conflicts:
+            report.at_ids[(field, value)] = found.get(
+                (report.sheet, CONFLICT_SEARCH_FIELDS.get(field, field), str(value)))
+
+
 def conflict_error_report(error_dic, sheet, connection):
-    # I am not sure of the complete case of HTTPConflicts
-    # To make sure we get all cases reported, I put a try/except
-    all_conflicts = []
-    try:
-        # list is reported as string, turned into list again
-        conflict_str = error_dic.get('detail').replace("Keys conflict:", "").strip()
-        conflict_list = ast.literal_eval(conflict_str)
-        for conflict in conflict_list:
-            error_field = conflict[0].split(":")[1]
-            error_value = conflict[1]
-            try:
-                # let's see if the user has access to conflicting item
-                search = "search/?type={sheet}&{field}={value}".format(sheet=sheet,
-                                                                       field=error_field,
-                                                                       value=error_value)
-                existing_item = ff_utils.search_metadata(search, key=connection.key)
-                at_id = existing_item.get('@id')
-                add_text = "please use " + at_id
-            except Exception:
-                # if there is a conflicting item, but it is not viewable by the user,
-                # we should release the item to the project/public
-                add_text = "please contact DCIC"
-            conflict_rep = ("{sheet:<30}Field '{er}': '{des}' already exists, {at}"
-                            .format(er=error_field, des=error_value, sheet="ERROR " + sheet.lower(), at=add_text))
-        all_conflicts.append(conflict_rep)
-        return all_conflicts
-    except Exception:
+    report = ConflictReport.from_error(error_dic, sheet)
+    if report is None:
         return
+    resolve_conflicts([report], connection)
+    return report.lines()
 
 
 def update_item(verb, file_to_upload, post_json, filename_to_post, extrafiles, connection, identifier):
     # if FTP, grab the file from ftp
-    ftp_download = False
-    if file_to_upload and filename_to_post.startswith("ftp://"):
-        ftp_download = True
-        file_to_upload, post_json, filename_to_post = ftp_copy(filename_to_post, post_json)
-    # add the md5
-    if file_to_upload and not post_json.get('md5sum'):
-        print(f"calculating md5 sum for file {filename_to_post} ")
-        post_json['md5sum'] = md5(filename_to_post)
+    if file_to_upload and s3_uploader.pipe_remote and filename_to_post.startswith(('ftp://', 'http://', 'https://')):
+        # streamed straight to S3 - the md5 is checked, or calculated, on the way
+        return submit_item(verb, file_to_upload, post_json, filename_to_post, extrafiles, connection, identifier,
+                           pipe_from=filename_to_post)
+    if not (file_to_upload and filename_to_post.startswith("ftp://")):
+        return submit_item(verb, file_to_upload, post_json, filename_to_post, extrafiles, connection, identifier)
+    ftp_download = filename_to_post
+    file_to_upload, post_json, filename_to_post = ftp_copy(filename_to_post, post_json)
     try:
-        if verb == 'PATCH':
-            e = ff_utils.patch_metadata(post_json, identifier, key=connection.key)
-        elif verb == 'POST':
-            e = ff_utils.post_metadata(post_json, identifier, key=connection.key)
+        return submit_item(verb, file_to_upload, post_json, filename_to_post, extrafiles, connection, identifier)
+    finally:
+        # the local copy goes however the submission ended, making room for the next download
+        if file_to_upload and not downloads.forget(ftp_download):
+            pp.Path(filename_to_post).unlink(missing_ok=True)
+
+
+def submit_item(verb, file_to_upload, post_json, filename_to_post, extrafiles, connection, identifier,
+                pipe_from=None):
+    """Posts or patches the item and uploads its file (from filename_to_post, or streamed from the
+    url pipe_from) and extra files."""
+    # add the md5
+    hasher = None
+    if file_to_upload and not pipe_from and not post_json.get('md5sum'):
+        md5sum = checksums.cached(filename_to_post)
+        if md5sum is None and checksums.on_upload:
+            # read the file only once - the md5 is patched in once the upload is done
+            print(f"md5 sum for file {filename_to_post} will be calculated during upload")
+            hasher = hashlib.md5()
         else:
-            raise ValueError('Unrecognized verb - must be POST or PATCH')
+            if md5sum is None:
+                print(f"calculating md5 sum for file {filename_to_post} ")
+                with timed('md5'):
+                    md5sum = checksums.md5(filename_to_post)
+            post_json['md5sum'] = md5sum
+    try:
+        with timed('submit'):
+            e = submit_metadata(verb, post_json, identifier, connection)
     except Exception as problem:
         e = parse_exception(problem)
     if e.get('status') == 'error':
         return e
+    if not (file_to_upload or extrafiles):
+        return e
+    item = e['@graph'][0]
+    accession = item.get('accession')
+    upload_credentials = get_upload_credentials(connection)
+    if verb == 'POST':
+        # the credentials come with the new item
+        upload_credentials.remember(accession, item.get('upload_credentials'))
+        upload_credentials.remember(accession, item.get('extra_files_creds'), extra=True)
     if file_to_upload:
         # get s3 credentials
         if verb == 'PATCH':
-            creds = get_upload_creds(e['@graph'][0]['accession'], connection)
-            e['@graph'][0]['upload_credentials'] = creds
+            item['upload_credentials'] = upload_credentials.get(accession, connection)
         # upload
-        upload_file_item(e, filename_to_post)
-        if ftp_download:
-            pp.Path(filename_to_post).unlink()
+        with timed('upload'), upload_credentials.keep_fresh(accession, connection):
+            if pipe_from:
+                uploaded_md5 = pipe_file_item(e, pipe_from, connection, post_json.get('md5sum'))
+            else:
+                upload_file_item(e, filename_to_post, connection, hasher)
+                uploaded_md5 = hasher.hexdigest() if hasher is not None else None
+        if uploaded_md5 and not post_json.get('md5sum'):
+            if hasher is not None:
+                checksums.remember(filename_to_post, uploaded_md5)
+            error = patch_uploaded_md5(e, uploaded_md5, connection)
+            if error is not None:
+                return error
     if extrafiles:
-        extcreds = e['@graph'][0].get('extra_file_creds')
-        if not extcreds or (
-            datetime.datetime.strptime(extcreds.get('upload_credentials').get('Expiration'), "%Y-%m-%d %H:%M:%S%z")
-            .replace(tzinfo=None) < datetime.datetime.now()
-        ):
-            extcreds = get_upload_creds(e['@graph'][0]['accession'], connection, extfilecreds=True)
+        extcreds = upload_credentials.get(accession, connection, extra=True)
+        extra_uploads = []
         for fformat, filepath in extrafiles.items():
             try:
                 file_format = ff_utils.get_metadata(fformat, key=connection.key)
                 ff_uuid = file_format.get('uuid')
             except Exception:
-                raise "Can't find file_format item for %s" % fformat
+                raise Exception("Can't find file_format item for %s" % fformat)
             for ecred in extcreds:
                 if ff_uuid == ecred.get('file_format'):
-                    upload_creds = ecred.get('upload_credentials')
-                    upload_extra_file(upload_creds, filepath)
+                    ecreds = ecred.get('upload_credentials')
+                    refresh_creds = upload_credentials.refresher(accession, connection, ecreds, extra=True,
+                                                                 upload_url=ecreds.get('upload_url'))
+                    extra_uploads.append((ecreds, filepath, refresh_creds))
+        # the extra files of an item are uploaded together
+        with timed('upload'), upload_credentials.keep_fresh(accession, connection, extra=True):
+            s3_uploader.upload_many(extra_uploads, upload_extra_file)
     return e
 
 
+def patch_uploaded_md5(metadata_post_response, md5sum, connection):
+    """Patches md5sum into the file item uploaded without one.  If the portal refuses it (e.g. the md5
+    is that of another file) the upload is removed again and the item marked as 'upload failed', so
+    it is uploaded again on the next run - the error is returned like that of a failed post or patch."""
+    item = metadata_post_response['@graph'][0]
+    try:
+        with timed('submit'):
+            ff_utils.patch_metadata({'md5sum': md5sum}, item['uuid'], key=connection.key)
+        return None
+    except Exception as problem:
+        error = parse_exception(problem)
+    try:
+        item_creds = _item_upload_creds(metadata_post_response, connection)
+        if item_creds is not None:
+            s3_uploader.remove(*item_creds)
+        ff_utils.patch_metadata({'status': 'upload failed'}, item['uuid'], key=connection.key)
+    except Exception as problem:
+        print("WARNING: the upload of {} could not be cleaned up - {}".format(item.get('accession'), problem))
+    return error
+
+
 def patch_item(file_to_upload, post_json, filename_to_post, extrafiles, connection, existing_data):
     return update_item('PATCH', file_to_upload, post_json, filename_to_post, extrafiles,
                        connection, existing_data.get('uuid'))
@@ -928,6 +2148,9 @@ def ftp_copy(filename_to_post, post_json):
         print("\nWARNING: File not uploaded")
         print("Please add original md5 values of the files")
         return False, post_json, ""
+    prefetched = downloads.local(filename_to_post)
+    if prefetched is not None:
+        return True, post_json, prefetched
     try:
         # download the file from the server
         # return new file location to upload from
@@ -944,13 +2167,15 @@ def ftp_copy(filename_to_post, post_json):
         return False, post_json, ""
 
 
+def fields_to_delete(post_json):
+    """The fields of post_json with the value '*delete*'."""
+    return [key for key, value in post_json.items() if value in ['*delete*', ['*delete*']]]
+
+
 def delete_fields(post_json, connection, existing_data):
     """Deletes fields with the value '*delete*'."""
     # find fields to be removed
-    fields_to_be_removed = []
-    for key, value in post_json.items():
-        if value in ['*delete*', ['*delete*']]:
-            fields_to_be_removed.append(key)
+    fields_to_be_removed = fields_to_delete(post_json)
     # if there are no delete fields, move along sir
     if not fields_to_be_removed:
         return post_json
@@ -1096,99 +2321,269 @@ def check_file_pairing(fastq_row):
     return _pairing_consistency_check(files, errors)
 
 
-def workbook_reader(workbook, sheet, update, connection, patchall, aliases_by_type,
-                    dict_patch_loadxl, dict_replicates, dict_exp_sets, novalidate, attach_fields):
-    """takes an openpyxl workbook object and posts, patches or does a dry run on the data depending
-    on the options passed in.
+class SubmissionReport(object):
+    """Writes a JSON line for each row submitted (and each loadxl patch and workflow run)
+    to path - nothing is written until it is opened with a path."""
+    def __init__(self, path=None):
+        self._file = None
+        self._lock = threading.Lock()
+        self.open(path)
+
+    def open(self, path):
+        self.close()
+        if path:
+            self._file = open(path, 'w')
+
+    def add(self, **record):
+        if self._file is None:
+            return
+        with self._lock:
+            self._file.write(json.dumps(record, default=str) + '\n')
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# shared by all the sheets of a run - main opens it with --report
+submission_report = SubmissionReport()
+
+
+class RunProfile(object):
+    """Timers for the main phases of a run and the number and latency of the requests made to the
+    portal by kind (GET, POST, PATCH, search...).  Nothing is recorded until it is enabled; the
+    requests are timed by a request hook around the request functions dcicutils.ff_utils uses.
     """
-    # determine right from the top if dry run
+    # upper bounds in seconds of the request latency histogram buckets
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = OrderedDict()
+        self.requests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        request_hooks.install(self, self._timed_request)
+
+    def disable(self):
+        self.enabled = False
+        request_hooks.uninstall(self)
+
+    def _timed_request(self, verb, request_fxn):
+        def timed_request(url, *args, **kwargs):
+            start = time.time()
+            try:
+                return request_fxn(url, *args, **kwargs)
+            finally:
+                self.add_request('search' if '/search/' in url else verb, time.time() - start)
+        return timed_request
+
+    @staticmethod
+    def _add(stats, name, seconds):
+        stat = stats.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+        stat['count'] += 1
+        stat['seconds'] += seconds
+        stat['max'] = max(stat['max'], seconds)
+        return stat
+
+    @contextmanager
+    def phase(self, name):
+        """Adds the time spent in the block to phase name."""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start)
+
+    def add_phase(self, name, seconds):
+        if self.enabled:
+            with self._lock:
+                self._add(self.phases, name, seconds)
+
+    def add_request(self, kind, seconds):
+        with self._lock:
+            stat = self._add(self.requests, kind, seconds)
+            histogram = stat.setdefault('histogram', [0] * len(self.BUCKETS))
+            histogram[next(i for i, bound in enumerate(self.BUCKETS) if seconds <= bound)] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {'phases': dict(self.phases), 'requests': dict(self.requests),
+                    'buckets': [str(bound) for bound in self.BUCKETS]}
+
+    def report(self):
+        """Returns the breakdown as printable lines."""
+        lines = ["PROFILE (phases can include each other)",
+                 "{:<40}{:>8}{:>12}{:>10}".format('phase', 'calls', 'seconds', 'max')]
+        for name, stat in self.phases.items():
+            lines.append("{:<40}{count:>8}{seconds:>12.2f}{max:>10.2f}".format(name, **stat))
+        bucket_names = ['<' + ('{:g}'.format(bound) if bound != float('inf') else 'inf') for bound in self.BUCKETS]
+        lines.append("{:<10}{:>8}{:>10}{:>8}".format('request', 'calls', 'seconds', 'mean') +
+                     ''.join('{:>7}'.format(b) for b in bucket_names))
+        for kind, stat in self.requests.items():
+            lines.append("{:<10}{:>8}{:>10.2f}{:>8.3f}".format(kind, stat['count'], stat['seconds'],
+                                                               stat['seconds'] / stat['count']) +
+                         ''.join('{:>7}'.format(n) for n in stat['histogram']))
+        return lines
+
+
+# shared by the whole run - main enables it with --profile
+profiler = RunProfile()
+_row_timings = threading.local()
+
+
+@contextmanager
+def recording_timings(timings):
+    """Collects the phases timed on this thread while in the block into timings (a Counter)."""
+    previous = getattr(_row_timings, 'current', None)
+    _row_timings.current = timings
+    try:
+        yield timings
+    finally:
+        _row_timings.current = previous
+
+
+@contextmanager
+def timed(phase):
+    """Adds the seconds spent in the block to phase of the timings being recorded, if any."""
+    timings = getattr(_row_timings, 'current', None)
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        if timings is not None:
+            timings[phase] += seconds
+        # the run profile gets the totals over all the rows
+        profiler.add_phase('rows: ' + phase, seconds)
+
+
+def _report_error(messages):
+    return '\n'.join(str(m) for m in messages) or None
+
+
+@attr.s
+class RowResult(object):
+    """What happened to a single workbook row - applied to the sheet totals in row order."""
+    row = attr.ib()
+    counts = attr.ib(factory=Counter)
+    messages = attr.ib(factory=list)
+    pre_validate_errors = attr.ib(factory=list)
+    item = attr.ib(default=None)
+    patch_loadxl_item = attr.ib(factory=dict)
+    rep_set_info = attr.ib(factory=list)
+    exp_set_info = attr.ib(factory=list)
+    alias = attr.ib(default=None)
+    uuid = attr.ib(default=None)
+    timings = attr.ib(factory=Counter)
+
+    @property
+    def action(self):
+        for action in ['error', 'post', 'patch']:
+            if self.counts[action]:
+                return action
+        return 'skip'
+
+
+# the rows of a sheet whose md5 sums, links and existing items are looked up together
+LOOKAHEAD_ROWS = 1000
+
+
+def map_rows(row_fxn, rows, workers=1):
+    """Calls row_fxn on each row and yields the results in row order.
+    With more than one worker the rows are run in a bounded thread pool - only a
+    few rows per worker are in flight at once so memory does not grow with the sheet.
+    """
+    if workers <= 1:
+        for a_row in rows:
+            yield row_fxn(a_row)
+        return
+    window = workers * 2
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for a_row in rows:
+            pending.append(pool.submit(in_current_sheet(row_fxn), a_row))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def clean_row_values(values):
+    """strip trailing commas and spaces from the str values of a row"""
+    clean_values = []
+    for item in values:
+        try:
+            clean_values.append(item.strip(', '))
+        except AttributeError:
+            clean_values.append(item)
+    return clean_values
+
+
+def sheet_identifiers(rows, keys, fields2types):
+    """All the identifiers used for the items of a sheet, from (row number, values) pairs."""
+    identifiers = []
+    for _, values in rows:
+        post_json = build_patch_json(OrderedDict(zip(keys, clean_row_values(values))), fields2types)
+        identifiers.extend(_all_identifiers(post_json))
+    return identifiers
+
+
+def submit_row(row_num, values, keys, fields2types, sheet, update, patchall, connection, aliases_by_type,
+               dict_replicates, dict_exp_sets, novalidate, attach_fields, skip_dryrun=False, set_lock=None,
+               existing_items=None, inline_fields=(), defer_conflicts=False):
+    """Validates, builds and submits (or simulates submission of) a single row.
+    Nothing is printed or added to the accumulating dictionaries from here (apart from the
+    set combination that needs them) so that rows can run in parallel - the returned RowResult
+    is applied by workbook_reader in row order.
+    The loadxl fields in inline_fields are posted with the item instead of being left for loadxl_cycle.
+    With defer_conflicts conflict errors are added to the messages as ConflictReports, for the items
+    they conflict with to be looked up together with those of the other rows (resolve_conflicts).
+    """
+    result = RowResult(row_num)
     dryrun = not (update or patchall)
     all_aliases = [k for k in aliases_by_type]
-    # dict for acumulating cycle patch data
-    patch_loadxl = []
-    row = reader(workbook, sheetname=sheet)
-    skip_dryrun = False
-    if sheet == "ExperimentMic_Path":
-        skip_dryrun = True
-        sheet = "ExperimentMic"
-    keys = next(row)  # grab the first row of headers
-    types = next(row)  # grab second row with type info
-    # remove title column
-    keys.pop(0)
-    types.pop(0)
-    fields2types = dict(zip(keys, types))
-    # set counters to 0
-    total = 0
-    error = 0
-    post = 0
-    patch = 0
-    not_patched = 0
-    not_posted = 0
-    pre_validate_errors = []
-    invalid = False
-
-    if sheet == "FileFastq" and not novalidate:
-        # check for consistent file pairing of fastqs in the sheet
-        pair_errs = check_file_pairing(reader(workbook, sheetname=sheet))
-        for f, err in sorted(pair_errs.items()):
-            for e in err:
-                print('WARNING: ', f, '\t', e)
+    # build post_json and get existing if available
+    post_json = OrderedDict(zip(keys, clean_row_values(values)))
+    result.alias = str(post_json.get('aliases') or '').split(',')[0].strip() or None
 
-    # iterate over the rows
-    for values in row:
-        # Rows that start with # are skipped
-        if values[0].startswith("#"):
-            continue
-        # Get rid of the first empty cell
-        values.pop(0)
-        total += 1
-        clean_values = []
-        for item in values:
-            try:
-                # strip trailing commas and spaces if a str
-                clean_values.append(item.strip(', '))
-            except AttributeError:
-                clean_values.append(item)
-        # build post_json and get existing if available
-        post_json = OrderedDict(zip(keys, clean_values))
-        # Get existing data if available
-        # existing_data = get_existing(post_json, connection)
-
-        # pre-validate the row by fields and data_types
-        if not novalidate:
+    # pre-validate the row by fields and data_types
+    if not novalidate:
+        with timed('validation'):
             row_errors = pre_validate_json(post_json, fields2types, aliases_by_type, connection)
-            if row_errors:
-                error += 1
-                pre_validate_errors.extend(row_errors)
-                invalid = True
-                continue
+        if row_errors:
+            result.counts['error'] += 1
+            result.pre_validate_errors.extend(row_errors)
+            return result
 
-        # if we get this far continue to build the json
-        post_json = build_patch_json(post_json, fields2types)
-
-        # # validate the row by fields and data_types
-        # if not novalidate:
-        #     row_errors = pre_validate_json(post_json, fields2types, aliases_by_type, connection)
-        #     if row_errors:
-        #         error += 1
-        #         pre_validate_errors.extend(row_errors)
-        #         invalid = True
-        #         continue
-        filename_to_post = post_json.get('filename')
-        post_json, existing_data, file_to_upload, extrafiles = populate_post_json(
-            post_json, connection, sheet, attach_fields)
+    # if we get this far continue to build the json
+    post_json = build_patch_json(post_json, fields2types)
+    filename_to_post = post_json.get('filename')
+    post_json, existing_data, file_to_upload, extrafiles = populate_post_json(
+        post_json, connection, sheet, attach_fields, existing_items)
+    # the downloaded copies of the attachments are not needed once the row is done, submitted or not
+    attached = downloaded_attachments(post_json)
+    try:
+        result.uuid = existing_data.get('uuid')
         # Filter loadxl fields
-        post_json, patch_loadxl_item = filter_loadxl_fields(post_json, sheet)
+        post_json, result.patch_loadxl_item = filter_loadxl_fields(post_json, sheet, keep=inline_fields)
         # Filter experiment set related fields from experiment
         if sheet.startswith('Experiment') and not sheet.startswith('ExperimentSet'):
-            post_json, rep_set_info, exp_set_info = filter_set_from_exps(post_json)
+            post_json, result.rep_set_info, result.exp_set_info = filter_set_from_exps(post_json)
         # Combine set items with stored dictionaries
         # Adds things to the existing items, will be a problem at some point
         # We need a way to delete some from the parent object
-        if sheet == 'ExperimentSet':
-            post_json, dict_exp_sets = combine_set(post_json, existing_data, sheet, dict_exp_sets)
-        if sheet == 'ExperimentSetReplicate':
-            post_json, dict_replicates = combine_set(post_json, existing_data, sheet, dict_replicates)
+        if sheet in ['ExperimentSet', 'ExperimentSetReplicate']:
+            accumulate_dict = dict_exp_sets if sheet == 'ExperimentSet' else dict_replicates
+            with set_lock or nullcontext():
+                post_json, _ = combine_set(post_json, existing_data, sheet, accumulate_dict)
 
         # Run update or patchall
         e = {}
@@ -1200,7 +2595,7 @@ def workbook_reader(workbook, sheet, update, connection, patchall, aliases_by_ty
                 # Do the patch
                 e = patch_item(file_to_upload, post_json, filename_to_post, extrafiles, connection, existing_data)
             else:
-                not_patched += 1
+                result.counts['not_patched'] += 1
         # if there is no existing item try posting
         else:
             if update:
@@ -1209,7 +2604,7 @@ def workbook_reader(workbook, sheet, update, connection, patchall, aliases_by_ty
                 # Do the post
                 e = post_item(file_to_upload, post_json, filename_to_post, extrafiles, connection, sheet)
             else:
-                not_posted += 1
+                result.counts['not_posted'] += 1
 
         # add to success/error counters
         if e.get("status") == "error":  # pragma: no cover
@@ -1217,38 +2612,41 @@ def workbook_reader(workbook, sheet, update, connection, patchall, aliases_by_ty
             e_id = ""
             if post_json.get('aliases'):
                 e_id = post_json['aliases'][0]
-            error_rep = error_report(e, sheet, all_aliases, connection, e_id)
-            error += 1
+            error_rep = ((defer_conflicts and ConflictReport.from_error(e, sheet)) or
+                         error_report(e, sheet, all_aliases, connection, e_id))
+            result.counts['error'] += 1
             if error_rep:
                 # TODO: move this report formatting to error_report
                 if e.get('detail') and e.get('detail').startswith("Keys conflict: [('alias', 'md5:"):
-                    print("Upload failure - md5 of file matches another item in database.")
-                print(error_rep)
+                    result.messages.append("Upload failure - md5 of file matches another item in database.")
+                result.messages.append(error_rep)
             # if error is a weird one
             else:
-                print(e)
+                result.messages.append(e)
         elif e.get("status") == "success":
             if existing_data.get("uuid"):
-                patch += 1
+                result.counts['patch'] += 1
             else:
-                post += 1
+                result.counts['post'] += 1
 
         # dryrun option
         if dryrun:
             if skip_dryrun:
-                continue
+                return result
             # simulate patch/post
             if existing_data.get("uuid"):
                 post_json = remove_deleted(post_json)
                 try:
-                    e = ff_utils.patch_metadata(post_json, existing_data["uuid"], key=connection.key,
-                                                add_on="check_only=True")
+                    with timed('submit'):
+                        e = submit_metadata('PATCH', post_json, existing_data["uuid"], connection,
+                                            add_on="check_only=True")
                 except Exception as problem:
                     e = parse_exception(problem)
             else:
                 post_json = remove_deleted(post_json)
                 try:
-                    e = ff_utils.post_metadata(post_json, sheet, key=connection.key, add_on="check_only=True")
+                    with timed('submit'):
+                        e = submit_metadata('POST', post_json, sheet, connection, add_on="check_only=True")
                 except Exception as problem:
                     e = parse_exception(problem)
             # check simulation status
@@ -1259,38 +2657,193 @@ def workbook_reader(workbook, sheet, update, connection, patchall, aliases_by_ty
                 e_id = ""
                 if post_json.get('aliases'):
                     e_id = post_json['aliases'][0]
-                error_rep = error_report(e, sheet, all_aliases, connection, e_id)
+                error_rep = ((defer_conflicts and ConflictReport.from_error(e, sheet)) or
+                             error_report(e, sheet, all_aliases, connection, e_id))
                 if error_rep:
-                    error += 1
-                    print(error_rep)
-            continue
+                    result.counts['error'] += 1
+                    result.messages.append(error_rep)
+            return result
 
-        # check status and if success fill transient storage dictionaries
+        # keep the posted/patched item for filling the transient storage dictionaries
         if e.get("status") == "success":
+            result.item = e['@graph'][0]
+            result.uuid = result.item.get('uuid')
+        return result
+    finally:
+        release_attachments(attached)
+
+
+def workbook_reader(workbook, sheet, update, connection, patchall, aliases_by_type,
+                    dict_patch_loadxl, dict_replicates, dict_exp_sets, novalidate, attach_fields, workers=1,
+                    batch_lookup=False, dryrun_workers=None):
+    """takes an openpyxl workbook object and posts, patches or does a dry run on the data depending
+    on the options passed in.
+    With workers > 1 the rows of the sheet are submitted concurrently, but their results are
+    still collected in row order so the reports and accumulated set/loadxl info are unchanged.
+    With batch_lookup the existing items are looked up ahead of the rows, LOOKAHEAD_ROWS at a time,
+    with a few searches instead of one or more GETs per row.
+    A dry run does not change anything on the portal, so if dryrun_workers is given its check_only
+    requests are sent for up to that many rows at a time instead of workers.
+    """
+    # determine right from the top if dry run
+    dryrun = not (update or patchall)
+    if dryrun and dryrun_workers:
+        workers = dryrun_workers
+    # dict for acumulating cycle patch data
+    patch_loadxl = []
+    row = reader(workbook, sheetname=sheet)
+    skip_dryrun = False
+    if sheet == "ExperimentMic_Path":
+        skip_dryrun = True
+        sheet = "ExperimentMic"
+    keys = next(row)  # grab the first row of headers
+    types = next(row)  # grab second row with type info
+    # remove title column
+    keys.pop(0)
+    types.pop(0)
+    fields2types = dict(zip(keys, types))
+    # set counters to 0
+    counts = Counter()
+    total = 0
+    pre_validate_errors = []
+    invalid = False
+
+    if sheet == "FileFastq" and not novalidate:
+        # check for consistent file pairing of fastqs in the sheet
+        pair_errs = check_file_pairing(reader(workbook, sheetname=sheet))
+        for f, err in sorted(pair_errs.items()):
+            for e in err:
+                print('WARNING: ', f, '\t', e)
+
+    def data_rows():
+        # excel row numbers - the first two rows were the headers
+        for row_num, values in enumerate(row, start=3):
+            # Rows that start with # are skipped
+            if values[0].startswith("#"):
+                continue
+            # Get rid of the first empty cell
+            values.pop(0)
+            yield row_num, values
+
+    hash_files = checksums.workers and any(k == 'filename' or k.startswith('extra_files') for k in keys)
+    prefetch_links = not novalidate and getattr(connection, 'link_cache', None) is not None
+    existing_items = {} if batch_lookup else None
+
+    def looked_ahead(rows):
+        # what the rows need is looked up LOOKAHEAD_ROWS rows at a time, so only that many rows are
+        # held in memory for it
+        while True:
+            chunk = list(itertools.islice(rows, LOOKAHEAD_ROWS))
+            if not chunk:
+                return
+            if hash_files:
+                # start hashing the files of the rows while they are being submitted
+                # a dry run only needs the md5 of the extra files
+                checksums.prefetch(file_paths_to_hash(chunk, keys, extra_files_only=dryrun))
+            if prefetch_links:
+                # look up the links of the rows with a few searches before validating them one by one
+                prefetch_link_types(sheet_links(chunk, keys, fields2types, aliases_by_type), connection)
+            if batch_lookup:
+                existing_items.update(get_existing_items(sheet_identifiers(chunk, keys, fields2types), connection))
+            yield from chunk
+
+    rows = looked_ahead(data_rows())
+    set_lock = threading.Lock()
+    # rows whose links to other rows of the sheet can be posted with them come after those rows - that
+    # needs all of the sheet at once, so the links of a streamed sheet are left to loadxl_cycle
+    levels, inline = [rows], {}
+    if any(s == sheet for s, _ in list_of_loadxl_fields) and not is_streamed(workbook):
+        levels, inline = order_rows(list(rows), keys, fields2types, sheet, aliases_by_type)
+    # rows that failed or are not posted / patched in this mode (e.g. new rows with only --patchall)
+    failed_rows = set()
+
+    def run_row(numbered_values):
+        row_num, values = numbered_values
+        # a link to a row that is not on the portal is left to loadxl_cycle
+        inline_fields = [f for f, needs in inline.get(row_num, {}).items() if not needs & failed_rows]
+        with recording_timings(Counter()) as timings, timed('total'):
+            result = submit_row(row_num, values, keys, fields2types, sheet, update, patchall, connection,
+                                aliases_by_type, dict_replicates, dict_exp_sets, novalidate, attach_fields,
+                                skip_dryrun=skip_dryrun, set_lock=set_lock, existing_items=existing_items,
+                                inline_fields=inline_fields, defer_conflicts=True)
+        result.timings.update(timings)
+        if result.counts['error'] or result.counts['not_posted'] or result.counts['not_patched']:
+            failed_rows.add(row_num)
+        return result
+
+    def row_results():
+        if len(levels) == 1:
+            for result in map_rows(run_row, levels[0], workers):
+                yield result
+            return
+        # each level is only started once the rows of the one before are done - the results
+        # are still reported in row order, those of the levels done before a row raised as well
+        results, error = [], None
+        try:
+            for level in levels:
+                results.extend(map_rows(run_row, level, workers))
+        except Exception as e:
+            error = e
+        for result in sorted(results, key=lambda result: result.row):
+            yield result
+        if error is not None:
+            raise error
+
+    def report_row(result):
+        for msg in result.messages:
+            print(msg)
+        submission_report.add(stage='rows', sheet=sheet, row=result.row, alias=result.alias,
+                              action=result.action, uuid=result.uuid, dryrun=dryrun,
+                              error=_report_error(result.messages + result.pre_validate_errors),
+                              timings=dict(result.timings))
+
+    # rows with conflict errors, and the rows after them, are reported at the end of the sheet once
+    # the items the conflicting values belong to have been looked up together - or as soon as a row
+    # raises, so the rows already submitted are never lost from the output and the report
+    held = []
+    try:
+        # iterate over the rows
+        for result in row_results():
+            total += 1
+            counts.update(result.counts)
+            if held or any(isinstance(msg, ConflictReport) for msg in result.messages):
+                held.append(result)
+            else:
+                report_row(result)
+            if result.pre_validate_errors:
+                pre_validate_errors.extend(result.pre_validate_errors)
+                invalid = True
+            # check status and if success fill transient storage dictionaries
+            if result.item is None:
+                continue
             # uuid of the posted/patched item
-            item_uuid = e['@graph'][0]['uuid']
-            item_id = e['@graph'][0]['@id']
+            item_uuid = result.item['uuid']
+            item_id = result.item['@id']
             # if post/patch successful, append uuid to patch_loadxl_item if full
-            if patch_loadxl_item != {}:
-                patch_loadxl_item['uuid'] = item_uuid
-                patch_loadxl.append(patch_loadxl_item)
+            if result.patch_loadxl_item != {}:
+                result.patch_loadxl_item['uuid'] = item_uuid
+                patch_loadxl.append(result.patch_loadxl_item)
             # if post/patch successful, add the replicate/set information to the accumulate lists
             if sheet.startswith('Experiment') and not sheet.startswith('ExperimentSet'):
                 # Part-I Replicates
-                if rep_set_info:
-                    rep_id = rep_set_info[0]
-                    saveitem = {'replicate_exp': item_id, 'bio_rep_no': rep_set_info[1], 'tec_rep_no': rep_set_info[2]}
-                    if dict_replicates.get(rep_id):
-                        dict_replicates[rep_id].append(saveitem)
-                    else:
-                        dict_replicates[rep_id] = [saveitem, ]
+                if result.rep_set_info:
+                    rep_id = result.rep_set_info[0]
+                    saveitem = {'replicate_exp': item_id, 'bio_rep_no': result.rep_set_info[1],
+                                'tec_rep_no': result.rep_set_info[2]}
+                    # setdefault as experiment sheets may be loaded at the same time (--sheet-workers)
+                    dict_replicates.setdefault(rep_id, []).append(saveitem)
                     # Part-II Experiment Sets
-                if exp_set_info:
-                    for exp_set in exp_set_info:
-                        if dict_exp_sets.get(exp_set):
-                            dict_exp_sets[exp_set].append(item_id)
-                        else:
-                            dict_exp_sets[exp_set] = [item_id, ]
+                if result.exp_set_info:
+                    for exp_set in result.exp_set_info:
+                        dict_exp_sets.setdefault(exp_set, []).append(item_id)
+    finally:
+        if held:
+            try:
+                resolve_conflicts([msg for result in held for msg in result.messages
+                                   if isinstance(msg, ConflictReport)], connection)
+            finally:
+                for result in held:
+                    report_row(result)
 
     # add all object loadxl patches to dictionary
     if patch_loadxl and not invalid:
@@ -1299,6 +2852,11 @@ def workbook_reader(workbook, sheet, update, connection, patchall, aliases_by_ty
     if pre_validate_errors:
         for le in pre_validate_errors:
             print(le)
+    post = counts['post']
+    patch = counts['patch']
+    not_posted = counts['not_posted']
+    not_patched = counts['not_patched']
+    error = counts['error']
     # dryrun report
     if dryrun:
         if skip_dryrun:
@@ -1399,34 +2957,46 @@ def user_workflow_reader(workbook, sheet, connection):
     post = 0
     not_posted = 0
     # iterate over the rows
-    for values in row:
+    for row_num, values in enumerate(row, start=3):
         # Rows that start with # are skipped
         if values[0].startswith("#"):
             continue
         # Get rid of the first empty cell
         values.pop(0)
         total += 1
-        # build post_json and get existing if available
-        post_json = build_tibanna_json(keys, types, values, connection)
-        existing_data = get_existing(post_json['wfr_meta'], connection)
-        if existing_data:
-            print('this workflow_run is already posted {}'.format(post_json['wfr_meta']['aliases'][0]))
-            error += 1
-            continue
-        if post_json:
-            # do the magic
-            try:
-                e = ff_utils.post_metadata(post_json, '/WorkflowRun/pseudo-run', key=connection.key)
-            except Exception as problem:
-                e = parse_exception(problem)
-            if e.get("status") == "SUCCEEDED":
-                post += 1
+        timings = Counter()
+        problem_text = None
+        with recording_timings(timings):
+            # build post_json and get existing if available
+            post_json = build_tibanna_json(keys, types, values, connection)
+            with timed('get_existing'):
+                existing_data = get_existing(post_json['wfr_meta'], connection)
+            if existing_data:
+                problem_text = 'this workflow_run is already posted {}'.format(post_json['wfr_meta']['aliases'][0])
+                print(problem_text)
+                error += 1
+            elif post_json:
+                # do the magic
+                try:
+                    with timed('submit'):
+                        e = ff_utils.post_metadata(post_json, '/WorkflowRun/pseudo-run', key=connection.key)
+                except Exception as problem:
+                    e = parse_exception(problem)
+                if e.get("status") == "SUCCEEDED":
+                    post += 1
+                else:
+                    problem_text = 'can not post the workflow run {}'.format(post_json['wfr_meta']['aliases'][0])
+                    print(problem_text)
+                    print(e)  # to give a little more info even if not that informative
+                    problem_text += '\n' + str(e)
+                    error += 1
             else:
-                print('can not post the workflow run {}'.format(post_json['wfr_meta']['aliases'][0]))
-                print(e)  # to give a little more info even if not that informative
+                problem_text = 'nothing to post'
                 error += 1
-        else:
-            error += 1
+        submission_report.add(stage='workflow', sheet=sheet, row=row_num,
+                              alias=(post_json.get('wfr_meta', {}).get('aliases') or [None])[0],
+                              action='error' if problem_text else 'post', uuid=None, dryrun=False,
+                              error=problem_text, timings=dict(timings))
     # print final report
     print("{sheet:<27}: {post:>2} posted /{not_posted:>2} not posted  \
     {patch:>2} patched /{not_patched:>2} not patched,{error:>2} errors"
@@ -1447,58 +3017,535 @@ def get_upload_creds(file_id, connection, extfilecreds=False):  # pragma: no cov
     return req['@graph'][0][creds2return]
 
 
-def upload_file_item(metadata_post_response, path):
+def creds_expiration(creds):
+    """The Expiration of upload credentials as a unix timestamp, or None if it is missing or unreadable."""
+    try:
+        expiration = creds['Expiration']
+        try:
+            expires = datetime.datetime.fromisoformat(expiration.replace('Z', '+00:00'))
+        except ValueError:
+            expires = datetime.datetime.strptime(expiration, "%Y-%m-%d %H:%M:%S%z")
+    except (TypeError, KeyError, AttributeError, ValueError):
+        return None
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=datetime.timezone.utc)
+    return expires.timestamp()
+
+
+class UploadCredentials(object):
+    """Run scoped store of the upload credentials of file items by accession, for both the file
+    itself and its extra files (the extra_files_creds list).  Credentials from the POST of an item
+    are kept, and new ones are only fetched from the /upload/ endpoint when there are none yet, the
+    ones an upload is using were refused, or they expire within margin seconds.  While the files
+    of an item are uploading (keep_fresh) its credentials are renewed in the background ahead of
+    their expiry, so a long upload picks up new ones without waiting on the portal.
+    The margin is at most margin_fraction of the lifetime of the credentials and they are not
+    renewed again within min_interval seconds, so short lived ones aren't fetched over and over.
+    """
+    def __init__(self, margin=20 * 60, margin_fraction=0.25, min_interval=60):
+        self.margin = margin
+        self.margin_fraction = margin_fraction
+        self.min_interval = min_interval
+        self.fetched = 0
+        self._creds = {}
+        self._expires = {}
+        self._lifetimes = {}
+        self._obtained = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _item_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _pick(creds, extra=False, upload_url=None):
+        """The credentials going to upload_url out of the extra_files_creds of an item."""
+        if not extra:
+            return creds
+        for ecred in creds or []:
+            if ecred.get('upload_credentials', {}).get('upload_url') == upload_url:
+                return ecred['upload_credentials']
+        return None
+
+    def remember(self, accession, creds, extra=False):
+        if not accession or not creds:
+            return
+        entries = [ecred.get('upload_credentials') for ecred in creds] if extra else [creds]
+        expires = [creds_expiration(entry) for entry in entries]
+        expires = min([e for e in expires if e is not None], default=None)
+        now = time.time()
+        with self._lock:
+            self._creds[(accession, extra)] = creds
+            self._expires[(accession, extra)] = expires
+            self._lifetimes[(accession, extra)] = None if expires is None else max(0, expires - now)
+            self._obtained[(accession, extra)] = now
+
+    def _margin(self, key):
+        """margin, but at most margin_fraction of the lifetime of the credentials of key"""
+        lifetime = self._lifetimes.get(key)
+        if lifetime is None:
+            return self.margin
+        return min(self.margin, lifetime * self.margin_fraction)
+
+    def _renew_at(self, key):
+        """When the credentials of key are due to be renewed, or None if they don't expire."""
+        expires = self._expires.get(key)
+        if expires is None:
+            return None
+        return max(expires - self._margin(key), self._obtained.get(key, 0) + self.min_interval)
+
+    def expiring(self, accession, extra=False):
+        """True if the credentials of accession are due to be renewed - they expire within the margin
+        and were not obtained within the last min_interval seconds."""
+        renew_at = self._renew_at((accession, extra))
+        return renew_at is not None and renew_at <= time.time()
+
+    def _fetch(self, accession, connection, extra=False):
+        creds = get_upload_creds(accession, connection, extfilecreds=extra)
+        self.fetched += 1
+        self.remember(accession, creds, extra)
+        return creds
+
+    def get(self, accession, connection, extra=False):
+        """The credentials of accession (the extra_files_creds list with extra) - only fetched if
+        there are none yet or they are about to expire."""
+        with self._item_lock((accession, extra)):
+            creds = self._creds.get((accession, extra))
+            if creds is None or self.expiring(accession, extra):
+                creds = self._fetch(accession, connection, extra)
+            return creds
+
+    def refresher(self, accession, connection, creds=None, extra=False, upload_url=None):
+        """Returns a function that gets new credentials for an upload that started with creds -
+        the ones renewed in the background if there are any, or else new ones from the portal.
+        For extra files the credentials going to upload_url are picked out."""
+        last = [creds]
+
+        def refresh():
+            with self._item_lock((accession, extra)):
+                current = self._pick(self._creds.get((accession, extra)), extra, upload_url)
+                if current is None or current is last[0] or self.expiring(accession, extra):
+                    current = self._pick(self._fetch(accession, connection, extra), extra, upload_url)
+            if current is None:
+                raise Exception("No upload credentials for {} in the extra files of {}".format(upload_url, accession))
+            last[0] = current
+            return current
+        return refresh
+
+    @contextmanager
+    def keep_fresh(self, accession, connection, extra=False):
+        """Renews the credentials of accession ahead of their expiry until the block ends."""
+        stop = threading.Event()
+
+        def renew():
+            while True:
+                renew_at = self._renew_at((accession, extra))
+                if renew_at is None or stop.wait(max(0, renew_at - time.time())):
+                    return
+                with self._item_lock((accession, extra)):
+                    if not self.expiring(accession, extra):
+                        continue
+                    try:
+                        self._fetch(accession, connection, extra)
+                    except Exception as e:
+                        print("Could not renew the upload credentials of {} - {}".format(accession, e))
+                        return
+
+        thread = threading.Thread(target=in_current_sheet(renew), daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+
+
+def get_upload_credentials(connection):
+    """The UploadCredentials of the run, or a new one just for the caller if the connection has none."""
+    upload_credentials = getattr(connection, 'upload_credentials', None)
+    return upload_credentials if upload_credentials is not None else UploadCredentials()
+
+
+def _item_upload_creds(metadata_post_response, connection=None):
+    """(upload credentials, refresher) of the file item posted or None."""
     try:
         item = metadata_post_response['@graph'][0]
         creds = item['upload_credentials']
     except Exception as e:
         print(e)
-        return
-    upload_file(creds, path)
+        return None
+    refresh_creds = None
+    if connection is not None and item.get('accession'):
+        refresh_creds = get_upload_credentials(connection).refresher(item['accession'], connection, creds)
+    return creds, refresh_creds
 
 
-def upload_extra_file(ecreds, path):
-    upload_file(ecreds, path)
+def upload_file_item(metadata_post_response, path, connection=None, hasher=None):
+    item_creds = _item_upload_creds(metadata_post_response, connection)
+    if item_creds is not None:
+        creds, refresh_creds = item_creds
+        upload_file(creds, path, refresh_creds, hasher=hasher)
 
 
-def upload_file(creds, path):  # pragma: no cover
+def pipe_file_item(metadata_post_response, url, connection=None, md5sum=None):
+    """Streams url straight into the upload of the file item - returns the md5 of what was sent."""
+    item_creds = _item_upload_creds(metadata_post_response, connection)
+    if item_creds is not None:
+        creds, refresh_creds = item_creds
+        return s3_uploader.upload_stream(creds, refresh_creds, url, md5sum)
 
-    ####################
-    # POST file to S3
-    env = os.environ.copy()  # pragma: no cover
-    try:
-        env.update({
-            'AWS_ACCESS_KEY_ID': creds['AccessKeyId'],
-            'AWS_SECRET_ACCESS_KEY': creds['SecretAccessKey'],
-            'AWS_SECURITY_TOKEN': creds['SessionToken'],
-        })
-    except Exception as e:
-        raise Exception(f"Didn't get back s3 access keys from file/upload endpoint.  Error was {e}")
-    # ~10s/GB from Stanford - AWS Oregon
-    # ~12-15s/GB from AWS Ireland - AWS Oregon
-    print("Uploading file.")
-    start = time.time()
-    path_object = pp.Path(path).expanduser()
-    try:
-        source = path_object
-        target = creds['upload_url']
-        print("Going to upload {} to {}.".format(source, target))
-        command = ['aws', 's3', 'cp']
-        command = command + ['--only-show-errors', source, target]
-        options = {}
-        if running_on_windows_native():
-            options = {"shell": True}
-        subprocess.check_call(command, env=env, **options)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError("Upload failed with exit code %d" % e.returncode)
-    else:
-        end = time.time()
-        duration = end - start
-        print("Uploaded in %.2f seconds" % duration)
 
+def upload_extra_file(ecreds, path, refresh_creds=None):
+    upload_file(ecreds, path, refresh_creds)
+
+
+class UploadJournal(object):
+    """SQLite record of the multipart uploads in progress - the upload id, part size and the
+    ETag of every part that made it to S3 - so a failed upload can be picked up where it stopped.
+    Uploads are found again by their S3 bucket and key, which stay the same for a file item
+    across runs, and are only resumed if the local file has not changed since.
+    """
+    DEFAULT_PATH = '.submit4dn_uploads.sqlite'
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # only create the journal file once a file is big enough to need it
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS uploads (
+                                bucket TEXT, key TEXT, path TEXT, size INTEGER, mtime REAL,
+                                upload_id TEXT, part_size INTEGER, started REAL,
+                                PRIMARY KEY (bucket, key))''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS parts (
+                                upload_id TEXT, part_number INTEGER, etag TEXT,
+                                PRIMARY KEY (upload_id, part_number))''')
+            self._db.commit()
+        return self._db
+
+    def _run(self, sql, params=()):
+        with self._lock:
+            db = self._connect()
+            rows = db.execute(sql, params).fetchall()
+            db.commit()
+        return rows
+
+    def find(self, bucket, key):
+        """Returns a dict of the upload in progress to bucket/key or None."""
+        rows = self._run('SELECT path, size, mtime, upload_id, part_size FROM uploads WHERE bucket = ? AND key = ?',
+                         (bucket, key))
+        if not rows:
+            return None
+        return dict(zip(['path', 'size', 'mtime', 'upload_id', 'part_size'], rows[0]))
+
+    def start(self, bucket, key, path, size, mtime, upload_id, part_size):
+        self._run('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                  (bucket, key, str(path), size, mtime, upload_id, part_size, time.time()))
+
+    def parts(self, upload_id):
+        """Returns {part_number: etag} for the parts of upload_id already on S3."""
+        rows = self._run('SELECT part_number, etag FROM parts WHERE upload_id = ?', (upload_id,))
+        return dict(rows)
+
+    def add_part(self, upload_id, part_number, etag):
+        self._run('INSERT OR REPLACE INTO parts VALUES (?, ?, ?)', (upload_id, part_number, etag))
+
+    def forget(self, bucket, key):
+        entry = self.find(bucket, key)
+        if entry:
+            self._run('DELETE FROM parts WHERE upload_id = ?', (entry['upload_id'],))
+            self._run('DELETE FROM uploads WHERE bucket = ? AND key = ?', (bucket, key))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class UploadProgress(object):
+    """boto3 transfer callback that prints how far an upload has got every 10%."""
+    def __init__(self, path, size):
+        self.name = pp.Path(path).name
+        self.size = size
+        self.seen = 0
+        self.reported = 0
+        self._lock = threading.Lock()
+        # boto3 calls back from threads of its own
+        self.sheet = current_sheet.get()
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.seen += bytes_amount
+            if not self.size:
+                return
+            percent = int(self.seen * 100 / self.size) // 10 * 10
+            if percent > self.reported:
+                self.reported = percent
+                print_progress("  {}: {}% of {:.1f} MB".format(self.name, percent, self.size / MB), self.sheet)
+
+
+class HashingReader(object):
+    """Read only wrapper of a file object that feeds everything read to hasher.  It has no seek
+    so boto3 reads it once from start to end."""
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+
+class _Provider(CredentialProvider):
+    """Hands the refreshable upload credentials of an S3Uploader client to botocore."""
+    METHOD = 'submit4dn-upload-credentials'
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    def load(self):
+        return self.credentials
+
+
+class S3Uploader(object):
+    """Uploads files to S3 in process with boto3 using the upload_credentials from the portal.
+    part_size (bytes) and concurrency tune the multipart transfer of each file and max_files
+    caps how many files are being transferred at the same time across all rows.
+    With a journal (UploadJournal) files larger than part_size are uploaded part by part and a
+    rerun after a failure only sends the parts that are missing.
+    endpoint_url points the uploads at an S3 compatible server rather than AWS.
+    With pipe_remote files given as ftp or http(s) urls are streamed from there into S3 (upload_stream)
+    instead of being downloaded first.
+    """
+    # S3 limit on the number of parts of a multipart upload
+    MAX_PARTS = 10000
+    EXPIRED_CODES = ('ExpiredToken', 'ExpiredTokenException', 'TokenRefreshRequired', 'RequestExpired')
+
+    def __init__(self, part_size=64 * MB, concurrency=10, max_files=4, journal=None, endpoint_url=None,
+                 pipe_remote=False):
+        self.configure(part_size, concurrency, max_files, journal, endpoint_url, pipe_remote)
+
+    def configure(self, part_size=64 * MB, concurrency=10, max_files=4, journal=None, endpoint_url=None,
+                  pipe_remote=False):
+        self.part_size = part_size
+        self.pipe_remote = pipe_remote
+        self.concurrency = concurrency
+        self.max_files = max_files
+        self.journal = journal
+        self.endpoint_url = endpoint_url
+        self.config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                                     max_concurrency=concurrency, use_threads=True)
+        self._slots = threading.BoundedSemaphore(max_files)
+
+    def client(self, creds, refresh_creds=None):
+        """An S3 client using creds.  With refresh_creds, and creds that say when they expire, boto3
+        calls refresh_creds for new credentials shortly before they do."""
+        kwargs = {}
+        if self.endpoint_url:
+            kwargs = {'endpoint_url': self.endpoint_url, 'region_name': 'us-east-1',
+                      'config': BotoConfig(s3={'addressing_style': 'path'})}
+        if refresh_creds is not None and creds_expiration(creds) is not None:
+            credentials = RefreshableCredentials.create_from_metadata(
+                self._credentials_metadata(creds), lambda: self._credentials_metadata(refresh_creds()),
+                'submit4dn-upload-credentials')
+            session = botocore.session.get_session()
+            session.register_component('credential_provider', CredentialResolver([_Provider(credentials)]))
+            return boto3.Session(botocore_session=session).client('s3', **kwargs)
+        return boto3.client('s3', aws_access_key_id=creds['AccessKeyId'],
+                            aws_secret_access_key=creds['SecretAccessKey'],
+                            aws_session_token=creds['SessionToken'], **kwargs)
+
+    @staticmethod
+    def _credentials_metadata(creds):
+        expires = datetime.datetime.fromtimestamp(creds_expiration(creds), datetime.timezone.utc)
+        return {'access_key': creds['AccessKeyId'], 'secret_key': creds['SecretAccessKey'],
+                'token': creds['SessionToken'], 'expiry_time': expires.isoformat()}
+
+    def upload(self, creds, path, refresh_creds=None, hasher=None):
+        """Uploads path to the upload_url of creds.  refresh_creds is called without arguments
+        for new credentials if they expire part way through a resumable upload.  hasher (e.g.
+        hashlib.md5()) is updated with the content of the file as it is read for the upload."""
+        try:
+            client = self.client(creds, refresh_creds)
+            bucket, key = creds['upload_url'].replace('s3://', '', 1).split('/', 1)
+        except Exception as e:
+            raise Exception(f"Didn't get back s3 access keys from file/upload endpoint.  Error was {e}")
+        # ~10s/GB from Stanford - AWS Oregon
+        # ~12-15s/GB from AWS Ireland - AWS Oregon
+        path_object = pp.Path(path).expanduser()
+        size = path_object.stat().st_size
+        with self._slots:
+            print("Uploading file.")
+            print("Going to upload {} to {}.".format(path_object, creds['upload_url']))
+            start = time.time()
+            try:
+                if self.journal is not None and size > self.part_size:
+                    self.resumable_upload(client, bucket, key, path_object, refresh_creds, hasher)
+                elif hasher is not None:
+                    with open(path_object, 'rb') as f:
+                        client.upload_fileobj(HashingReader(f, hasher), bucket, key, Config=self.config,
+                                              Callback=UploadProgress(path_object, size))
+                else:
+                    client.upload_file(str(path_object), bucket, key, Config=self.config,
+                                       Callback=UploadProgress(path_object, size))
+            except (BotoCoreError, ClientError, S3UploadFailedError) as e:
+                raise RuntimeError("Upload failed - {}".format(e))
+        print("Uploaded in %.2f seconds" % (time.time() - start))
+
+    def upload_stream(self, creds, refresh_creds=None, url=None, md5sum=None):
+        """Streams the ftp or http(s) url into the upload_url of creds as it is read, without a local
+        copy.  Returns the md5 of the content - if it is not md5sum the upload is removed again."""
+        try:
+            client = self.client(creds, refresh_creds)
+            bucket, key = creds['upload_url'].replace('s3://', '', 1).split('/', 1)
+        except Exception as e:
+            raise Exception(f"Didn't get back s3 access keys from file/upload endpoint.  Error was {e}")
+        hasher = hashlib.md5()
+        with self._slots:
+            print("Uploading file.")
+            print("Going to stream {} to {}.".format(url, creds['upload_url']))
+            start = time.time()
+            try:
+                with remote_source(url) as (source, size):
+                    config = self.config
+                    if size and size / self.part_size > self.MAX_PARTS:
+                        part_size = math.ceil(size / self.MAX_PARTS)
+                        config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                                                max_concurrency=self.concurrency, use_threads=True)
+                    client.upload_fileobj(HashingReader(source, hasher), bucket, key, Config=config,
+                                          Callback=UploadProgress(url, size))
+            except (BotoCoreError, ClientError, S3UploadFailedError, OSError) as e:
+                raise RuntimeError("Upload failed - {}".format(e))
+            if md5sum and hasher.hexdigest() != md5sum:
+                error = "Upload failed - the md5 sum of {} is {} not {}".format(url, hasher.hexdigest(), md5sum)
+                try:
+                    client.delete_object(Bucket=bucket, Key=key)
+                except (BotoCoreError, ClientError) as e:
+                    error += " and the upload could not be removed - {}".format(e)
+                raise RuntimeError(error)
+        print("Uploaded in %.2f seconds" % (time.time() - start))
+        return hasher.hexdigest()
+
+    def remove(self, creds, refresh_creds=None):
+        """Deletes what was uploaded to the upload_url of creds."""
+        try:
+            client = self.client(creds, refresh_creds)
+            bucket, key = creds['upload_url'].replace('s3://', '', 1).split('/', 1)
+            client.delete_object(Bucket=bucket, Key=key)
+        except (BotoCoreError, ClientError, KeyError) as e:
+            raise RuntimeError("The upload to {} could not be removed - {}".format(creds.get('upload_url'), e))
+
+    def _find_resumable(self, client, bucket, key, path, stat):
+        """Returns (upload_id, part_size, done parts) of an upload of path that can be carried on
+        with or None - any outdated upload to the same key is aborted and dropped from the journal."""
+        entry = self.journal.find(bucket, key)
+        if not entry:
+            return None
+        if (entry['path'], entry['size'], entry['mtime']) == (str(path), stat.st_size, stat.st_mtime):
+            try:
+                client.list_parts(Bucket=bucket, Key=key, UploadId=entry['upload_id'], MaxParts=1)
+                return entry['upload_id'], entry['part_size'], self.journal.parts(entry['upload_id'])
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+                    raise
+        else:
+            print("{} has changed since the last upload attempt - starting again".format(path.name))
+            try:
+                client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=entry['upload_id'])
+            except ClientError:
+                pass
+        self.journal.forget(bucket, key)
+        return None
+
+    def resumable_upload(self, client, bucket, key, path, refresh_creds=None, hasher=None):
+        stat = path.stat()
+        resume = self._find_resumable(client, bucket, key, path, stat)
+        if resume:
+            upload_id, part_size, done = resume
+            print("Resuming upload of {} - {} parts already uploaded".format(path.name, len(done)))
+        else:
+            part_size = max(self.part_size, math.ceil(stat.st_size / self.MAX_PARTS))
+            upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+            self.journal.start(bucket, key, path, stat.st_size, stat.st_mtime, upload_id, part_size)
+            done = {}
+        total_parts = max(1, math.ceil(stat.st_size / part_size))
+        progress = UploadProgress(path, stat.st_size)
+        progress(sum(min(part_size, stat.st_size - (n - 1) * part_size) for n in done))
+        # clients are swapped for one with new credentials by whichever part sees them expire first
+        current = {'client': client}
+        refresh_lock = threading.Lock()
+
+        def call(method, **kwargs):
+            used = current['client']
+            try:
+                return getattr(used, method)(**kwargs)
+            except ClientError as e:
+                if refresh_creds is None or e.response.get('Error', {}).get('Code') not in self.EXPIRED_CODES:
+                    raise
+            with refresh_lock:
+                if current['client'] is used:
+                    print("Upload credentials expired - getting new ones")
+                    current['client'] = self.client(refresh_creds(), refresh_creds)
+            return getattr(current['client'], method)(**kwargs)
+
+        slots = threading.BoundedSemaphore(max(1, self.concurrency))
+
+        def send_part(part_number, body):
+            try:
+                resp = call('upload_part', Bucket=bucket, Key=key, UploadId=upload_id,
+                            PartNumber=part_number, Body=body)
+                self.journal.add_part(upload_id, part_number, resp['ETag'])
+                progress(len(body))
+            finally:
+                slots.release()
+
+        # parts are read in order here (so hasher sees the whole file once) and sent by the pool -
+        # at most concurrency parts are waiting in memory
+        sends = []
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as pool, open(path, 'rb') as f:
+            for part_number in range(1, total_parts + 1):
+                if part_number in done and hasher is None:
+                    continue
+                f.seek((part_number - 1) * part_size)
+                if part_number in done:
+                    hasher.update(f.read(part_size))
+                    continue
+                slots.acquire()
+                body = f.read(part_size)
+                if hasher is not None:
+                    hasher.update(body)
+                sends.append(pool.submit(in_current_sheet(send_part), part_number, body))
+            for sent in sends:
+                sent.result()
+        parts = self.journal.parts(upload_id)
+        call('complete_multipart_upload', Bucket=bucket, Key=key, UploadId=upload_id,
+             MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': parts[n]} for n in sorted(parts)]})
+        self.journal.forget(bucket, key)
+
+    def upload_many(self, uploads, upload_fxn=None):
+        """Runs upload_fxn (default upload) on each (creds, path[, refresh_creds]) in uploads,
+        max_files at a time."""
+        upload_fxn = upload_fxn or self.upload
+        if len(uploads) <= 1 or self.max_files <= 1:
+            for upload in uploads:
+                upload_fxn(*upload)
+            return
+        with ThreadPoolExecutor(max_workers=self.max_files) as pool:
+            for done in [pool.submit(in_current_sheet(upload_fxn), *upload) for upload in uploads]:
+                done.result()
 
-def running_on_windows_native():
-    return os.name == 'nt'
+
+# shared by all the uploads of a run - main configures it from the options
+s3_uploader = S3Uploader()
+
+
+def upload_file(creds, path, refresh_creds=None, hasher=None):  # pragma: no cover
+    s3_uploader.upload(creds, path, refresh_creds, hasher)
 
 
 # the order to try to upload / update the items
@@ -1520,25 +3567,208 @@ def order_sorter(list_of_names):
     return ret_list
 
 
-def loadxl_cycle(patch_list, connection, alias_dict):
+def _link_targets(field_type, sheets, subtypes=None):
+    """The sheets holding items of the Item: types of field_type - abstract types also match
+    their sub types in subtypes (see get_subtypes)."""
+    if 'Item:' not in field_type:
+        return []
+    subtypes = subtypes or {}
+    targets = set()
+    for linked in field_type.split('Item:', 1)[1].split(' or '):
+        targets.add(linked.strip())
+        targets.update(subtypes.get(linked.strip(), []))
+    return [sheet for sheet in sheets if sheet.replace('_Path', '') in targets]
+
+
+def sheet_dependencies(workbook, sheets, aliases_by_type, subtypes=None):
+    """Returns {sheet: set of the sheets that have to be loaded before it}.
+    A sheet depends on the sheets whose item types (or their sub types in subtypes) its Item: columns
+    link to and on the sheets of the aliases it actually uses in them.  Only links to sheets earlier in sheets (sheet_order)
+    count - the ones going the other way are patched in later by loadxl_cycle as before - so the
+    result is always acyclic.  Experiment set sheets also wait for all the experiment sheets as
+    they are made from them, and ExperimentMic_Path for ExperimentMic.
+    """
+    position = {sheet: i for i, sheet in enumerate(sheets)}
+    dependencies = {}
+    for sheet in sheets:
+        needs = set()
+        dependencies[sheet] = needs
+        if sheet not in workbook:
+            continue
+        rows = reader(workbook, sheetname=sheet)
+        next(rows)  # field names
+        types = next(rows)[1:]
+        link_cols = [i for i, t in enumerate(types) if 'Item:' in str(t)]
+        for i in link_cols:
+            needs.update(_link_targets(str(types[i]), sheets, subtypes))
+        for values in rows:
+            if str(values[0]).startswith('#'):
+                continue
+            for i in link_cols:
+                for alias in str(values[i + 1]).split(','):
+                    linked = aliases_by_type.get(alias.strip())
+                    if linked in position:
+                        needs.add(linked)
+        if sheet.startswith('ExperimentSet'):
+            needs.update(s for s in sheets if s.startswith('Experiment') and not s.startswith('ExperimentSet'))
+        if sheet == 'ExperimentMic_Path':
+            needs.add('ExperimentMic')
+        dependencies[sheet] = set(s for s in needs if position[s] < position[sheet])
+    return dependencies
+
+
+# (sheet name, buffer) of the sheet the code running is loading while sheets are loaded concurrently
+# - set for the thread of the sheet and passed on to the threads it starts for its rows and uploads
+current_sheet = contextvars.ContextVar('current_sheet', default=None)
+
+
+def in_current_sheet(fxn):
+    """fxn to be run in another thread as part of the sheet being loaded (if any)."""
+    return functools.partial(contextvars.copy_context().run, fxn)
+
+
+class SheetOutput(object):
+    """Stands in for sys.stdout while sheets are loaded concurrently: what is printed for a sheet,
+    by its thread or the row and upload threads it starts (current_sheet), is kept and printed in
+    one piece when the sheet is done, so the reports don't get mixed up.  Progress lines (live) go
+    straight through marked with their sheet, as does output from any other thread.
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def capture(self, sheet):
+        buffer = io.StringIO()
+        token = current_sheet.set((sheet, buffer))
+        try:
+            yield
+        finally:
+            current_sheet.reset(token)
+            with self._lock:
+                self.stdout.write(buffer.getvalue())
+                self.stdout.flush()
+
+    def live(self, text, sheet=None):
+        with self._lock:
+            self.stdout.write(text if sheet is None else '[{}] {}'.format(sheet, text))
+            self.stdout.flush()
+
+    def write(self, text):
+        sheet = current_sheet.get()
+        if sheet is None:
+            with self._lock:
+                return self.stdout.write(text)
+        return sheet[1].write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+def print_progress(text, sheet=None):
+    """Prints a progress line as it happens rather than with the rest of the output of its sheet.
+    sheet is the current_sheet of the code it reports on, for callbacks run by other threads."""
+    sheet = sheet or current_sheet.get()
+    if sheet is not None and isinstance(sys.stdout, SheetOutput):
+        sys.stdout.live(text + '\n', sheet[0])
+    else:
+        print(text)
+
+
+def run_sheets(sheets, dependencies, load_sheet, workers=1):
+    """Calls load_sheet(sheet) for each of sheets once the sheets it depends on are done,
+    up to workers at a time.  Sheets that are ready at the same time are started in the order
+    of sheets.  If a sheet fails no more are started and the error is raised once the running
+    ones are done.
+    """
+    if workers <= 1:
+        for sheet in sheets:
+            load_sheet(sheet)
+        return
+    output = SheetOutput(sys.stdout)
+
+    def run(sheet):
+        with output.capture(sheet):
+            load_sheet(sheet)
+
+    waiting = list(sheets)
+    done = set()
+    running = {}
+    error = None
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while waiting or running:
+                if error is None:
+                    for sheet in [s for s in waiting if dependencies.get(s, set()) <= done]:
+                        if len(running) >= workers:
+                            break
+                        waiting.remove(sheet)
+                        running[pool.submit(run, sheet)] = sheet
+                else:
+                    waiting = []
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done.add(running.pop(future))
+                    if future.exception() is not None and error is None:
+                        error = future.exception()
+    finally:
+        sys.stdout = output.stdout
+    if error is not None:
+        raise error
+    if waiting:  # pragma: no cover
+        raise ValueError("Sheets {} depend on sheets that are not loaded".format(', '.join(waiting)))
+
+
+def loadxl_patch(entry, sheet, connection, alias_dict):
+    """Patches the loadxl fields of one item - fields to be deleted are removed with the
+    delete_fields parameter of the same request.  Returns (error report or None, record for
+    the submission report)."""
+    to_delete = fields_to_delete(entry)
+    entry = {k: v for k, v in entry.items() if k not in to_delete}
+    add_on = 'delete_fields=' + ','.join(to_delete) if to_delete else ''
+    start = time.time()
+    try:
+        e = ff_utils.patch_metadata(entry, entry["uuid"], key=connection.key, add_on=add_on)
+    except Exception as problem:
+        e = parse_exception(problem)
+    timings = {'submit': time.time() - start}
+    error_rep = None
+    if e.get("status") == "error":  # pragma: no cover
+        error_rep = error_report(e, sheet.upper(), [k for k in alias_dict], connection) or e
+    record = dict(stage='loadxl', sheet=sheet, row=None, alias=None,
+                  action='error' if e.get("status") == "error" else 'patch',
+                  uuid=entry["uuid"], dryrun=False, error=_report_error([error_rep] if error_rep else []),
+                  timings=timings)
+    return error_rep, record
+
+
+def loadxl_cycle(patch_list, connection, alias_dict, workers=1):
+    """Patches in the fields left out of the posts (phase 2), one request per item.
+    With more than one worker the items of all the sheets are patched that many at a time, the
+    output is still printed sheet by sheet in order."""
+    entries = [(n, entry) for n in patch_list.keys() for entry in patch_list[n]]
+    totals = Counter(n for n, _ in entries)
+    done = Counter()
+
+    def patch(sheet_entry):
+        return loadxl_patch(sheet_entry[1], sheet_entry[0], connection, alias_dict)
+
+    for (n, _), (error_rep, record) in zip(entries, map_rows(patch, entries, workers)):
+        if error_rep:
+            print(error_rep)
+        submission_report.add(**record)
+        done[n] += 1
+        if done[n] == totals[n]:
+            print("{sheet}(phase2): {total} items patched.".format(sheet=n.upper(), total=totals[n]))
     for n in patch_list.keys():
-        total = 0
-        for entry in patch_list[n]:
-            entry = delete_fields(entry, connection, entry)
-            if entry != {}:
-                total = total + 1
-                try:
-                    e = ff_utils.patch_metadata(entry, entry["uuid"], key=connection.key)
-                except Exception as problem:
-                    e = parse_exception(problem)
-                if e.get("status") == "error":  # pragma: no cover
-                    error_rep = error_report(e, n.upper(), [k for k in alias_dict], connection)
-                    if error_rep:
-                        print(error_rep)
-                    else:
-                        # if error is a weird one
-                        print(e)
-        print("{sheet}(phase2): {total} items patched.".format(sheet=n.upper(), total=total))
+        if not totals[n]:
+            print("{sheet}(phase2): {total} items patched.".format(sheet=n.upper(), total=0))
 
 
 def _verify_and_return_item(item, connection):
@@ -1625,7 +3855,7 @@ def cabin_cross_check(connection, patchall, update, infile, remote, lab=None, aw
 
 
 def get_profiles(connection):
-    return ff_utils.get_metadata("/profiles/", key=connection.key, add_on="frame=object")
+    return get_schema_metadata(connection, "/profiles/", add_on="frame=object")
 
 
 def get_attachment_fields(profiles):
@@ -1637,6 +3867,21 @@ def get_attachment_fields(profiles):
     return attach_field
 
 
+def get_subtypes(profiles):
+    """{abstract item type: set of all its (direct and indirect) sub types} from the rdfs:subClassOf
+    of the profiles - Item, that everything is a sub type of, is left out."""
+    parents = {name: re.sub(r'^/profiles/|\.json$', '', profile.get('rdfs:subClassOf') or '')
+               for name, profile in profiles.items() if isinstance(profile, dict)}
+    subtypes = {}
+    for name in parents:
+        parent, seen = parents[name], {name}
+        while parent and parent != 'Item' and parent not in seen:
+            subtypes.setdefault(parent, set()).add(name)
+            seen.add(parent)
+            parent = parents.get(parent)
+    return subtypes
+
+
 def get_collections(profiles):
     """Get a list of all the data_types in the system."""
     supported_collections = list(profiles.keys())
@@ -1644,6 +3889,15 @@ def get_collections(profiles):
     return supported_collections
 
 
+def _add_aliases(aliases_by_type, sheet, my_aliases):
+    for a in my_aliases:
+        if aliases_by_type.get(a):
+            print("WARNING! NON-UNIQUE ALIAS: ", a)
+            print("\tused for TYPE ", aliases_by_type[a], "and ", sheet)
+        else:
+            aliases_by_type[a] = sheet
+
+
 def get_all_aliases(workbook, sheets):
     """Extracts all aliases existing in the workbook to later check object connections
        Checks for same aliases that are used for different items and gives warning."""
@@ -1651,6 +3905,12 @@ def get_all_aliases(workbook, sheets):
     for sheet in sheets:
         if sheet == 'ExperimentMic_Path':
             continue
+        if isinstance(workbook, WorkbookIndex):
+            # aliases were already collected when indexing
+            if sheet in workbook:
+                for _, my_aliases in workbook[sheet].aliases:
+                    _add_aliases(aliases_by_type, sheet, my_aliases)
+            continue
         alias_col = ""
         rows = reader(workbook, sheetname=sheet)
         keys = next(rows)  # grab the first row of headers
@@ -1666,73 +3926,149 @@ def get_all_aliases(workbook, sheets):
             my_aliases = [x.strip() for x in my_alias.split(",")]
             my_aliases = list(filter(None, my_aliases))
             if my_aliases:
-                for a in my_aliases:
-                    if aliases_by_type.get(a):
-                        print("WARNING! NON-UNIQUE ALIAS: ", a)
-                        print("\tused for TYPE ", aliases_by_type[a], "and ", sheet)
-                    else:
-                        aliases_by_type[a] = sheet
+                _add_aliases(aliases_by_type, sheet, my_aliases)
     return aliases_by_type
 
 
+def finish_profile(args, cprofiler=None):  # pragma: no cover
+    profiler.disable()
+    if args.profile or args.profile_out:
+        for line in profiler.report():
+            print(line)
+    if args.profile_out:
+        with open(args.profile_out, 'w') as out:
+            json.dump(profiler.as_dict(), out, indent=2)
+    if cprofiler is not None:
+        cprofiler.disable()
+        cprofiler.dump_stats(args.cprofile)
+        print("cProfile stats written to {}".format(args.cprofile))
+
+
 def main():  # pragma: no cover
     args = getArgs()
+    cprofiler = None
+    if args.cprofile:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
     key = FDN_Key(args.keyfile, args.key)
     # check if key has error
     if key.error:
         sys.exit(1)
     # establish connection and run checks
-    connection = FDN_Connection(key)
-    cabin_cross_check(connection, args.patchall, args.update, args.infile,
-                      args.remote, args.lab, args.award)
-    # support for xlsx only - adjust if allowing different
-    workbook, sheetnames = digest_xlsx(args.infile)
-
-    # This is not in our documentation, but if single sheet is used, file name can be the collection
-    if args.type and 'all' not in args.type:
-        names = args.type
-    else:
-        names = sheetnames
-    # get me a list of all the data_types in the system
-    profiles = get_profiles(connection)
-    supported_collections = get_collections(profiles)
-    attachment_fields = get_attachment_fields(profiles)
-    # we want to read through names in proper upload order
-    sorted_names = order_sorter(names)
-    # get all aliases from all sheets for dryrun object connections tests
-    aliases_by_type = get_all_aliases(workbook, sorted_names)
-    # all_aliases = list(aliases_by_type.keys())
-    # dictionaries that accumulate information during submission
-    dict_loadxl = {}
-    dict_replicates = {}
-    dict_exp_sets = {}
-    # Todo combine accumulate dicts to one
-    # accumulate = {dict_loadxl: {}, dict_replicates: {}, dict_exp_sets: {}}
-    for n in sorted_names:
-        if n.lower() in supported_collections:
-            workbook_reader(workbook, n, args.update, connection, args.patchall, aliases_by_type,
-                            dict_loadxl, dict_replicates, dict_exp_sets, args.novalidate, attachment_fields)
-        elif n.lower() == "experimentmic_path":
-            workbook_reader(workbook, "ExperimentMic_Path", args.update, connection, args.patchall, aliases_by_type,
-                            dict_loadxl, dict_replicates, dict_exp_sets, args.novalidate, attachment_fields)
-        elif n.lower().startswith('user_workflow'):
-            if args.update:
-                user_workflow_reader(workbook, n, connection)
-            else:
-                print('user workflow sheets will only be processed with the --update argument')
+    # keep a connection for each row worker of each sheet loaded at the same time
+    connection = FDN_Connection(key, pool_size=args.pool_size and max(
+        args.pool_size, args.sheet_workers * max(args.workers, args.dryrun_workers or 0), args.loadxl_workers))
+    set_schema_cache(connection, args)
+    if args.profile or args.profile_out:
+        profiler.enable()
+    journal = None if args.no_upload_journal else UploadJournal(args.upload_journal)
+    s3_uploader.configure(args.upload_part_size * MB, args.upload_concurrency, args.upload_files, journal,
+                          args.s3_endpoint_url, args.pipe_remote_files)
+    if args.link_cache_size:
+        connection.link_cache = LinkCache(args.link_cache_size)
+    connection.upload_credentials = UploadCredentials()
+    if args.attachment_cache_size:
+        connection.attachment_cache = AttachmentCache(args.attachment_cache_size * MB)
+    checksums.configure(None if args.no_checksum_cache else ChecksumStore(), args.md5_workers, args.md5_on_upload)
+    downloads.configure(args.download_workers, args.download_dir, args.download_ahead, args.download_max_size * MB)
+    try:
+        cabin_cross_check(connection, args.patchall, args.update, args.infile,
+                          args.remote, args.lab, args.award)
+        # support for xlsx only - adjust if allowing different
+        with profiler.phase('digest_xlsx'):
+            book, sheetnames = digest_xlsx(args.infile, read_only=args.stream_workbook)
+
+        # This is not in our documentation, but if single sheet is used, file name can be the collection
+        if args.type and 'all' not in args.type:
+            names = args.type
         else:
-            print("Sheet name '{name}' not part of supported object types!".format(name=n))
-    loadxl_cycle(dict_loadxl, connection, aliases_by_type)
-    # if any item left in the following dictionaries
-    # it means that this items are not posted/patched
-    # because they are not on the exp_set file_set sheets
-    for dict_store, dict_sheet in [[dict_replicates, "ExperimentSetReplicate"],
-                                   [dict_exp_sets, "ExperimentSet"]]:
-        if dict_store:
-            remains = ', '.join(dict_store.keys())
-            print('Following items are not posted')
-            print('make sure they are on {} sheet'.format(dict_sheet))
-            print(remains)
+            names = sheetnames
+        # get me a list of all the data_types in the system
+        with profiler.phase('get_profiles'):
+            profiles = get_profiles(connection)
+        supported_collections = get_collections(profiles)
+        attachment_fields = get_attachment_fields(profiles)
+        # we want to read through names in proper upload order
+        sorted_names = order_sorter(names)
+        submission_report.open(args.report)
+        # read the sheets once - all the readers below work from this index
+        # (the rows of a streamed workbook are kept on disk rather than in memory)
+        with profiler.phase('read sheets'):
+            workbook = WorkbookIndex(book, sorted_names, keep_rows=not args.stream_workbook)
+        book.close()
+        # get all aliases from all sheets for dryrun object connections tests
+        with profiler.phase('get_all_aliases'):
+            aliases_by_type = get_all_aliases(workbook, sorted_names)
+        # start downloading the remote files while the sheets are loaded
+        # (files are only uploaded by a real submission, and streamed from their source with --pipe-remote-files)
+        downloads.prefetch(remote_paths_to_fetch(workbook, sorted_names, attachment_fields,
+                                                 filenames=(args.update or args.patchall) and not args.pipe_remote_files))
+        # all_aliases = list(aliases_by_type.keys())
+        # dictionaries that accumulate information during submission
+        dict_loadxl = {}
+        dict_replicates = {}
+        dict_exp_sets = {}
+        # Todo combine accumulate dicts to one
+        # accumulate = {dict_loadxl: {}, dict_replicates: {}, dict_exp_sets: {}}
+
+        def load_sheet(n):
+            if n.lower() in supported_collections:
+                with profiler.phase('workbook_reader ' + n):
+                    workbook_reader(workbook, n, args.update, connection, args.patchall, aliases_by_type,
+                                    dict_loadxl, dict_replicates, dict_exp_sets, args.novalidate, attachment_fields,
+                                    workers=args.workers, batch_lookup=args.batch_lookup,
+                                    dryrun_workers=args.dryrun_workers)
+            elif n.lower() == "experimentmic_path":
+                with profiler.phase('workbook_reader ' + n):
+                    workbook_reader(workbook, "ExperimentMic_Path", args.update, connection, args.patchall,
+                                    aliases_by_type, dict_loadxl, dict_replicates, dict_exp_sets, args.novalidate,
+                                    attachment_fields, workers=args.workers, batch_lookup=args.batch_lookup,
+                                    dryrun_workers=args.dryrun_workers)
+            elif n.lower().startswith('user_workflow'):
+                if args.update:
+                    with profiler.phase('user_workflow_reader ' + n):
+                        user_workflow_reader(workbook, n, connection)
+                else:
+                    print('user workflow sheets will only be processed with the --update argument')
+            else:
+                print("Sheet name '{name}' not part of supported object types!".format(name=n))
+
+        # the user workflow sheets come last and are run after all the others
+        item_sheets = [n for n in sorted_names if not n.lower().startswith('user_workflow')]
+        dependencies = {}
+        if args.sheet_workers > 1:
+            dependencies = sheet_dependencies(workbook, item_sheets, aliases_by_type, get_subtypes(profiles))
+        run_sheets(item_sheets, dependencies, load_sheet, args.sheet_workers)
+        for n in sorted_names[len(item_sheets):]:
+            load_sheet(n)
+        with profiler.phase('loadxl_cycle'):
+            loadxl_cycle(dict_loadxl, connection, aliases_by_type, workers=args.loadxl_workers)
+        workbook.close()
+        if args.debug and connection.link_cache is not None:
+            print("link validation: {} lookups, {} from cache".format(
+                connection.link_cache.hits + connection.link_cache.misses, connection.link_cache.hits))
+        if args.debug and connection.attachment_cache is not None:
+            print("attachments: {} used, {} from cache".format(
+                connection.attachment_cache.hits + connection.attachment_cache.misses, connection.attachment_cache.hits))
+        # if any item left in the following dictionaries
+        # it means that this items are not posted/patched
+        # because they are not on the exp_set file_set sheets
+        for dict_store, dict_sheet in [[dict_replicates, "ExperimentSetReplicate"],
+                                       [dict_exp_sets, "ExperimentSet"]]:
+            if dict_store:
+                remains = ', '.join(dict_store.keys())
+                print('Following items are not posted')
+                print('make sure they are on {} sheet'.format(dict_sheet))
+                print(remains)
+    finally:
+        # also when a sheet fails or the run is interrupted - the prefetched files can take up
+        # gigabytes and the md5 workers are processes of their own
+        checksums.close()
+        downloads.close()
+        submission_report.close()
+        if journal is not None:
+            journal.close()
+        finish_profile(args, cprofiler)
 
 
 if __name__ == '__main__':